@@ -1,12 +1,26 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import (Flask, Response, request, abort, jsonify,
+                   stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_cors import CORS
-from datetime import datetime
-
-from models import db, Actor, Movie, Role
-from auth import AuthError, requires_auth
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from models import (db, Actor, Movie, Role, ActorRecord, MovieRecord,
+                    RoleRecord, transaction, update_record,
+                    delete_record)
+from filters import (FilterError, ACTOR_FILTERS, MOVIE_FILTERS,
+                     ROLE_FILTERS, apply_filters)
+from pagination import PaginationError, paginate
+from streaming import stream_list, wants_stream
+from export import EXPORT_ENTITIES, EXPORT_FORMATS, Export
+from search import SearchError, format_result, search
+from autocomplete import (IndexNotReady, complete, format_completion,
+                          rebuild_in_background)
+from dates import parse_date
+from batch import BatchError, create_batch, delete_batch, replace_cast
+from auth import AuthError, requires_auth, register_route_permissions
 
 app = Flask(__name__)
 app.config.from_object("config")
@@ -32,7 +46,14 @@ def welcome():
 @requires_auth('get:actors')
 def get_actors(payload):
     '''
-  Get a list of all actors in JSON format
+  Get a page of actors in JSON format
+    - ?limit=N (default 100) and ?sort=name,-age (id, name, age)
+    - ?age_min=20&age_max=30 (both included), ?gender=Female and
+      ?name_prefix=Am (case sensitive) keep the matching actors
+    - next_cursor is passed as ?after=<cursor> to get the next page,
+      it is null on the last page
+    - ?stream=1 streams every row after the cursor (up to limit, if
+      given) in the same envelope, see streaming.py
     EXAMPLE
     {
       "action": "get all actors",
@@ -44,19 +65,30 @@ def get_actors(payload):
           "name": "Link"
         }
       ],
+      "next_cursor": null,
       "success": true
   }
   '''
     try:
-        actors = Actor.query.all()
+        # read-only: select the columns rather than Actor instances
+        query = apply_filters(ActorRecord.query(), ACTOR_FILTERS,
+                              request.args)
+        if wants_stream(request.args):
+            return stream_list(query, Actor, ActorRecord,
+                               request.args, 'get all actors', 'actors')
+
+        rows, next_cursor = paginate(query, Actor, request.args)
 
-        formatted_actors = [actor.format() for actor in actors]
+        formatted_actors = [ActorRecord._make(row).format() for row in rows]
 
         return jsonify({
             'success': True,
             'action': 'get all actors',
             'actors': formatted_actors,
+            'next_cursor': next_cursor,
         })
+    except (PaginationError, FilterError):
+        abort(400)
     except Exception:
         abort(422)
 
@@ -67,8 +99,10 @@ def add_actor(payload):
     '''
   Add an actor entity to database
     actor has name, age, gender, and an unique id assigned by database
-    age must be an integer
+    name is required and age must be an integer
     return the new actor entity in JSON format
+    - a JSON array of actors adds them all in one transaction, or none
+      of them with the errors of each invalid item, see batch.py
     EXAMPLE
     {
       "action": "add a new actor",
@@ -87,11 +121,19 @@ def add_actor(payload):
         body = request.get_json()
         if body is None:
             abort(400)
+        if isinstance(body, list):
+            return jsonify({
+                'success': True,
+                'action': 'add new actors',
+                'actors': create_batch('actors', body),
+            })
 
         req_name = body.get('name')
         req_age = body.get('age')
         req_gender = body.get('gender')
 
+        if not req_name:
+            abort(400)
         if not isinstance(req_age, int):
             abort(400, {'message': 'age must be an integer'})
 
@@ -105,6 +147,8 @@ def add_actor(payload):
             'action': 'add a new actor',
             'actors': formatted_actor
         })
+    except BatchError:
+        raise
     except Exception as e:
         if e.code == 400:
             abort(400)
@@ -140,7 +184,10 @@ def get_actor_detail(payload, id):
     }
   '''
     try:
-        actor = Actor.query.filter(Actor.id == id).one_or_none()
+        # the actor, its roles and their movies in one query
+        actor = Actor.query \
+            .options(joinedload(Actor.roles).joinedload(Role.movie)) \
+            .filter(Actor.id == id).one_or_none()
         if not actor:
             abort(404)
 
@@ -172,6 +219,7 @@ def get_actor_detail(payload, id):
 def edit_actor(payload, id):
     '''
   Edit an existing actor entity
+    name, age and gender can be changed together, in one UPDATE
     return the edited actor entity in JSON format
     EXAMPLE
     {
@@ -189,26 +237,28 @@ def edit_actor(payload, id):
   '''
     try:
         body = request.get_json()
-        if body is None:
+        if not isinstance(body, dict):
             abort(400)
 
-        actor = Actor.query.filter(Actor.id == id).one_or_none()
-        if not actor:
-            abort(404)
-
+        # every field given is applied
+        values = {}
         if body.get('name'):
-            actor.name = body.get('name')
-        elif body.get('age'):
+            values['name'] = body.get('name')
+        if body.get('age') is not None:
             # verify age is integer
             if not isinstance(body.get('age'), int):
                 abort(400)
-            actor.age = body.get('age')
-        elif body.get('gender'):
-            actor.gender = body.get('gender')
-        else:
+            values['age'] = body.get('age')
+        if body.get('gender'):
+            values['gender'] = body.get('gender')
+        if not values:
             abort(400)
 
-        actor.update()
+        # one UPDATE ... RETURNING, no row means no such actor
+        with transaction():
+            actor = update_record(ActorRecord, Actor, id, values)
+        if actor is None:
+            abort(404)
 
         formatted_actor = [actor.format()]
 
@@ -230,7 +280,7 @@ def edit_actor(payload, id):
 @requires_auth('delete:actors')
 def delete_actor(payload, id):
     '''
-  Delete an existing actor entity from database
+  Delete an existing actor entity from database, with its roles
     return the deleted actor info in JSON format
     EXAMPLE
     {
@@ -247,12 +297,12 @@ def delete_actor(payload, id):
     }
   '''
     try:
-        actor = Actor.query.filter(Actor.id == id).one_or_none()
-        if not actor:
+        # one DELETE ... RETURNING, the database deletes the roles
+        with transaction():
+            actor = delete_record(ActorRecord, Actor, id)
+        if actor is None:
             abort(404)
 
-        actor.delete()
-
         formatted_actor = [actor.format()]
 
         return jsonify({
@@ -267,6 +317,50 @@ def delete_actor(payload, id):
             abort(422)
 
 
+@app.route('/actors', methods=['DELETE'])
+@requires_auth('delete:actors')
+def delete_actors(payload):
+    '''
+  Delete the actors with the given ids, with their roles, in one statement
+    - the body lists the ids: {"ids": [2, 3, 1000]}
+    - ids that match no actor are returned in missing_ids
+    EXAMPLE
+    {
+      "action": "delete actors",
+      "deleted_actors": [
+        {
+          "age": 24,
+          "gender": "Female",
+          "id": 2,
+          "name": "Amy"
+        }
+      ],
+      "missing_ids": [1000],
+      "success": true
+    }
+  '''
+    try:
+        body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
+
+        deleted, missing_ids = delete_batch('actors', body.get('ids'))
+
+        return jsonify({
+            'success': True,
+            'action': 'delete actors',
+            'deleted_actors': deleted,
+            'missing_ids': missing_ids,
+        })
+    except BatchError:
+        raise
+    except Exception as e:
+        if e.code == 400:
+            abort(400)
+        else:
+            abort(422)
+
+
 # ---------------------------------------
 # Decorators for /movies
 # ---------------------------------------
@@ -276,7 +370,15 @@ def delete_actor(payload, id):
 @requires_auth('get:movies')
 def get_movies(payload):
     '''
-  Get a list of movie entity in JSON format
+  Get a page of movie entity in JSON format
+    - ?limit=N (default 100) and ?sort=-date,title (id, title, date,
+      release_year)
+    - ?year_from=2015&year_to=2020 keeps the movies released in these
+      years (both included)
+    - next_cursor is passed as ?after=<cursor> to get the next page,
+      it is null on the last page
+    - ?stream=1 streams every row after the cursor (up to limit, if
+      given) in the same envelope, see streaming.py
     EXAMPLE
     {
       "action": "get all movies",
@@ -287,19 +389,29 @@ def get_movies(payload):
           "title": "The Legend of Zelda: Breath of the Wild"
         }
       ],
+      "next_cursor": null,
       "success": true
     }
   '''
     try:
-        movies = Movie.query.all()
+        query = apply_filters(MovieRecord.query(), MOVIE_FILTERS,
+                              request.args)
+        if wants_stream(request.args):
+            return stream_list(query, Movie, MovieRecord,
+                               request.args, 'get all movies', 'movies')
+
+        rows, next_cursor = paginate(query, Movie, request.args)
 
-        formatted_movies = [movie.format() for movie in movies]
+        formatted_movies = [MovieRecord._make(row).format() for row in rows]
 
         return jsonify({
             'success': True,
             'action': 'get all movies',
             'movies': formatted_movies,
+            'next_cursor': next_cursor,
         })
+    except (PaginationError, FilterError):
+        abort(400)
     except Exception as e:
         abort(422)
 
@@ -312,6 +424,8 @@ def add_movie(payload):
     - Moive has title and date
     - date must be in an expected form
     - return new movie in JSON format
+    - a JSON array of movies adds them all in one transaction, or none
+      of them with the errors of each invalid item, see batch.py
     EXAMPLE
     {
       "action": "add a new movie",
@@ -329,26 +443,21 @@ def add_movie(payload):
         body = request.get_json()
         if body is None:
             abort(400)
+        if isinstance(body, list):
+            return jsonify({
+                'success': True,
+                'action': 'add new movies',
+                'movies': create_batch('movies', body),
+            })
 
         req_title = body.get('title')
         req_date = body.get('date')
-        if req_date is None:
+        if not req_title or req_date is None:
             abort(400)
 
-        # This format string and sample is provided by dawg on
-        # https://stackoverflow.com/questions/25341945/check-if-string-has-date-any-format
-        fmts = ('%Y', '%b %d, %Y', '%b %d, %Y', '%B %d, %Y', '%B %d %Y',
-                '%m/%d/%Y', '%m/%d/%y', '%b %Y', '%B%Y', '%b %d,%Y',
-                '%Y-%m-%d', '%y-%m-%d', '%m-%d-%Y', '%m-%d-$y')
-        is_datetime = False
-        for fmt in fmts:
-            try:
-                t = datetime.strptime(req_date, fmt)
-                is_datetime = True
-                break
-            except ValueError:
-                pass
-        if not is_datetime:
+        try:
+            req_date = parse_date(req_date)
+        except ValueError:
             abort(400)
 
         movie = Movie(title=req_title, date=req_date)
@@ -361,6 +470,8 @@ def add_movie(payload):
             'action': 'add a new movie',
             'movies': formatted_movie,
         })
+    except BatchError:
+        raise
     except Exception as e:
         if e.code == 400:
             abort(400)
@@ -395,7 +506,10 @@ def get_movie_detail(payload, id):
     }
   '''
     try:
-        movie = Movie.query.filter(Movie.id == id).one_or_none()
+        # the movie, its roles and their actors in one query
+        movie = Movie.query \
+            .options(joinedload(Movie.roles).joinedload(Role.actor)) \
+            .filter(Movie.id == id).one_or_none()
         if not movie:
             abort(404)
 
@@ -427,6 +541,7 @@ def get_movie_detail(payload, id):
 def edit_movie(payload, id):
     '''
   Edit an existing movie
+    - title and date can be changed together, in one UPDATE
     - date must be in an expected form
     - return edited movie in JSON format
     EXAMPLE
@@ -444,36 +559,26 @@ def edit_movie(payload, id):
   '''
     try:
         body = request.get_json()
-        if body is None:
+        if not isinstance(body, dict):
             abort(400)
 
-        movie = Movie.query.filter(Movie.id == id).one_or_none()
-        if not movie:
-            abort(404)
-
+        # every field given is applied
+        values = {}
         if body.get('title'):
-            movie.title = body.get('title')
-        elif body.get('date'):
-            # This format string and sample is provided by dawg on
-            # https://stackoverflow.com/questions/25341945/check-if-string-has-date-any-format
-            fmts = ('%Y', '%b %d, %Y', '%b %d, %Y', '%B %d, %Y', '%B %d %Y',
-                    '%m/%d/%Y', '%m/%d/%y', '%b %Y', '%B%Y', '%b %d,%Y',
-                    '%Y-%m-%d', '%y-%m-%d', '%m-%d-%Y', '%m-%d-$y')
-            is_datetime = False
-            for fmt in fmts:
-                try:
-                    t = datetime.strptime(body.get('date'), fmt)
-                    is_datetime = True
-                    movie.date = body.get('date')
-                    break
-                except ValueError:
-                    pass
-            if not is_datetime:
+            values['title'] = body.get('title')
+        if body.get('date'):
+            try:
+                values['date'] = parse_date(body.get('date'))
+            except ValueError:
                 abort(400)
-        else:
+        if not values:
             abort(400)
 
-        movie.update()
+        # one UPDATE ... RETURNING, no row means no such movie
+        with transaction():
+            movie = update_record(MovieRecord, Movie, id, values)
+        if movie is None:
+            abort(404)
 
         formatted_movie = [movie.format()]
 
@@ -495,7 +600,7 @@ def edit_movie(payload, id):
 @requires_auth('delete:movies')
 def delete_movie(payload, id):
     '''
-  Delete an existing movie from database
+  Delete an existing movie from database, with its roles
     - return delete movie info in JSON format
     EXAMPLE
     {
@@ -511,12 +616,12 @@ def delete_movie(payload, id):
     }
   '''
     try:
-        movie = Movie.query.filter(Movie.id == id).one_or_none()
-        if not movie:
+        # one DELETE ... RETURNING, the database deletes the roles
+        with transaction():
+            movie = delete_record(MovieRecord, Movie, id)
+        if movie is None:
             abort(404)
 
-        movie.delete()
-
         formatted_movie = [movie.format()]
 
         return jsonify({
@@ -531,6 +636,106 @@ def delete_movie(payload, id):
             abort(422)
 
 
+@app.route('/movies', methods=['DELETE'])
+@requires_auth('delete:movies')
+def delete_movies(payload):
+    '''
+  Delete the movies with the given ids, with their roles, in one statement
+    - the body lists the ids: {"ids": [2, 3, 1000]}
+    - ids that match no movie are returned in missing_ids
+    EXAMPLE
+    {
+      "action": "delete movies",
+      "deleted_movies": [
+        {
+          "id": 2,
+          "release_year": "2017",
+          "title": "The Legend of Zelda: Breath of the Wild"
+        }
+      ],
+      "missing_ids": [1000],
+      "success": true
+    }
+  '''
+    try:
+        body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
+
+        deleted, missing_ids = delete_batch('movies', body.get('ids'))
+
+        return jsonify({
+            'success': True,
+            'action': 'delete movies',
+            'deleted_movies': deleted,
+            'missing_ids': missing_ids,
+        })
+    except BatchError:
+        raise
+    except Exception as e:
+        if e.code == 400:
+            abort(400)
+        else:
+            abort(422)
+
+
+@app.route('/movies/<int:id>/castings', methods=['PUT'])
+@requires_auth(('post:castings', 'delete:castings'))
+def replace_movie_cast(payload, id):
+    '''
+  Replace the roles of a movie with the given list, in one transaction
+    - the body is the whole cast: [{"actor_id": 3, "role_name": "Hero"}]
+    - roles already there are kept, roles of an actor who gets another
+      role are renamed, the others are deleted or inserted, see batch.py
+    - requires post:castings and delete:castings
+    EXAMPLE
+    {
+      "action": "replace the cast of a movie",
+      "deleted": 0,
+      "inserted": 1,
+      "roles": [
+        {
+          "actor_id": 3,
+          "actor_name": "Link",
+          "id": 1,
+          "movie_id": 1,
+          "movie_name": "The Legend of Zelda: Breath of the Wild",
+          "role_name": "Hero"
+        }
+      ],
+      "success": true,
+      "updated": 0
+    }
+  '''
+    try:
+        body = request.get_json()
+        if body is None:
+            abort(400)
+
+        cast = replace_cast(id, body)
+        if cast is None:
+            abort(404)
+        roles, inserted, updated, deleted = cast
+
+        return jsonify({
+            'success': True,
+            'action': 'replace the cast of a movie',
+            'roles': roles,
+            'inserted': inserted,
+            'updated': updated,
+            'deleted': deleted,
+        })
+    except BatchError:
+        raise
+    except Exception as e:
+        if e.code == 400:
+            abort(400)
+        elif e.code == 404:
+            abort(404)
+        else:
+            abort(422)
+
+
 # ---------------------------------------
 # Decorators for /castings
 # ---------------------------------------
@@ -540,10 +745,17 @@ def delete_movie(payload, id):
 @requires_auth('get:castings')
 def get_roles(payload):
     '''
-  Get a list of all roles in JSON format
+  Get a page of roles in JSON format
+    - ?limit=N (default 100) and ?sort=role_name (id, role_name)
+    - ?actor_id=3 and ?movie_id=1 keep the roles of an actor, of a movie
+    - next_cursor is passed as ?after=<cursor> to get the next page,
+      it is null on the last page
+    - ?stream=1 streams every row after the cursor (up to limit, if
+      given) in the same envelope, see streaming.py
     EXAMPLE
     {
       "action": "get all roles",
+      "next_cursor": null,
       "roles": [
         {
           "actor_id": 3,
@@ -558,15 +770,24 @@ def get_roles(payload):
     }
   '''
     try:
-        roles = Role.query.all()
+        # the roles joined to their actor and movie names in one query
+        query = apply_filters(RoleRecord.query(), ROLE_FILTERS, request.args)
+        if wants_stream(request.args):
+            return stream_list(query, Role, RoleRecord,
+                               request.args, 'get all roles', 'roles')
+
+        rows, next_cursor = paginate(query, Role, request.args)
 
-        formatted_roles = [role.format() for role in roles]
+        formatted_roles = [RoleRecord._make(row).format() for row in rows]
 
         return jsonify({
             'success': True,
             'action': 'get all roles',
-            'roles': formatted_roles
+            'roles': formatted_roles,
+            'next_cursor': next_cursor,
         })
+    except (PaginationError, FilterError):
+        abort(400)
     except Exception:
         abort(422)
 
@@ -580,6 +801,8 @@ def add_role(payload):
     - actor_id and movie_id must be associated with an existing record
       from the database
     - return the new role in JSON format
+    - a JSON array of roles adds them all in one transaction, or none
+      of them with the errors of each invalid item, see batch.py
     EXAMPLE
     {
       "action": "add a new role",
@@ -600,26 +823,30 @@ def add_role(payload):
         body = request.get_json()
         if body is None:
             abort(400)
-
-        # actor_id and movie_id are required
-        if not (body.get('actor_id') and body.get('movie_id')):
+        if isinstance(body, list):
+            return jsonify({
+                'success': True,
+                'action': 'add new roles',
+                'roles': create_batch('roles', body),
+            })
+
+        # role_name, actor_id and movie_id are required
+        if not (body.get('role_name') and body.get('actor_id') and
+                body.get('movie_id')):
             abort(400)
 
         req_role_name = body.get('role_name')
         req_actor_id = body.get('actor_id')
         req_movie_id = body.get('movie_id')
 
-        # actor and movie must exist in the database
-        actor = Actor.query.filter(Actor.id == req_actor_id).one_or_none()
-        movie = Movie.query.filter(Movie.id == req_movie_id).one_or_none()
-        if not (actor and movie):
+        # actor and movie must exist in the database: checked, inserted
+        # and read back with their names in one statement
+        with transaction():
+            role = RoleRecord.create(req_role_name, req_actor_id,
+                                     req_movie_id)
+        if role is None:
             abort(400)
 
-        role = Role(role_name=req_role_name,
-                    actor_id=req_actor_id,
-                    movie_id=req_movie_id)
-        role.insert()
-
         formatted_roles = [role.format()]
 
         return jsonify({
@@ -627,6 +854,11 @@ def add_role(payload):
             'action': 'add a new role',
             'roles': formatted_roles,
         })
+    except BatchError:
+        raise
+    except IntegrityError:
+        # the actor or the movie was deleted while the role was inserted
+        abort(400)
     except Exception as e:
         if e.code == 400:
             abort(400)
@@ -677,10 +909,212 @@ def delete_role(payload, id):
             abort(422)
 
 
+@app.route('/castings', methods=['DELETE'])
+@requires_auth('delete:castings')
+def delete_roles(payload):
+    '''
+  Delete the roles with the given ids, in one statement
+    - the body lists the ids: {"ids": [2, 3, 1000]}
+    - ids that match no role are returned in missing_ids
+    EXAMPLE
+    {
+      "action": "delete roles",
+      "deleted_roles": [
+        {
+          "actor_id": 3,
+          "actor_name": "Link",
+          "id": 2,
+          "movie_id": 1,
+          "movie_name": "The Legend of Zelda: Breath of the Wild",
+          "role_name": "Hero who doesn't save the princess"
+        }
+      ],
+      "missing_ids": [1000],
+      "success": true
+    }
+  '''
+    try:
+        body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
+
+        deleted, missing_ids = delete_batch('roles', body.get('ids'))
+
+        return jsonify({
+            'success': True,
+            'action': 'delete roles',
+            'deleted_roles': deleted,
+            'missing_ids': missing_ids,
+        })
+    except BatchError:
+        raise
+    except Exception as e:
+        if e.code == 400:
+            abort(400)
+        else:
+            abort(422)
+
+
+# ---------------------------------------
+# Decorators for /search
+# ---------------------------------------
+
+
+@app.route('/search', methods=['GET'])
+@requires_auth(('get:actors', 'get:movies', 'get:castings'))
+def search_casting(payload):
+    '''
+  Get a page of the actors, movies and roles matching a search, best first
+    - ?q=words: the actor names, movie titles and role names having every
+      word (any case, any order), see search.py
+    - ?limit=N (default 100), next_cursor is passed as ?after=<cursor>
+      to get the next page, it is null on the last page
+    - requires get:actors, get:movies and get:castings
+    EXAMPLE
+    {
+      "action": "search",
+      "next_cursor": null,
+      "results": [
+        {
+          "id": 1,
+          "rank": 0.0607927,
+          "title": "The Legend of Zelda: Breath of the Wild",
+          "type": "movie"
+        }
+      ],
+      "success": true
+    }
+  '''
+    try:
+        rows, next_cursor = search(request.args)
+
+        return jsonify({
+            'success': True,
+            'action': 'search',
+            'results': [format_result(row) for row in rows],
+            'next_cursor': next_cursor,
+        })
+    except (PaginationError, SearchError):
+        abort(400)
+    except Exception:
+        abort(422)
+
+
+# ---------------------------------------
+# Decorators for /autocomplete
+# ---------------------------------------
+
+
+@app.before_first_request
+def build_autocomplete_index():
+    # the worker builds its index while serving its first requests
+    rebuild_in_background(app)
+
+
+@app.route('/autocomplete', methods=['GET'])
+@requires_auth(('get:actors', 'get:movies'))
+def autocomplete_names(payload):
+    '''
+  Get the actor names and movie titles starting with q, in any case, sorted
+    - ?q=text, the start of the name or title
+    - ?limit=N (default 10, at most 100)
+    - served from the memory of the worker, see autocomplete.py
+    - 503 until the worker has built its index
+    - requires get:actors and get:movies
+    EXAMPLE
+    {
+      "action": "autocomplete",
+      "results": [
+        {
+          "id": 1,
+          "title": "The Legend of Zelda: Breath of the Wild",
+          "type": "movie"
+        }
+      ],
+      "success": true
+    }
+  '''
+    try:
+        entries = complete(request.args)
+
+        return jsonify({
+            'success': True,
+            'action': 'autocomplete',
+            'results': [format_completion(entry) for entry in entries],
+        })
+    except (PaginationError, SearchError):
+        abort(400)
+    except IndexNotReady:
+        abort(503)
+    except Exception:
+        abort(422)
+
+
+# ---------------------------------------
+# Decorators for /export
+# ---------------------------------------
+
+
+@app.route('/export', methods=['GET'])
+@requires_auth(('get:actors', 'get:movies', 'get:castings'))
+def export_casting(payload):
+    '''
+  Stream actors, movies and roles for bulk reads, from one snapshot
+    - ?format=ndjson (default): one JSON object per line with its "type"
+    - ?format=csv&entity=actors: a single entity (actors, movies, roles)
+    - ?entity=actors,roles: only these entities (NDJSON)
+    - requires get:actors, get:movies and get:castings
+    EXAMPLE
+    {"type":"actor","id":3,"name":"Link","age":117,"gender":"Male"}
+    {"type":"movie","id":1,"title":"Breath of the Wild","date":"2017-..."}
+    {"type":"role","id":1,"role_name":"Hero","actor_id":3,"movie_id":1}
+  '''
+    export_format = request.args.get('format', 'ndjson')
+    entities = [entity for entity in request.args.get('entity', '')
+                .split(',') if entity] or list(EXPORT_ENTITIES)
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    if export_format == 'csv' and len(entities) != 1:
+        abort(400)
+    if any(entity not in EXPORT_ENTITIES for entity in entities):
+        abort(400)
+
+    try:
+        export = Export(entities)
+        export.begin()
+    except Exception:
+        abort(422)
+
+    def generate():
+        if export_format == 'ndjson':
+            yield from export.ndjson()
+        else:
+            yield from export.csv(entities[0])
+        app.logger.info('exported %d rows in %.1fs (%.0f rows/s)',
+                        export.rows, export.elapsed(), export.rate())
+
+    if export_format == 'ndjson':
+        mimetype, filename = 'application/x-ndjson', 'casting.ndjson'
+    else:
+        mimetype, filename = 'text/csv', f'{entities[0]}.csv'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             f'attachment; filename={filename}'})
+
+
+# ---------------------------------------
+# Route permissions
+# ---------------------------------------
+#   (method, rule) -> permissions required by that route, collected from
+#   the @requires_auth decorators above
+
+ROUTE_PERMISSIONS = register_route_permissions(app)
+
+
 # ---------------------------------------
 # Error Handling
 # ---------------------------------------
-#   return 422, 400, 404, 405 and AuthError gracefully
+#   return 422, 400, 404, 405, BatchError and AuthError gracefully
 #   Each error handler should return with error messages
 #   EXAMPLE
 #     jsonify({
@@ -756,6 +1190,31 @@ def method_not_found(error):
     }), 405
 
 
+@app.errorhandler(503)
+def service_unavailable(error):
+    '''
+  Error handling for a service not ready yet
+  '''
+    return jsonify({
+        "success": False,
+        "error": 503,
+        "message": "service unavailable"
+    }), 503
+
+
+@app.errorhandler(BatchError)
+def batch_error(e):
+    '''
+  Error handling for a rejected batch, with the errors of its items
+  '''
+    return jsonify({
+        'success': False,
+        'error': 400,
+        'message': e.message,
+        'errors': e.errors,
+    }), 400
+
+
 @app.errorhandler(AuthError)
 def auth_error(e):
     '''
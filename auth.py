@@ -1,13 +1,58 @@
 import os
 import json
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
 from jose import jwt
 from flask import request
-from functools import wraps
+from functools import wraps, lru_cache
 from urllib.request import urlopen
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
+AUTH_ISSUER = 'https://' + AUTH0_DOMAIN + '/'
+
+# AUTH_MODE=local verifies tokens against a key pair on disk instead of
+# Auth0 (see local_auth.py), for tests and benchmarks without network.
+# The tokens still have to carry the Auth0 issuer and API audience.
+AUTH_MODE = os.environ.get('AUTH_MODE', 'auth0')
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCAL_PRIVATE_KEY_PATH = os.environ.get(
+    'LOCAL_PRIVATE_KEY_PATH', os.path.join(BASE_DIR, 'local_keys',
+                                           'private.pem'))
+LOCAL_JWKS_PATH = os.environ.get(
+    'LOCAL_JWKS_PATH', os.path.join(BASE_DIR, 'local_keys', 'jwks.json'))
+
+# How long (seconds) a fetched JWKS document is trusted before it is
+# fetched again, and the minimum gap between forced refreshes triggered
+# by tokens carrying an unknown key id
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+# Where the signing keys are fetched from, and the local file the last good
+# copy is saved to (an empty JWKS_SNAPSHOT_PATH disables the snapshot)
+if AUTH_MODE == 'local':
+    JWKS_URL = os.environ.get(
+        'JWKS_URL', 'file://' + os.path.abspath(LOCAL_JWKS_PATH))
+    JWKS_SNAPSHOT_PATH = os.environ.get('JWKS_SNAPSHOT_PATH', '')
+else:
+    JWKS_URL = os.environ.get(
+        'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+    JWKS_SNAPSHOT_PATH = os.environ.get(
+        'JWKS_SNAPSHOT_PATH', os.path.join(BASE_DIR, '.jwks-snapshot.json'))
+
+# Consecutive failed fetches before the circuit breaker opens, and seconds
+# it stays open before a trial fetch is allowed
+JWKS_FAILURE_THRESHOLD = int(os.environ.get('JWKS_FAILURE_THRESHOLD', 3))
+JWKS_RESET_TIMEOUT = int(os.environ.get('JWKS_RESET_TIMEOUT', 30))
+
+# Maximum number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
 
 
 class AuthError(Exception):
@@ -56,6 +101,348 @@ def get_token_check_auth_header():
     return header_parts[1]
 
 
+# JWKS key store
+#
+# Auth0 rotates its signing keys rarely, so the JWKS document is kept in
+# process and indexed by key id (kid). The steady state is a dict lookup;
+# the network is only touched when the document is older than the TTL or
+# when a token shows up signed with a kid we have never seen (rate limited,
+# so a flood of forged kids cannot turn into a flood of requests to Auth0)
+#
+# Refreshing happens off the request path:
+#   - the last good document is written to a snapshot file and loaded when
+#     the module is imported, so a freshly booted worker has keys before
+#     its first request
+#   - a daemon thread refreshes the keys shortly before the TTL runs out;
+#     a request that finds the keys past their TTL is still served with
+#     them and only wakes the thread up (stale-while-revalidate)
+#   - fetches go through a circuit breaker, so while Auth0 is down worker
+#     threads fail fast instead of each waiting for the fetch timeout
+#
+# Only a worker with no keys at all (no snapshot, first request) blocks on
+# the fetch.
+
+class CircuitBreaker:
+    '''
+    Consecutive failure counter guarding calls to an external service
+        - closed: calls are allowed
+        - open: after failure_threshold failures in a row, calls are
+          refused until reset_timeout seconds have passed
+        - half-open: after reset_timeout, one trial call is allowed;
+          success closes the breaker, failure opens it again
+    '''
+
+    def __init__(self, failure_threshold=JWKS_FAILURE_THRESHOLD,
+                 reset_timeout=JWKS_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        '''
+        allow()
+        return True if a call may be attempted now
+        a half-open breaker lets one caller through and re-opens for the
+        others until that trial call has been recorded
+        '''
+        with self.lock:
+            state = self.state
+            if state == 'half-open':
+                self.opened_at = time.monotonic()
+                return True
+            return state == 'closed'
+
+    def retry_in(self):
+        '''
+        retry_in()
+        seconds until an open breaker lets a trial call through
+        '''
+        if self.opened_at is None:
+            return 0
+        return max(0, self.reset_timeout -
+                   (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class JWKSCache:
+    '''
+    In-process cache of the JWKS document, keys indexed by kid
+    '''
+
+    def __init__(self, url, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT, snapshot_path=None,
+                 breaker=None, background_refresh=True):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.snapshot_path = snapshot_path
+        self.breaker = breaker or CircuitBreaker()
+        self.background_refresh = background_refresh
+        self.keys = {}
+        self.fetched_at = None
+        self.last_refresh = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+        # lock guards swapping in new keys and is never held during
+        # network I/O; fetch_lock serializes the fetches themselves and is
+        # only waited on by requests that have no usable key
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.refresher_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.refresher = None
+
+        if self.snapshot_path:
+            self.load_snapshot()
+
+    def fetch(self):
+        '''
+        fetch()
+        download the JWKS document and return it as a dict
+        '''
+        jsonurl = urlopen(self.url, timeout=self.timeout)
+        return json.loads(jsonurl.read())
+
+    def load(self, jwks):
+        '''
+        load(jwks)
+        replace the cached keys with the keys of a JWKS document
+        '''
+        keys = {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            } for key in jwks['keys'] if 'kid' in key
+        }
+        with self.lock:
+            self.keys = keys
+
+    def load_snapshot(self):
+        '''
+        load_snapshot()
+        load the keys saved by a previous fetch
+        the snapshot keeps its age, so an old snapshot is served as stale
+        and refreshed in the background. A snapshot of another url or a
+        broken file is ignored.
+        '''
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            if snapshot.get('url') != self.url:
+                return False
+            self.load(snapshot['jwks'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+        age = max(0, time.time() - snapshot.get('fetched_at', 0))
+        self.fetched_at = time.monotonic() - age
+        return True
+
+    def save_snapshot(self, jwks):
+        '''
+        save_snapshot(jwks)
+        write the JWKS document to the snapshot file
+        the file is replaced atomically so a worker booting at the same
+        time never reads a half written snapshot
+        '''
+        snapshot = {'url': self.url, 'fetched_at': time.time(), 'jwks': jwks}
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def refresh(self, kid=None, max_age=None):
+        '''
+        refresh(kid=None, max_age=None)
+        fetch the JWKS document and replace the cached keys
+            - without a kid, skip the fetch if the keys are younger than
+              max_age (default: the TTL), for instance because another
+              thread refreshed them while we waited for fetch_lock
+            - with a kid, skip the fetch if the kid showed up meanwhile or
+              a forced refresh happened less than min_refresh_interval ago
+        return True if the keys were fetched
+        raise an AuthError if the circuit breaker is open or the fetch
+        fails
+        '''
+        with self.fetch_lock:
+            if kid is None:
+                if not self.is_expired(max_age):
+                    return False
+            elif kid in self.keys or not self.can_force_refresh():
+                return False
+
+            if not self.breaker.allow():
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch the signing keys.'
+                }, 503)
+
+            self.last_refresh = time.monotonic()
+            try:
+                jwks = self.fetch()
+                self.load(jwks)
+            except Exception:
+                self.failures += 1
+                self.breaker.record_failure()
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch the signing keys.'
+                }, 503)
+
+            self.breaker.record_success()
+            with self.lock:
+                self.fetched_at = self.last_refresh
+                self.refreshes += 1
+
+            if self.snapshot_path:
+                self.save_snapshot(jwks)
+        return True
+
+    def is_expired(self, max_age=None):
+        if max_age is None:
+            max_age = self.ttl
+        return (self.fetched_at is None or
+                time.monotonic() - self.fetched_at >= max_age)
+
+    def can_force_refresh(self):
+        return (self.last_refresh is None or
+                time.monotonic() - self.last_refresh >=
+                self.min_refresh_interval)
+
+    def next_refresh_in(self):
+        '''
+        next_refresh_in()
+        seconds the background thread sleeps before its next refresh:
+        at 80% of the TTL, or when the circuit breaker lets a trial
+        call through
+        '''
+        if self.breaker.state == 'open':
+            return max(1, self.breaker.retry_in())
+        if self.fetched_at is None:
+            return 1
+        age = time.monotonic() - self.fetched_at
+        return max(1, self.ttl * 0.8 - age)
+
+    def run_refresher(self):
+        while True:
+            self.wakeup.wait(self.next_refresh_in())
+            self.wakeup.clear()
+            try:
+                self.refresh(max_age=self.ttl * 0.8)
+            except AuthError:
+                pass
+
+    def start_refresher(self):
+        '''
+        start_refresher()
+        start the background refresh thread, once per process
+        it is started lazily rather than at import so a gunicorn master
+        that imports the app before forking does not own the thread
+        the common case, a running thread, takes no lock at all
+        '''
+        refresher = self.refresher
+        if refresher is not None and refresher.is_alive():
+            return
+        with self.refresher_lock:
+            if self.refresher is not None and self.refresher.is_alive():
+                return
+            self.refresher = threading.Thread(
+                target=self.run_refresher, name='jwks-refresher', daemon=True)
+            self.refresher.start()
+
+    def get_key(self, kid):
+        '''
+        get_key(kid)
+        return the rsa key for a kid, or None if the kid is unknown
+            - with no keys at all, fetch them (the only blocking path)
+            - past the TTL, serve the stale keys and wake up the refresher
+              (without background refresh, refresh them inline and fall
+              back to the stale keys if that fails)
+            - force a refresh for an unknown kid, at most once per
+              min_refresh_interval
+        '''
+        if self.background_refresh:
+            self.start_refresher()
+
+        if not self.keys:
+            self.refresh()
+        elif self.is_expired():
+            self.stale_hits += 1
+            if self.background_refresh:
+                self.wakeup.set()
+            else:
+                try:
+                    self.refresh()
+                except AuthError:
+                    pass
+
+        key = self.keys.get(kid)
+        if key:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        if self.can_force_refresh():
+            try:
+                self.refresh(kid)
+            except AuthError:
+                return None
+            return self.keys.get(kid)
+        return None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'circuit': self.breaker.state,
+            'keys': len(self.keys),
+        }
+
+
+jwks_cache = JWKSCache(JWKS_URL, snapshot_path=JWKS_SNAPSHOT_PATH)
+
+
 # Verify and decode jwt
 #
 # This is provided by Udcaity FSND in reference to a boilerplate
@@ -78,25 +465,14 @@ def get_token_check_auth_header():
 # '''
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -104,7 +480,7 @@ def verify_decode_jwt(token):
                 rsa_key,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer=AUTH_ISSUER
             )
             return payload
 
@@ -131,21 +507,136 @@ def verify_decode_jwt(token):
             }, 400)
 
 
+# Verified token cache
+#
+# Clients reuse the same bearer token for many requests, so the payload of
+# a token that passed verification is kept in a bounded LRU keyed by a
+# hash of the token (the raw token is never stored), together with its
+# permissions compiled into a frozenset. An entry is dropped at the token's
+# own 'exp' claim, so a cached token is never accepted past the point where
+# verify_decode_jwt would reject it as expired. Tokens without an 'exp'
+# claim are never cached.
+
+class TokenCache:
+    '''
+    LRU of verified jwt payloads, keyed by sha256 of the token
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        '''
+        get(token)
+        return the cached (payload, permissions) of a token, or None if
+        the token is not cached or has expired
+        '''
+        key = self.key(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, payload, permissions = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return payload, permissions
+
+    def put(self, token, payload, permissions=None):
+        '''
+        put(token, payload, permissions=None)
+        cache the payload and permissions of a verified token until its
+        'exp' claim
+        '''
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)) or self.maxsize <= 0:
+            return
+
+        key = self.key(token)
+        with self.lock:
+            self.entries[key] = (expires_at, payload, permissions)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+token_cache = TokenCache()
+
+
+def token_permissions(payload):
+    '''
+    Return the permissions claim of a payload as a frozenset, or None if
+    the payload has no permissions claim
+    '''
+    if 'permissions' not in payload:
+        return None
+    return frozenset(payload['permissions'])
+
+
+def verify_decode_jwt_cached(token):
+    '''
+    Return the (payload, permissions) of a token, skipping signature
+    verification for tokens that were verified before and have not
+    expired yet
+    '''
+    entry = token_cache.get(token)
+    if entry is None:
+        payload = verify_decode_jwt(token)
+        entry = payload, token_permissions(payload)
+        token_cache.put(token, *entry)
+    return entry
+
+
 # Check permission
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, permissions=None):
     '''
     check if the permission is cluded in the decoded jwt payload
         raise an AuthError if
         - permission is not included in JWT
         - required permission is not included in the payload permission
+    permissions is the precompiled frozenset of the payload permissions;
+    it is built from the payload when not given
     '''
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
-    if permission not in payload['permissions']:
+    if permissions is None:
+        permissions = token_permissions(payload)
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -153,6 +644,45 @@ def check_permissions(permission, payload):
     return True
 
 
+# Route permission registry
+#
+# requires_auth tags every view it wraps with the permissions it requires.
+# register_route_permissions collects those tags from the app's url map
+# into ROUTE_PERMISSIONS, {(method, rule): frozenset of permissions}, once
+# the routes are defined. Since a token's permissions are a frozenset too,
+# anything derived from them (like allowed_routes) can be cached per
+# permission set, which is shared by every token of the same role.
+
+ROUTE_PERMISSIONS = {}
+
+
+def register_route_permissions(app):
+    '''
+    Rebuild ROUTE_PERMISSIONS from the views of a flask app
+    routes that do not require auth are left out
+    '''
+    ROUTE_PERMISSIONS.clear()
+    for rule in app.url_map.iter_rules():
+        view = app.view_functions[rule.endpoint]
+        required = getattr(view, 'required_permissions', None)
+        if required is None:
+            continue
+        for method in rule.methods - {'HEAD', 'OPTIONS'}:
+            ROUTE_PERMISSIONS[(method, rule.rule)] = required
+    allowed_routes.cache_clear()
+    return ROUTE_PERMISSIONS
+
+
+@lru_cache(maxsize=128)
+def allowed_routes(permissions):
+    '''
+    Return the sorted (method, rule) pairs a permission set gives access to
+    '''
+    return tuple(sorted(
+        route for route, required in ROUTE_PERMISSIONS.items()
+        if required <= permissions))
+
+
 # Auth decorator wrapper
 
 def requires_auth(permission=''):
@@ -161,15 +691,23 @@ def requires_auth(permission=''):
         verifying header
         validate jwt
         check permission
+    permission can also be a tuple of permissions which are all required
     '''
+    if isinstance(permission, str):
+        required = frozenset([permission])
+    else:
+        required = frozenset(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_check_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload, permissions = verify_decode_jwt_cached(token)
+            for required_permission in required:
+                check_permissions(required_permission, payload, permissions)
 
             return f(payload, *args, **kwargs)
 
+        wrapper.required_permissions = required
         return wrapper
     return requires_auth_decorator
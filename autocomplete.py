@@ -0,0 +1,267 @@
+import os
+import time
+import threading
+from bisect import bisect_left, insort
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Actor, Movie, NAME_CHANGES
+from pagination import parse_limit
+from search import SearchError
+
+# Autocomplete
+#
+# GET /autocomplete?q= completes the start of an actor name or movie title
+# as the user types. Rather than a LIKE query per keystroke, every worker
+# keeps the names in memory, in a list sorted by their casefolded text:
+#     [('link', 'actor', 3, 'Link'), ('the legend of zelda', 'movie', ...)]
+# The names starting with q are the run of entries from bisect_left(q) on,
+# so a lookup is a binary search and a slice of the list: microseconds,
+# whatever the size of the catalog.
+#
+# The index is built from the database, in a background thread with a
+# session of its own, when the worker serves its first request; requests
+# never build it themselves. Until the first build is done, a request
+# waits up to AUTOCOMPLETE_WAIT seconds for it, then gets a 503. The names
+# a transaction writes through the models (see NAME_CHANGES in models.py)
+# are applied to it when it commits, one insort or removal each. Other
+# workers, and python manage.py import, write too: once older than
+# AUTOCOMPLETE_MAX_AGE seconds, the index is rebuilt in the background and
+# the previous one is served meanwhile.
+#
+# The app config AUTOCOMPLETE_REBUILD = False turns the background builds
+# off (the tests do, so that no thread queries the database behind them);
+# the index is then only built by calling build_index().
+#
+# Memory is bounded by AUTOCOMPLETE_MAX_ENTRIES: about 280 bytes per name
+# (the entry, the name, its casefolded text and the id lookup), so 55MB
+# with the default. Past it, the names that do not fit are not completed.
+#
+# EXAMPLE
+#   GET /autocomplete?q=the%20leg&limit=2
+#   {"results": [{"id": 1, "title": "The Legend of Zelda", "type":
+#    "movie"}], ...}
+
+AUTOCOMPLETE_MAX_ENTRIES = int(os.environ.get('AUTOCOMPLETE_MAX_ENTRIES',
+                                              200000))
+AUTOCOMPLETE_MAX_AGE = float(os.environ.get('AUTOCOMPLETE_MAX_AGE', 60))
+AUTOCOMPLETE_WAIT = float(os.environ.get('AUTOCOMPLETE_WAIT', 5))
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 100
+
+# completed type -> (model, searched column), the autocompleted column
+AUTOCOMPLETE_TYPES = {
+    'actor': (Actor, Actor.autocompleted),
+    'movie': (Movie, Movie.autocompleted),
+}
+TYPE_OF_TABLE = {model.__tablename__: completed_type
+                 for completed_type, (model, _)
+                 in AUTOCOMPLETE_TYPES.items()}
+
+
+class IndexNotReady(Exception):
+    '''
+    The first build of the index is not done, reported as 503
+    '''
+
+
+class PrefixIndex:
+    '''
+    PrefixIndex(max_entries=AUTOCOMPLETE_MAX_ENTRIES)
+    the names to complete, sorted by their casefolded text
+    lookups read the list without a lock; writes take it
+    '''
+
+    def __init__(self, max_entries=AUTOCOMPLETE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = None
+        # type -> {id: casefolded name}, to find the entry of a row again
+        self.keys = {}
+        self.built_at = None
+        # whether the last build left names out, past max_entries
+        self.truncated = False
+        # the changes applied while a rebuild reads the database, replayed
+        # onto the new index; None when no rebuild is running
+        self.replayed = None
+
+    def lookup(self, prefix, limit):
+        '''
+        lookup(prefix, limit)
+        the (key, type, id, name) of the first limit names starting with
+        prefix, in any case, sorted by name
+        '''
+        entries = self.entries
+        prefix = prefix.casefold()
+        start = bisect_left(entries, (prefix,))
+        found = []
+        for entry in entries[start:start + limit]:
+            if not entry[0].startswith(prefix):
+                break
+            found.append(entry)
+        return found
+
+    def build(self, rows):
+        '''
+        build(rows)
+        index the (type, id, name) rows in place of the current names
+        '''
+        with self.lock:
+            self.replayed = []
+        try:
+            entries = []
+            keys = {}
+            truncated = False
+            for completed_type, id, name in rows:
+                if len(entries) == self.max_entries:
+                    truncated = True
+                    break
+                key = name.casefold()
+                entries.append((key, completed_type, id, name))
+                keys.setdefault(completed_type, {})[id] = key
+            entries.sort()
+        except BaseException:
+            with self.lock:
+                self.replayed = None
+            raise
+
+        with self.lock:
+            changes, self.replayed = self.replayed, None
+            self.entries, self.keys = entries, keys
+            self.truncated = truncated
+            for change in changes:
+                self.change(*change)
+            self.built_at = time.monotonic()
+
+    def apply(self, changes):
+        '''
+        apply(changes)
+        set the name of each (type, id, name) change, None to remove it
+        '''
+        with self.lock:
+            if self.replayed is not None:
+                self.replayed.extend(changes)
+            if self.entries is None:
+                return
+            for change in changes:
+                self.change(*change)
+
+    def change(self, completed_type, id, name):
+        # with the lock held
+        keys = self.keys.setdefault(completed_type, {})
+        key = keys.pop(id, None)
+        if key is not None:
+            position = bisect_left(self.entries, (key, completed_type, id))
+            del self.entries[position]
+        if name is not None and len(self.entries) < self.max_entries:
+            key = name.casefold()
+            insort(self.entries, (key, completed_type, id, name))
+            keys[id] = key
+
+    def stale(self):
+        return (self.built_at is None or
+                time.monotonic() - self.built_at > AUTOCOMPLETE_MAX_AGE)
+
+
+index = PrefixIndex()
+# held by the build of the index running, one at a time
+building = threading.Lock()
+
+
+def names(session):
+    '''
+    the (type, id, name) of every autocompleted row, in id order
+    '''
+    for completed_type, (model, column) in AUTOCOMPLETE_TYPES.items():
+        query = session.query(model.id, getattr(model, column)) \
+            .order_by(model.id).limit(AUTOCOMPLETE_MAX_ENTRIES)
+        for id, name in query.yield_per(10000):
+            yield completed_type, id, name
+
+
+def build_index():
+    '''
+    build the index from the database, in the current app context, with
+    building held
+    the rows are read by a session of its own, so the build leaves the
+    db.session of the thread running it alone
+    '''
+    session = Session(bind=db.engine)
+    try:
+        index.build(names(session))
+    finally:
+        session.close()
+    if index.truncated:
+        current_app.logger.warning(
+            'autocomplete: only the first %d names are indexed',
+            index.max_entries)
+
+
+def rebuild_in_background(app):
+    '''
+    rebuild the index in a thread of its own, unless a build is running
+    or the app config AUTOCOMPLETE_REBUILD is False; lookups keep reading
+    the current index until the new one is swapped in
+    '''
+    if not app.config.get('AUTOCOMPLETE_REBUILD', True):
+        return
+    if not building.acquire(blocking=False):
+        return
+
+    def rebuild():
+        try:
+            with app.app_context():
+                build_index()
+        except Exception:
+            app.logger.exception('autocomplete: building the index failed')
+        finally:
+            building.release()
+
+    threading.Thread(target=rebuild, daemon=True).start()
+
+
+def complete(args):
+    '''
+    complete(args)
+    the (key, type, id, name) of the names starting with the request
+    arg q, up to limit (default AUTOCOMPLETE_LIMIT)
+    raise a SearchError on a missing q, a PaginationError on a malformed
+    limit, an IndexNotReady when the first build of the index is not done
+    after AUTOCOMPLETE_WAIT seconds
+    '''
+    q = args.get('q')
+    if not q or not q.strip():
+        raise SearchError('q is required')
+    limit = parse_limit(args.get('limit', AUTOCOMPLETE_LIMIT),
+                        AUTOCOMPLETE_MAX_LIMIT)
+    app = current_app._get_current_object()
+    if index.entries is None:
+        # start the first build, unless it is running, and wait for it:
+        # building is released when it ends
+        rebuild_in_background(app)
+        if building.acquire(timeout=AUTOCOMPLETE_WAIT):
+            building.release()
+        if index.entries is None:
+            raise IndexNotReady('the autocomplete index is being built')
+    elif index.stale():
+        rebuild_in_background(app)
+    return index.lookup(q.lstrip(), limit)
+
+
+def format_completion(entry):
+    _, completed_type, id, name = entry
+    return {
+        'type': completed_type,
+        'id': id,
+        AUTOCOMPLETE_TYPES[completed_type][1]: name,
+    }
+
+
+@event.listens_for(db.session, 'after_commit')
+def apply_name_changes(session):
+    changes = session.info.pop(NAME_CHANGES, None)
+    if changes:
+        index.apply([(TYPE_OF_TABLE[table], id, name)
+                     for table, id, name in changes])
@@ -0,0 +1,354 @@
+import os
+
+from sqlalchemy import Integer, String, bindparam, select, text
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from dates import parse_date
+from models import (db, Actor, Movie, Role, ActorRecord, MovieRecord,
+                    RoleRecord, any_of, delete_records, name_changed,
+                    transaction)
+
+# Batch creation and deletion
+#
+# POST /actors, /movies and /castings also take a JSON array of objects.
+# The whole array is validated before anything is written (the actors and
+# movies of a batch of roles are looked up with one query per table): if
+# any item is invalid, nothing is inserted and every error is reported with
+# the index of its item. Otherwise the items go in with one multi-row
+# INSERT ... RETURNING on Postgres, and are committed once.
+#
+# DELETE /actors, /movies and /castings take {"ids": [...]} and delete
+# every row found with one DELETE ... WHERE id = ANY(...) RETURNING, in one
+# transaction; the ids that matched nothing are reported as missing_ids.
+#
+# EXAMPLE
+#   POST /actors [{"name": "Link", "age": 117}, {"name": "Amy"}]
+#   400 {"error": 400, "errors": [{"index": 1, "message": "age must be an
+#        integer"}], "message": "bad request", "success": false}
+
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 1000))
+DELETE_MAX_IDS = int(os.environ.get('DELETE_MAX_IDS', 10000))
+
+
+class BatchError(Exception):
+    '''
+    BatchError(errors, message='bad request')
+    a rejected batch, errors lists {'index': i, 'message': ...} for each
+    invalid item
+    '''
+
+    def __init__(self, errors, message='bad request'):
+        super().__init__(message)
+        self.errors = errors
+        self.message = message
+
+
+def required_text(item, name):
+    value = item.get(name)
+    if not value or not isinstance(value, str):
+        raise ValueError(f'{name} is required')
+    return value
+
+
+def required_integer(item, name):
+    value = item.get(name)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(f'{name} must be an integer')
+    return value
+
+
+def movie_date(item):
+    try:
+        return parse_date(item.get('date'))
+    except ValueError:
+        raise ValueError('date must be a date')
+
+
+def validate_actor(item):
+    gender = item.get('gender')
+    if gender is not None and not isinstance(gender, str):
+        raise ValueError('gender must be a string')
+    return {
+        'name': required_text(item, 'name'),
+        'age': required_integer(item, 'age'),
+        'gender': gender,
+    }
+
+
+def validate_movie(item):
+    return {
+        'title': required_text(item, 'title'),
+        'date': movie_date(item),
+    }
+
+
+def validate_role(item):
+    return {
+        'role_name': required_text(item, 'role_name'),
+        'actor_id': required_integer(item, 'actor_id'),
+        'movie_id': required_integer(item, 'movie_id'),
+    }
+
+
+# entity -> (model, item validation, record of the response)
+BATCH_ENTITIES = {
+    'actors': (Actor, validate_actor, ActorRecord),
+    'movies': (Movie, validate_movie, MovieRecord),
+    'roles': (Role, validate_role, RoleRecord),
+}
+
+
+def names_by_id(column, ids):
+    '''
+    {id: name} of the rows of column's table whose id is in ids
+    '''
+    model = column.class_
+    return dict(db.session.query(model.id, column)
+                .filter(any_of(model.id, ids)))
+
+
+def insert_rows(model, columns, rows):
+    '''
+    insert_rows(model, columns, rows)
+    insert rows (dicts of column values) and return the given columns of
+    the inserted rows, in order
+    one multi-row INSERT ... RETURNING on Postgres, one INSERT per row
+    elsewhere
+    '''
+    table = model.__table__
+    if db.engine.name == 'postgresql':
+        returned = db.session.execute(table.insert().values(rows).returning(
+            *[table.c[column] for column in columns])).fetchall()
+        # the ids come from the sequence in VALUES order
+        return sorted(returned, key=lambda row: row[0])
+
+    # read each row back, for the columns the database generates
+    inserted = []
+    for row in rows:
+        result = db.session.execute(table.insert().values(**row))
+        inserted.append(db.session.execute(
+            select([table.c[column] for column in columns])
+            .where(table.c.id == result.inserted_primary_key[0])).first())
+    return inserted
+
+
+def create_batch(entity, items):
+    '''
+    create_batch(entity, items)
+    validate a list of actors, movies or roles and insert them, in one
+    transaction
+    return the formatted new rows
+    raise a BatchError listing every invalid item, before anything is
+    inserted
+    '''
+    model, validate, record = BATCH_ENTITIES[entity]
+    if not items:
+        raise BatchError([], 'the batch is empty')
+    if len(items) > BATCH_MAX_SIZE:
+        raise BatchError([], f'a batch holds at most {BATCH_MAX_SIZE} items')
+
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('an item must be an object')
+            rows.append(validate(item))
+        except ValueError as e:
+            errors.append({'index': index, 'message': str(e)})
+
+    if errors:
+        raise BatchError(errors)
+
+    with transaction():
+        if entity != 'roles':
+            inserted = insert_rows(model, record._fields, rows)
+            for row in inserted:
+                name_changed(model, row)
+            return [record._make(row).format() for row in inserted]
+
+        actors = names_by_id(Actor.name, {row['actor_id'] for row in rows})
+        movies = names_by_id(Movie.title, {row['movie_id'] for row in rows})
+        errors = []
+        for index, row in enumerate(rows):
+            if row['actor_id'] not in actors:
+                errors.append({'index': index, 'message':
+                               f'actor {row["actor_id"]} does not exist'})
+            if row['movie_id'] not in movies:
+                errors.append({'index': index, 'message':
+                               f'movie {row["movie_id"]} does not exist'})
+        if errors:
+            raise BatchError(errors)
+
+        inserted = insert_rows(model, ('id', 'role_name', 'actor_id',
+                                       'movie_id'), rows)
+        return [record(id, role_name, actor_id, actors[actor_id],
+                       movie_id, movies[movie_id]).format()
+                for id, role_name, actor_id, movie_id in inserted]
+
+
+def delete_batch(entity, ids):
+    '''
+    delete_batch(entity, ids)
+    delete the actors, movies or roles with these ids, in one transaction
+    return the formatted deleted rows and the sorted ids that matched none
+    raise a BatchError listing the ids that are not integers, before
+    anything is deleted
+    '''
+    model, _, record = BATCH_ENTITIES[entity]
+    if not isinstance(ids, list) or not ids:
+        raise BatchError([], 'ids must be a list of ids')
+    if len(ids) > DELETE_MAX_IDS:
+        raise BatchError([], f'at most {DELETE_MAX_IDS} ids can be deleted')
+    errors = [{'index': index, 'message': 'an id must be an integer'}
+              for index, id in enumerate(ids)
+              if not isinstance(id, int) or isinstance(id, bool)]
+    if errors:
+        raise BatchError(errors)
+
+    with transaction():
+        deleted = delete_records(record, model, set(ids))
+    missing_ids = sorted(set(ids) - {row.id for row in deleted})
+    return [row.format() for row in deleted], missing_ids
+
+
+# Re-casting
+#
+# PUT /movies/<id>/castings takes the whole cast of a movie as a list of
+# {"actor_id", "role_name"} and turns the current roles into it:
+# - a role already there (same actor and name) is kept, with its id
+# - a role of an actor who no longer has it is renamed if that actor gets
+#   a new role, deleted otherwise
+# - the other new roles are inserted
+# The movie row is locked first, so two re-casts of a movie run one after
+# the other. Then at most one DELETE, one UPDATE and one INSERT (each
+# set-based) apply the diff, in one transaction.
+
+
+def validate_cast_item(item):
+    return {
+        'role_name': required_text(item, 'role_name'),
+        'actor_id': required_integer(item, 'actor_id'),
+    }
+
+
+def diff_cast(current, desired):
+    '''
+    diff_cast(current, desired)
+    current: (id, role_name, actor_id) of the roles, by id
+    desired: {'role_name', 'actor_id'} of the wanted roles
+    return (kept, updates, inserts, deletes): (id, row) pairs of kept and
+    renamed roles, rows to insert and ids to delete
+    '''
+    unmatched = {}
+    for id, role_name, actor_id in current:
+        unmatched.setdefault((actor_id, role_name), []).append(id)
+
+    kept = []
+    new = []
+    for row in desired:
+        ids = unmatched.get((row['actor_id'], row['role_name']))
+        if ids:
+            kept.append((ids.pop(0), row))
+        else:
+            new.append(row)
+
+    by_actor = {}
+    for (actor_id, _), ids in unmatched.items():
+        by_actor.setdefault(actor_id, []).extend(ids)
+    updates = []
+    inserts = []
+    for row in new:
+        ids = by_actor.get(row['actor_id'])
+        if ids:
+            updates.append((ids.pop(0), row))
+        else:
+            inserts.append(row)
+    deletes = sorted(id for ids in by_actor.values() for id in ids)
+    return kept, updates, inserts, deletes
+
+
+def rename_roles(updates):
+    '''
+    set the role_name of (id, row) pairs
+    one UPDATE ... FROM unnest(:ids, :names) on Postgres
+    '''
+    if db.engine.name == 'postgresql':
+        db.session.execute(
+            text('UPDATE "Role" SET role_name = v.role_name '
+                 'FROM unnest(:ids, :names) AS v(id, role_name) '
+                 'WHERE "Role".id = v.id')
+            .bindparams(bindparam('ids', type_=ARRAY(Integer)),
+                        bindparam('names', type_=ARRAY(String))),
+            {'ids': [id for id, _ in updates],
+             'names': [row['role_name'] for _, row in updates]})
+        return
+
+    table = Role.__table__
+    db.session.execute(
+        table.update().where(table.c.id == bindparam('role_id'))
+        .values(role_name=bindparam('new_role_name')),
+        [{'role_id': id, 'new_role_name': row['role_name']}
+         for id, row in updates])
+
+
+def replace_cast(movie_id, items):
+    '''
+    replace_cast(movie_id, items)
+    make the roles of a movie the given list, in one transaction
+    return the formatted roles of the movie and the number of roles
+    inserted, updated and deleted, or None when there is no such movie
+    raise a BatchError listing every invalid item, before anything is
+    written
+    '''
+    if not isinstance(items, list):
+        raise BatchError([], 'the cast must be a list of roles')
+    if len(items) > BATCH_MAX_SIZE:
+        raise BatchError([], f'a cast holds at most {BATCH_MAX_SIZE} roles')
+
+    desired = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('an item must be an object')
+            desired.append(validate_cast_item(item))
+        except ValueError as e:
+            errors.append({'index': index, 'message': str(e)})
+    if errors:
+        raise BatchError(errors)
+
+    with transaction():
+        title = db.session.query(Movie.title) \
+            .filter(Movie.id == movie_id).with_for_update().scalar()
+        if title is None:
+            return None
+
+        actors = names_by_id(Actor.name, {row['actor_id'] for row in desired})
+        errors = [{'index': index,
+                   'message': f'actor {row["actor_id"]} does not exist'}
+                  for index, row in enumerate(desired)
+                  if row['actor_id'] not in actors]
+        if errors:
+            raise BatchError(errors)
+
+        current = db.session.query(Role.id, Role.role_name, Role.actor_id) \
+            .filter(Role.movie_id == movie_id).order_by(Role.id).all()
+        kept, updates, inserts, deletes = diff_cast(current, desired)
+
+        if deletes:
+            db.session.execute(Role.__table__.delete()
+                               .where(any_of(Role.id, deletes)))
+        if updates:
+            rename_roles(updates)
+        inserted = []
+        if inserts:
+            inserted = insert_rows(Role, ('id', 'role_name', 'actor_id'), [
+                dict(row, movie_id=movie_id) for row in inserts])
+
+    roles = sorted([(id, row['role_name'], row['actor_id'])
+                    for id, row in kept + updates] + list(inserted))
+    formatted = [RoleRecord(id, role_name, actor_id, actors[actor_id],
+                            movie_id, title).format()
+                 for id, role_name, actor_id in roles]
+    return formatted, len(inserts), len(updates), len(deletes)
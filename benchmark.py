@@ -0,0 +1,366 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import tracemalloc
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+# Endpoint benchmarks
+#
+# Seeds a scratch database with a large catalog and times the API through
+# the Flask test client, so the numbers include routing, the ORM and JSON
+# serialization but not the network. Tokens are minted locally, so it runs
+# with AUTH_MODE=local (see README, Offline mode).
+#
+# It creates, fills and alters tables: never point DATABASE_URL at a
+# database you care about.
+#
+# EXAMPLE
+#   AUTH_MODE=local DATABASE_URL=postgresql://localhost/casting_bench \
+#       python benchmark.py indexes --roles 1000000
+#   python benchmark.py projection
+#   python benchmark.py search
+#   python benchmark.py autocomplete
+#   python benchmark.py stream
+
+os.environ.setdefault('AUTH_MODE', 'local')
+
+import autocomplete  # noqa: E402
+import local_auth  # noqa: E402
+from app import app  # noqa: E402
+from models import (db, Actor, Movie, Role, ActorRecord,  # noqa: E402
+                    MovieRecord, RoleRecord)
+
+# Role foreign key indexes added by migration e41c7a0b9f52
+ROLE_FK_INDEXES = [
+    ('ix_Role_actor_id', ['actor_id']),
+    ('ix_Role_movie_id_actor_id', ['movie_id', 'actor_id']),
+]
+
+
+def seed(roles):
+    '''
+    Fill empty tables with the given number of roles, spread over
+    roles / 50 actors and roles / 20 movies, so a detail page has 20 to
+    50 credits
+    '''
+    actors = max(1, roles // 50)
+    movies = max(1, roles // 20)
+    if db.engine.name == 'postgresql':
+        db.session.execute(
+            'INSERT INTO "Actor" (name, age, gender) '
+            "SELECT 'Actor ' || i, 18 + i % 60, 'Female' "
+            'FROM generate_series(1, :n) AS i', {'n': actors})
+        db.session.execute(
+            'INSERT INTO "Movie" (title, date) '
+            "SELECT 'Movie ' || i, "
+            "timestamp '1950-01-01' + (i % 25000) * interval '1 day' "
+            'FROM generate_series(1, :n) AS i', {'n': movies})
+        db.session.execute(
+            'INSERT INTO "Role" (role_name, actor_id, movie_id) '
+            "SELECT 'Role ' || i, 1 + (i::bigint * 7919) % :actors, "
+            '1 + (i::bigint * 104729) % :movies '
+            'FROM generate_series(1, :n) AS i',
+            {'n': roles, 'actors': actors, 'movies': movies})
+        db.session.commit()
+        db.session.execute('ANALYZE')
+        return
+
+    from datetime import datetime, timedelta
+    start = datetime(1950, 1, 1)
+    batch = 10000
+    for table, count, row in [
+        (Actor.__table__, actors, lambda i: {
+            'name': f'Actor {i}', 'age': 18 + i % 60, 'gender': 'Female'}),
+        (Movie.__table__, movies, lambda i: {
+            'title': f'Movie {i}',
+            'date': start + timedelta(days=i % 25000)}),
+        (Role.__table__, roles, lambda i: {
+            'role_name': f'Role {i}',
+            'actor_id': 1 + (i * 7919) % actors,
+            'movie_id': 1 + (i * 104729) % movies}),
+    ]:
+        for first in range(1, count + 1, batch):
+            db.session.execute(table.insert(), [
+                row(i) for i in range(first, min(first + batch, count + 1))])
+        db.session.commit()
+
+
+def prepare(roles):
+    '''
+    Create the tables and seed them unless they hold that many roles
+    already
+    '''
+    db.create_all()
+    if Role.query.count() == roles:
+        return
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    started = time.perf_counter()
+    seed(roles)
+    print(f'seeded {roles} roles in {time.perf_counter() - started:.1f}s')
+
+
+def time_requests(client, headers, urls, repeat):
+    '''
+    Return the median latency in milliseconds of GET url, cycling through
+    urls repeat times
+    '''
+    timings = []
+    for i in range(repeat):
+        url = urls[i % len(urls)]
+        started = time.perf_counter()
+        res = client.get(url, headers=headers)
+        timings.append((time.perf_counter() - started) * 1000)
+        if res.status_code != 200:
+            sys.exit(f'GET {url}: {res.status_code}')
+    return statistics.median(timings)
+
+
+def set_role_fk_indexes(present):
+    table = Role.__table__
+    for name, columns in ROLE_FK_INDEXES:
+        db.session.execute(f'DROP INDEX IF EXISTS "{name}"')
+        if present:
+            db.session.execute('CREATE INDEX "{}" ON "{}" ({})'.format(
+                name, table.name, ', '.join(columns)))
+    db.session.commit()
+    if db.engine.name == 'postgresql':
+        db.session.execute('ANALYZE "Role"')
+        db.session.commit()
+
+
+def bench_indexes(roles, repeat):
+    '''
+    Detail and list endpoint latency without and with the Role foreign
+    key indexes
+    '''
+    prepare(roles)
+    headers = {
+        'Authorization': 'Bearer ' + local_auth.mint_token('producer'),
+    }
+    client = app.test_client()
+
+    actor_count = db.session.query(func.count(Actor.id)).scalar()
+    movie_count = db.session.query(func.count(Movie.id)).scalar()
+    step_actors = max(1, actor_count // repeat)
+    step_movies = max(1, movie_count // repeat)
+    endpoints = [
+        ('GET /actors/<id>', [f'/actors/{i}' for i in
+                              range(1, actor_count + 1, step_actors)]),
+        ('GET /movies/<id>', [f'/movies/{i}' for i in
+                              range(1, movie_count + 1, step_movies)]),
+        ('GET /castings', ['/castings?limit=100']),
+    ]
+    db.session.remove()
+
+    print(f'{"endpoint":<20}{"no index":>12}{"indexed":>12}')
+    results = {}
+    for present in (False, True):
+        set_role_fk_indexes(present)
+        db.session.remove()
+        for label, urls in endpoints:
+            # warm the caches before timing
+            time_requests(client, headers, urls, min(repeat, 5))
+            results[label, present] = time_requests(
+                client, headers, urls, repeat)
+    for label, _ in endpoints:
+        print(f'{label:<20}{results[label, False]:>10.2f}ms'
+              f'{results[label, True]:>10.2f}ms')
+
+
+def measure(read, repeat):
+    '''
+    Return the median milliseconds and the peak traced KiB of read()
+    '''
+    timings = []
+    for _ in range(repeat):
+        db.session.remove()
+        started = time.perf_counter()
+        read()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    db.session.remove()
+    tracemalloc.start()
+    read()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(timings), peak / 1024
+
+
+def bench_projection(roles, repeat, rows=1000):
+    '''
+    ORM instances against column projections for a list page of rows rows
+    (the largest page), from the query to the formatted dicts
+    '''
+    prepare(roles)
+    paths = [
+        ('actors',
+         lambda: [actor.format() for actor in
+                  Actor.query.order_by(Actor.id).limit(rows)],
+         lambda: [ActorRecord._make(row).format() for row in
+                  ActorRecord.query().order_by(Actor.id).limit(rows)]),
+        ('movies',
+         lambda: [movie.format() for movie in
+                  Movie.query.order_by(Movie.id).limit(rows)],
+         lambda: [MovieRecord._make(row).format() for row in
+                  MovieRecord.query().order_by(Movie.id).limit(rows)]),
+        ('roles',
+         lambda: [role.format() for role in
+                  Role.query.options(joinedload(Role.actor),
+                                     joinedload(Role.movie))
+                  .order_by(Role.id).limit(rows)],
+         lambda: [RoleRecord._make(row).format() for row in
+                  RoleRecord.query().order_by(Role.id).limit(rows)]),
+    ]
+
+    print(f'{f"{rows} rows":<10}{"orm":>23}{"projection":>23}')
+    for label, orm, projection in paths:
+        orm_ms, orm_kib = measure(orm, repeat)
+        projection_ms, projection_kib = measure(projection, repeat)
+        print(f'{label:<10}'
+              f'{orm_ms:>10.2f}ms{orm_kib:>8.0f}KiB'
+              f'{projection_ms:>10.2f}ms{projection_kib:>8.0f}KiB')
+
+
+def bench_stream(roles, repeat):
+    '''
+    Time to first byte, total time and peak traced memory of streaming
+    GET /castings?stream=1 for growing numbers of roles
+    '''
+    prepare(roles)
+    headers = {
+        'Authorization': 'Bearer ' + local_auth.mint_token('producer'),
+    }
+    client = app.test_client()
+    db.session.remove()
+
+    print(f'{"roles":>10}{"first byte":>14}{"total":>12}{"peak":>12}')
+    limit = 1000
+    while limit <= roles:
+        tracemalloc.start()
+        started = time.perf_counter()
+        res = client.get(f'/castings?stream=1&limit={limit}',
+                         headers=headers, buffered=False)
+        if res.status_code != 200:
+            sys.exit(f'GET /castings?stream=1: {res.status_code}')
+        size = 0
+        first_byte = None
+        for chunk in res.response:
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            size += len(chunk)
+        total = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        res.close()
+        print(f'{limit:>10}{first_byte * 1000:>12.1f}ms{total:>11.2f}s'
+              f'{peak / 1024 / 1024:>9.1f}MiB')
+        limit *= 10
+
+
+def bench_search(roles, repeat):
+    '''
+    GET /search latency for words found in a few rows, and for a word
+    found in every role (each match is ranked before the first page)
+    '''
+    prepare(roles)
+    if db.engine.name == 'postgresql':
+        # merge the GIN pending lists the seed filled into the indexes, as
+        # autovacuum does in production, or every search scans them
+        db.session.remove()
+        with db.engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT') as connection:
+            connection.execute('VACUUM ANALYZE')
+    headers = {
+        'Authorization': 'Bearer ' + local_auth.mint_token('producer'),
+    }
+    client = app.test_client()
+
+    actor_count = db.session.query(func.count(Actor.id)).scalar()
+    step = max(1, actor_count // repeat)
+    endpoints = [
+        ('actor name', [f'/search?q=actor+{i}' for i in
+                        range(1, actor_count + 1, step)]),
+        ('number', [f'/search?q={i}' for i in
+                    range(1, actor_count + 1, step)]),
+        ('every role', ['/search?q=role&limit=100']),
+    ]
+    db.session.remove()
+
+    print(f'{"GET /search?q=":<20}{"median":>12}')
+    for label, urls in endpoints:
+        # warm the caches before timing
+        time_requests(client, headers, urls, min(repeat, 5))
+        print(f'{label:<20}'
+              f'{time_requests(client, headers, urls, repeat):>10.2f}ms')
+
+
+def bench_autocomplete(roles, repeat):
+    '''
+    Build time and memory of the autocomplete index, then the latency of
+    a lookup in it and of GET /autocomplete
+    '''
+    prepare(roles)
+    headers = {
+        'Authorization': 'Bearer ' + local_auth.mint_token('producer'),
+    }
+    client = app.test_client()
+    # the index timed is the one built here, not a background rebuild
+    app.config['AUTOCOMPLETE_REBUILD'] = False
+    prefixes = [f'actor {i}' for i in range(1, 100)] + \
+        [f'movie {i}' for i in range(1, 100)]
+
+    started = time.perf_counter()
+    with autocomplete.building:
+        autocomplete.build_index()
+    built = time.perf_counter() - started
+    # build again to measure the index it holds (tracemalloc slows it down)
+    tracemalloc.start()
+    with autocomplete.building:
+        autocomplete.build_index()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'{len(autocomplete.index.entries)} names indexed in '
+          f'{built * 1000:.0f}ms, {memory / 1024 / 1024:.1f}MiB')
+
+    timings = []
+    for i in range(repeat * 100):
+        prefix = prefixes[i % len(prefixes)]
+        started = time.perf_counter()
+        autocomplete.index.lookup(prefix, 10)
+        timings.append((time.perf_counter() - started) * 1000000)
+    print(f'lookup{statistics.median(timings):>13.1f}us')
+
+    urls = [f'/autocomplete?q={prefix}' for prefix in prefixes]
+    time_requests(client, headers, urls, min(repeat, 5))
+    print(f'GET /autocomplete'
+          f'{time_requests(client, headers, urls, repeat):>8.2f}ms')
+
+
+BENCHMARKS = {
+    'autocomplete': bench_autocomplete,
+    'indexes': bench_indexes,
+    'projection': bench_projection,
+    'search': bench_search,
+    'stream': bench_stream,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the API')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--roles', type=int, default=1000000,
+                        help='number of roles to seed (default 1000000)')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='requests timed per endpoint (default 50)')
+    args = parser.parse_args()
+
+    if not os.path.exists(local_auth.LOCAL_PRIVATE_KEY_PATH):
+        local_auth.generate_keys()
+    with app.app_context():
+        BENCHMARKS[args.benchmark](args.roles, args.repeat)
@@ -0,0 +1,71 @@
+import os
+import re
+from datetime import datetime
+from functools import lru_cache
+
+# Movie release dates
+#
+# add_movie, edit_movie and the batch endpoints accept a date in any of
+# the formats below. Rather than trying each format with strptime in turn
+# (a raised ValueError per miss), the shape of the string picks the one or
+# two formats it can be in, and only those are tried. The shapes accept
+# everything strptime would for their formats: one or more spaces where a
+# format has one, one or two digit days and months.
+#
+# Parsed dates are cached: a batch of movies usually repeats its dates.
+#
+# EXAMPLE
+#   parse_date('Mar 3, 2011')   # datetime(2011, 3, 3, 0, 0)
+#   parse_date('03-03-11')      # datetime(2003, 3, 11, 0, 0): %y-%m-%d
+#   parse_date('sometime')      # ValueError
+
+DATE_CACHE_SIZE = int(os.environ.get('DATE_CACHE_SIZE', 4096))
+
+# The formats are the ones provided by dawg on
+# https://stackoverflow.com/questions/25341945/check-if-string-has-date-any-format
+# (shape, formats tried in order)
+DATE_SHAPES = [(re.compile(shape), formats) for shape, formats in [
+    (r'\d{4}', ('%Y',)),
+    (r'[A-Za-z]+\s+\d{1,2},\s+\d{4}', ('%b %d, %Y', '%B %d, %Y')),
+    (r'[A-Za-z]+\s+\d{1,2},\d{4}', ('%b %d,%Y',)),
+    (r'[A-Za-z]+\s+\d{1,2}\s+\d{4}', ('%B %d %Y',)),
+    (r'[A-Za-z]+\s+\d{4}', ('%b %Y',)),
+    (r'[A-Za-z]+\d{4}', ('%B%Y',)),
+    (r'\d{1,2}/\d{1,2}/\d{4}', ('%m/%d/%Y',)),
+    (r'\d{1,2}/\d{1,2}/\d{2}', ('%m/%d/%y',)),
+    (r'\d{4}-\d{1,2}-\d{1,2}', ('%Y-%m-%d',)),
+    (r'\d{1,2}-\d{1,2}-\d{4}', ('%m-%d-%Y',)),
+    (r'\d{1,2}-\d{1,2}-\d{1,2}', ('%y-%m-%d', '%m-%d-%y')),
+]]
+
+
+def date_formats(value):
+    '''
+    date_formats(value)
+    the formats a string of this shape can be in, () if none
+    '''
+    for shape, formats in DATE_SHAPES:
+        if shape.fullmatch(value):
+            return formats
+    return ()
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date_string(value):
+    for fmt in date_formats(value):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f'{value!r} is not a date')
+
+
+def parse_date(value):
+    '''
+    parse_date(value)
+    return the datetime a release date string stands for
+    raise a ValueError when it is not a string in one of the formats
+    '''
+    if not isinstance(value, str):
+        raise ValueError('a date must be a string')
+    return parse_date_string(value)
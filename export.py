@@ -0,0 +1,135 @@
+import io
+import os
+import csv
+import json
+import time
+from datetime import datetime
+
+from models import db, Actor, Movie, Role
+
+# Bulk export
+#
+# Dumps actors, movies and roles for the reporting jobs, as NDJSON (one
+# object per line, with a "type" member) or as CSV (one entity per file).
+# All the tables are read in one REPEATABLE READ, READ ONLY transaction on
+# Postgres, so roles never point to an actor created after the actors were
+# read. Each table is read through a server-side cursor (yield_per) and
+# written out chunk by chunk: the export never holds a table in memory.
+#
+# EXAMPLE
+#   export = Export()
+#   export.begin()
+#   for chunk in export.ndjson():
+#       out.write(chunk)
+#   export.rows, export.rate()    # 1050000, 181234.5
+
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 2000))
+
+# entity -> (type of its NDJSON objects, model, exported columns)
+EXPORT_ENTITIES = {
+    'actors': ('actor', Actor, ['id', 'name', 'age', 'gender']),
+    'movies': ('movie', Movie, ['id', 'title', 'date']),
+    'roles': ('role', Role, ['id', 'role_name', 'actor_id', 'movie_id']),
+}
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class Export:
+    '''
+    Export(entities=all, chunk_size=EXPORT_CHUNK_SIZE)
+    one export of some of EXPORT_ENTITIES, read from a single snapshot
+    begin() must be called before the session runs any other statement
+    '''
+
+    def __init__(self, entities=tuple(EXPORT_ENTITIES),
+                 chunk_size=EXPORT_CHUNK_SIZE):
+        for entity in entities:
+            if entity not in EXPORT_ENTITIES:
+                raise ValueError(f'cannot export {entity!r}')
+        self.entities = entities
+        self.chunk_size = chunk_size
+        self.rows = 0
+        self.started = None
+
+    def begin(self):
+        '''
+        begin()
+        start the snapshot transaction the export reads from
+        '''
+        if db.engine.name == 'postgresql':
+            db.session.execute('SET TRANSACTION ISOLATION LEVEL '
+                               'REPEATABLE READ, READ ONLY')
+        self.started = time.perf_counter()
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def rate(self):
+        '''
+        rate()
+        rows exported per second so far
+        '''
+        elapsed = self.elapsed()
+        return self.rows / elapsed if elapsed else 0.0
+
+    def chunks(self, entity):
+        '''
+        chunks(entity)
+        yield the rows of an entity in id order, chunk_size rows at a time
+        '''
+        _, model, columns = EXPORT_ENTITIES[entity]
+        query = db.session \
+            .query(*[getattr(model, name) for name in columns]) \
+            .order_by(model.id).yield_per(self.chunk_size)
+        chunk = []
+        for row in query:
+            chunk.append(row)
+            if len(chunk) == self.chunk_size:
+                self.rows += len(chunk)
+                yield chunk
+                chunk = []
+        if chunk:
+            self.rows += len(chunk)
+            yield chunk
+
+    def ndjson(self):
+        '''
+        ndjson()
+        yield the entities as NDJSON text, one chunk of lines at a time
+            {"type":"actor","id":1,"name":"Link","age":117,"gender":"Male"}
+        '''
+        encode = json.JSONEncoder(separators=(',', ':'),
+                                  default=export_value).encode
+        for entity in self.entities:
+            type_, _, columns = EXPORT_ENTITIES[entity]
+            for chunk in self.chunks(entity):
+                yield ''.join(
+                    encode({'type': type_, **dict(zip(columns, row))}) + '\n'
+                    for row in chunk)
+
+    def csv(self, entity):
+        '''
+        csv(entity)
+        yield one entity as CSV text with a header line, one chunk of
+        lines at a time
+        '''
+        _, _, columns = EXPORT_ENTITIES[entity]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for chunk in self.chunks(entity):
+            writer.writerows([export_value(value) for value in row]
+                             for row in chunk)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            # the header of an empty table
+            yield buffer.getvalue()
@@ -0,0 +1,81 @@
+from sqlalchemy import and_
+
+from models import db, Actor, Movie, Role
+
+# List filters
+#
+# Query parameters of the list endpoints that narrow the rows down. Each
+# one is compiled to a condition on an indexed column and added to the
+# WHERE clause of the page (or stream) query, so the database does the
+# filtering and the pagination still seeks through an index.
+#
+# EXAMPLE
+#   GET /movies?year_from=2015&year_to=2020&sort=release_year
+#   WHERE "Movie".release_year >= 2015 AND "Movie".release_year <= 2020
+#   GET /actors?gender=Female&age_min=20&age_max=30&name_prefix=Am
+#   WHERE "Actor".name LIKE 'Am%' AND "Actor".age >= 20 AND ...
+
+
+class FilterError(Exception):
+    '''
+    A malformed filter parameter, reported as 400
+    '''
+
+
+def integer_param(value, name):
+    try:
+        return int(value)
+    except ValueError:
+        raise FilterError(f'{name} must be an integer')
+
+
+def text_param(value, name):
+    if not value:
+        raise FilterError(f'{name} must not be empty')
+    return value
+
+
+def name_prefix(prefix):
+    '''
+    the actors whose name starts with prefix, case sensitive
+    on Postgres a LIKE 'prefix%', served by the text_pattern_ops index
+    whatever the collation; elsewhere the range of names between prefix
+    and the next string of its length, served by the name index
+    '''
+    if db.engine.name == 'postgresql':
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%') \
+            .replace('_', '\\_')
+        return Actor.name.like(escaped + '%', escape='\\')
+    following = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return and_(Actor.name >= prefix, Actor.name < following)
+
+
+# parameter -> (parse, condition)
+ACTOR_FILTERS = {
+    'age_min': (integer_param, lambda age: Actor.age >= age),
+    'age_max': (integer_param, lambda age: Actor.age <= age),
+    'gender': (text_param, lambda gender: Actor.gender == gender),
+    'name_prefix': (text_param, name_prefix),
+}
+
+ROLE_FILTERS = {
+    'actor_id': (integer_param, lambda id: Role.actor_id == id),
+    'movie_id': (integer_param, lambda id: Role.movie_id == id),
+}
+
+MOVIE_FILTERS = {
+    'year_from': (integer_param, lambda year: Movie.release_year >= year),
+    'year_to': (integer_param, lambda year: Movie.release_year <= year),
+}
+
+
+def apply_filters(query, filters, args):
+    '''
+    apply_filters(query, filters, args)
+    add the condition of every filter given in args to query
+    raise a FilterError on a malformed value
+    '''
+    for name, (parse, condition) in filters.items():
+        if name in args:
+            query = query.filter(condition(parse(args[name], name)))
+    return query
@@ -0,0 +1,320 @@
+import io
+import os
+import csv
+import json
+import time
+from datetime import datetime
+
+from sqlalchemy import func
+
+from models import db, Actor, Movie, Role, any_of
+
+# Bulk import
+#
+# Loads actors, movies and roles from CSV files (with a header line) or JSON
+# lines files, one file per entity or a single file whose lines have a
+# "type" member, such as the NDJSON export. Rows are validated, then
+# written IMPORT_BATCH_SIZE at a time: with Postgres COPY, elsewhere with
+# one executemany INSERT. The import runs in one transaction(), so a
+# failed import leaves the database as it was.
+#
+# Rows keep the id they are given (the sequences are moved past them) or
+# get a new one. A role names its actor by actor_id or actor_name and its
+# movie by movie_id or movie_title; the references of a batch are resolved
+# with one query per table, a name resolving to the lowest id holding it.
+# Rows that fail validation or reference a missing actor or movie are
+# skipped and reported.
+#
+# EXAMPLE
+#   importer = Importer()
+#   with transaction():
+#       importer.load(read_records('actors.csv'), 'actors')
+#       importer.load(read_records('casting.ndjson'))
+#       importer.finish()
+
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 10000))
+
+
+def read_records(path):
+    '''
+    read_records(path)
+    yield (line number, record) for the rows of a CSV file (.csv) or the
+    lines of a JSON lines file (any other extension)
+    a line that is not a JSON object is yielded as None
+    '''
+    if path.endswith('.csv'):
+        with open(path, newline='') as f:
+            for number, record in enumerate(csv.DictReader(f), 2):
+                yield number, record
+        return
+
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield number, record if isinstance(record, dict) else None
+
+
+def text(record, name, required=True):
+    value = record.get(name)
+    if value is None or value == '':
+        if required:
+            raise ValueError(f'{name} is required')
+        return None
+    if not isinstance(value, str):
+        raise ValueError(f'{name} must be a string')
+    return value
+
+
+def integer(record, name, required=True):
+    value = record.get(name)
+    if value is None or value == '':
+        if required:
+            raise ValueError(f'{name} is required')
+        return None
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    elif isinstance(value, int) and not isinstance(value, bool):
+        return value
+    raise ValueError(f'{name} must be an integer')
+
+
+def timestamp(record, name):
+    try:
+        return datetime.fromisoformat(text(record, name))
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be an ISO 8601 date')
+
+
+def clean_actor(record):
+    return {
+        'id': integer(record, 'id', required=False),
+        'name': text(record, 'name'),
+        'age': integer(record, 'age'),
+        'gender': text(record, 'gender', required=False) or '',
+    }
+
+
+def clean_movie(record):
+    return {
+        'id': integer(record, 'id', required=False),
+        'title': text(record, 'title'),
+        'date': timestamp(record, 'date'),
+    }
+
+
+def clean_role(record):
+    role = {
+        'id': integer(record, 'id', required=False),
+        'role_name': text(record, 'role_name'),
+        'actor_id': integer(record, 'actor_id', required=False),
+        'actor_name': text(record, 'actor_name', required=False),
+        'movie_id': integer(record, 'movie_id', required=False),
+        'movie_title': text(record, 'movie_title', required=False),
+    }
+    if role['actor_id'] is None and role['actor_name'] is None:
+        raise ValueError('actor_id or actor_name is required')
+    if role['movie_id'] is None and role['movie_title'] is None:
+        raise ValueError('movie_id or movie_title is required')
+    return role
+
+
+# entity -> (model, record validation, inserted columns)
+IMPORT_ENTITIES = {
+    'actors': (Actor, clean_actor, ['name', 'age', 'gender']),
+    'movies': (Movie, clean_movie, ['title', 'date']),
+    'roles': (Role, clean_role, ['role_name', 'actor_id', 'movie_id']),
+}
+
+# "type" member of a JSON line -> entity
+IMPORT_TYPES = {'actor': 'actors', 'movie': 'movies', 'role': 'roles'}
+
+# role references: (id key, name key, model, name column)
+ROLE_REFERENCES = [
+    ('actor_id', 'actor_name', Actor, Actor.name),
+    ('movie_id', 'movie_title', Movie, Movie.title),
+]
+
+
+def resolve(model, column, values):
+    '''
+    resolve(model, column, values)
+    return {value: id} for the values found in column, with one query
+    '''
+    if not values:
+        return {}
+    return dict(db.session.query(column, func.min(model.id))
+                .filter(any_of(column, values)).group_by(column))
+
+
+def copy_value(value):
+    '''
+    a value in the text format of COPY
+    '''
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t') \
+            .replace('\n', '\\n').replace('\r', '\\r')
+    return str(value)
+
+
+class Importer:
+    '''
+    Importer(batch_size=IMPORT_BATCH_SIZE, progress=None)
+    one import, to run in a transaction() ended by finish()
+    progress(entity, rows, rate) is called after each batch
+    '''
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, progress=None):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.rows = {entity: 0 for entity in IMPORT_ENTITIES}
+        self.batches = {entity: [] for entity in IMPORT_ENTITIES}
+        self.errors = []
+        self.explicit_ids = set()
+        self.unanalyzed = set()
+        self.started = time.perf_counter()
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return sum(self.rows.values()) / elapsed if elapsed else 0.0
+
+    def load(self, records, entity=None, source=''):
+        '''
+        load(records, entity=None, source='')
+        validate (line number, record) pairs and insert them by batches
+        with entity, every record is one of it; otherwise its "type"
+        member ("actor", "movie" or "role") tells
+        errors are recorded as (source, line number, message)
+        '''
+        for number, record in records:
+            try:
+                if record is None:
+                    raise ValueError('not a JSON object')
+                record_entity = entity or IMPORT_TYPES.get(record.get('type'))
+                if record_entity is None:
+                    raise ValueError('type must be actor, movie or role')
+                _, clean, _ = IMPORT_ENTITIES[record_entity]
+                batch = self.batches[record_entity]
+                batch.append((number, clean(record)))
+            except ValueError as e:
+                self.errors.append((source, number, str(e)))
+                continue
+            if len(batch) == self.batch_size:
+                self.flush(record_entity, source)
+
+        for pending in IMPORT_ENTITIES:
+            if self.batches[pending]:
+                self.flush(pending, source)
+
+    def flush(self, entity, source):
+        '''
+        insert the pending batch of an entity
+        the actors and movies still pending go in before any role
+        '''
+        if entity == 'roles':
+            for referenced in ('actors', 'movies'):
+                if self.batches[referenced]:
+                    self.flush(referenced, source)
+            self.analyze()
+
+        batch, self.batches[entity] = self.batches[entity], []
+        self.insert(entity, batch, source)
+        if entity != 'roles':
+            self.unanalyzed.add(IMPORT_ENTITIES[entity][0])
+
+    def analyze(self):
+        '''
+        the planner sees a freshly filled table as empty: without fresh
+        statistics the foreign key checks of the roles (and the reference
+        lookups) would scan Actor and Movie for every row
+        '''
+        if db.engine.name == 'postgresql':
+            for model in self.unanalyzed:
+                db.session.execute(f'ANALYZE "{model.__tablename__}"')
+        self.unanalyzed.clear()
+
+    def resolve_references(self, batch, source):
+        '''
+        fill in the actor_id and movie_id of a batch of roles, dropping
+        the roles whose actor or movie does not exist
+        '''
+        for id_key, name_key, model, name_column in ROLE_REFERENCES:
+            ids = resolve(model, model.id, {
+                row[id_key] for _, row in batch if row[id_key] is not None})
+            names = resolve(model, name_column, {
+                row[name_key] for _, row in batch if row[id_key] is None})
+
+            resolved = []
+            for number, row in batch:
+                if row[id_key] is not None:
+                    found = ids.get(row[id_key])
+                else:
+                    found = names.get(row[name_key])
+                if found is None:
+                    reference = row[id_key] or row[name_key]
+                    self.errors.append(
+                        (source, number, f'{model.__name__.lower()} '
+                                         f'{reference!r} does not exist'))
+                    continue
+                row[id_key] = found
+                resolved.append((number, row))
+            batch = resolved
+        return batch
+
+    def insert(self, entity, batch, source):
+        model, _, columns = IMPORT_ENTITIES[entity]
+        if entity == 'roles':
+            batch = self.resolve_references(batch, source)
+
+        # rows with and without an id go in separate statements
+        with_id = [row for _, row in batch if row['id'] is not None]
+        without_id = [row for _, row in batch if row['id'] is None]
+        if with_id:
+            self.explicit_ids.add(model)
+            self.write(model, ['id'] + columns, with_id)
+        if without_id:
+            self.write(model, columns, without_id)
+
+        self.rows[entity] += len(batch)
+        if self.progress:
+            self.progress(entity, self.rows[entity], self.rate())
+
+    def write(self, model, columns, rows):
+        table = model.__table__
+        if db.engine.name != 'postgresql':
+            db.session.execute(table.insert(), [
+                {column: row[column] for column in columns} for row in rows])
+            return
+
+        data = ''.join(
+            '\t'.join(copy_value(row[column]) for column in columns) + '\n'
+            for row in rows)
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert('COPY "{}" ({}) FROM STDIN'.format(
+                table.name, ', '.join(columns)), io.StringIO(data))
+        finally:
+            cursor.close()
+
+    def finish(self):
+        '''
+        finish()
+        move the id sequences past the imported ids
+        '''
+        if db.engine.name == 'postgresql':
+            for model in self.explicit_ids:
+                db.session.execute(
+                    "SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), "
+                    'max(id)) FROM "{0}"'.format(model.__tablename__))
@@ -0,0 +1,39 @@
+from sqlalchemy import event
+
+from models import db
+
+
+class QueryCounter:
+    '''
+    Context manager counting the SQL statements sent to the database
+    used by the tests and benchmarks to check that an endpoint does a
+    fixed number of round trips no matter how many rows it returns
+    EXAMPLE
+        with QueryCounter() as counter:
+            roles = Role.query.all()
+        counter.count       # 1
+        counter.statements  # ['SELECT "Role".id AS ...']
+    '''
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        if self.engine is None:
+            self.engine = db.engine
+        event.listen(self.engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import base64
+import hashlib
+
+import rsa
+from jose import jwk, jwt
+
+from auth import (API_AUDIENCE, AUTH_ISSUER, LOCAL_JWKS_PATH,
+                  LOCAL_PRIVATE_KEY_PATH)
+
+# Local signing keys
+#
+# With AUTH_MODE=local, auth.py verifies tokens against a JWKS file on disk
+# instead of Auth0. This module creates that key pair and mints tokens for
+# the three Auth0 roles, with the same issuer, audience and permissions
+# claims Auth0 would put in them, so the API can be tested and benchmarked
+# on a machine with no network.
+#
+# Never point a deployed app at these keys: anyone holding the private key
+# can mint a producer token.
+
+ALGORITHM = 'RS256'
+
+# Permissions of the Auth0 roles (see README)
+ROLE_PERMISSIONS = {
+    'assistant': [
+        'get:actors', 'get:castings', 'get:movies',
+    ],
+    'director': [
+        'delete:actors', 'get:actors', 'get:castings', 'get:movies',
+        'patch:actors', 'patch:movies', 'post:actors',
+    ],
+    'producer': [
+        'delete:actors', 'delete:castings', 'delete:movies',
+        'get:actors', 'get:castings', 'get:movies',
+        'patch:actors', 'patch:movies',
+        'post:actors', 'post:castings', 'post:movies',
+    ],
+}
+
+
+def key_id(public_jwk):
+    '''
+    Return the RFC 7638 thumbprint of a public RSA jwk, used as its kid
+    '''
+    members = {'e': public_jwk['e'], 'kty': 'RSA', 'n': public_jwk['n']}
+    digest = hashlib.sha256(
+        json.dumps(members, separators=(',', ':'), sort_keys=True)
+        .encode('utf-8')).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def public_jwks(private_key_pem):
+    '''
+    Return the JWKS document holding the public half of a private key
+    '''
+    public_jwk = jwk.construct(private_key_pem, ALGORITHM) \
+        .public_key().to_dict()
+    return {
+        'keys': [{
+            'kty': 'RSA',
+            'kid': key_id(public_jwk),
+            'use': 'sig',
+            'alg': ALGORITHM,
+            'n': public_jwk['n'],
+            'e': public_jwk['e'],
+        }]
+    }
+
+
+def generate_keys(private_key_path=LOCAL_PRIVATE_KEY_PATH,
+                  jwks_path=LOCAL_JWKS_PATH, bits=2048):
+    '''
+    Generate an RSA key pair
+    the private key is written as PEM (readable by the owner only) and
+    the public key as a JWKS document
+    '''
+    public_key, private_key = rsa.newkeys(bits)
+    private_key_pem = private_key.save_pkcs1().decode('ascii')
+
+    for path in (private_key_path, jwks_path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    fd = os.open(private_key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(private_key_pem)
+    with open(jwks_path, 'w') as f:
+        json.dump(public_jwks(private_key_pem), f, indent=2)
+
+    return private_key_pem
+
+
+def load_private_key(private_key_path=LOCAL_PRIVATE_KEY_PATH):
+    with open(private_key_path) as f:
+        return f.read()
+
+
+def mint_token(role, private_key_pem=None, expires_in=24 * 3600,
+               subject=None):
+    '''
+    Mint a token for one of the roles in ROLE_PERMISSIONS
+    signed with the local private key (read from LOCAL_PRIVATE_KEY_PATH
+    when not given)
+    '''
+    if role not in ROLE_PERMISSIONS:
+        raise ValueError(f'unknown role {role!r}, expected one of '
+                         f'{", ".join(sorted(ROLE_PERMISSIONS))}')
+    if private_key_pem is None:
+        private_key_pem = load_private_key()
+
+    now = int(time.time())
+    claims = {
+        'iss': AUTH_ISSUER,
+        'sub': subject or f'local|{role}',
+        'aud': API_AUDIENCE,
+        'iat': now,
+        'exp': now + expires_in,
+        'scope': '',
+        'permissions': ROLE_PERMISSIONS[role],
+    }
+    kid = public_jwks(private_key_pem)['keys'][0]['kid']
+    return jwt.encode(claims, private_key_pem, algorithm=ALGORITHM,
+                      headers={'kid': kid})
+
+
+def mint_role_tokens(private_key_pem=None, expires_in=24 * 3600):
+    '''
+    Return {role: token} for every role in ROLE_PERMISSIONS
+    '''
+    if private_key_pem is None:
+        private_key_pem = load_private_key()
+    return {
+        role: mint_token(role, private_key_pem, expires_in)
+        for role in ROLE_PERMISSIONS
+    }
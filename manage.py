@@ -1,8 +1,14 @@
-from flask_script import Manager
+from flask_script import Command, Manager, Option
 from flask_migrate import Migrate, MigrateCommand
 
+import os
+import sys
+
+import local_auth
 from app import app
-from models import db
+from export import EXPORT_ENTITIES, EXPORT_FORMATS, Export
+from importer import IMPORT_BATCH_SIZE, Importer, read_records
+from models import db, transaction
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +16,115 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('-b', '--bits', dest='bits', type=int, default=2048)
+def generate_keys(bits):
+    '''
+    Generate the local key pair used with AUTH_MODE=local
+    '''
+    local_auth.generate_keys(bits=bits)
+    print(f'private key: {local_auth.LOCAL_PRIVATE_KEY_PATH}')
+    print(f'jwks: {local_auth.LOCAL_JWKS_PATH}')
+
+
+@manager.option('-r', '--role', dest='role', default='producer',
+                choices=sorted(local_auth.ROLE_PERMISSIONS))
+@manager.option('-e', '--expires-in', dest='expires_in', type=int,
+                default=24 * 3600)
+def mint_token(role, expires_in):
+    '''
+    Print a token for a role, signed with the local private key
+    '''
+    print(local_auth.mint_token(role, expires_in=expires_in))
+
+
+@manager.option('-f', '--format', dest='export_format', default='ndjson',
+                choices=EXPORT_FORMATS)
+@manager.option('-e', '--entity', dest='entities', action='append',
+                choices=sorted(EXPORT_ENTITIES))
+@manager.option('-o', '--output', dest='output', default='-')
+def export(export_format, entities, output):
+    '''
+    Export actors, movies and roles from one snapshot, as NDJSON (to the
+    -o file, stdout by default) or as CSV (one <entity>.csv per entity in
+    the -o directory, or a single -e entity to stdout)
+    '''
+    entities = entities or list(EXPORT_ENTITIES)
+    if export_format == 'csv' and output == '-' and len(entities) != 1:
+        sys.exit('CSV to stdout needs a single --entity')
+
+    job = Export(entities)
+    job.begin()
+    if export_format == 'ndjson':
+        outputs = [(output, job.ndjson())]
+    elif output == '-':
+        outputs = [(output, job.csv(entities[0]))]
+    else:
+        os.makedirs(output, exist_ok=True)
+        outputs = [(os.path.join(output, f'{entity}.csv'), job.csv(entity))
+                   for entity in entities]
+
+    for path, chunks in outputs:
+        f = sys.stdout if path == '-' else open(path, 'w', newline='')
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+
+    print(f'exported {job.rows} rows in {job.elapsed():.1f}s '
+          f'({job.rate():.0f} rows/s)', file=sys.stderr)
+
+
+class ImportCommand(Command):
+    '''
+    Import actors, movies and roles in one transaction, from JSON lines
+    files with a "type" member on each line (such as the NDJSON export,
+    where roles come after the actors and movies they reference) and from
+    per entity CSV or JSON lines files
+    EXAMPLE
+        python manage.py import casting.ndjson
+        python manage.py import -a actors.csv -m movies.csv -r roles.csv
+    '''
+
+    option_list = (
+        Option('paths', nargs='*'),
+        Option('-a', '--actors', dest='actors', action='append', default=[]),
+        Option('-m', '--movies', dest='movies', action='append', default=[]),
+        Option('-r', '--roles', dest='roles', action='append', default=[]),
+        Option('-b', '--batch-size', dest='batch_size', type=int,
+               default=IMPORT_BATCH_SIZE),
+    )
+
+    def run(self, paths, actors, movies, roles, batch_size):
+        def progress(entity, rows, rate):
+            print(f'{entity}: {rows} rows ({rate:.0f} rows/s)',
+                  file=sys.stderr)
+
+        importer = Importer(batch_size, progress)
+        try:
+            with transaction():
+                # the roles last, they reference actors and movies
+                for entity, files in [('actors', actors), ('movies', movies),
+                                      (None, paths), ('roles', roles)]:
+                    for path in files:
+                        importer.load(read_records(path), entity, path)
+                importer.finish()
+        except Exception as e:
+            sys.exit(f'import failed, nothing was imported: {e}')
+
+        for path, number, message in importer.errors[:20]:
+            print(f'{path}:{number}: {message}', file=sys.stderr)
+        if len(importer.errors) > 20:
+            print(f'... {len(importer.errors) - 20} more errors',
+                  file=sys.stderr)
+        print(f'imported {sum(importer.rows.values())} rows in '
+              f'{importer.elapsed():.1f}s ({importer.rate():.0f} rows/s), '
+              f'skipped {len(importer.errors)}', file=sys.stderr)
+
+
+manager.add_command('import', ImportCommand())
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
@@ -0,0 +1,61 @@
+"""add Movie.release_year, generated from date
+
+Revision ID: 3f9b6d2a8c14
+Revises: a7c2e5d8f031
+Create Date: 2026-10-18 21:37:52.904117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9b6d2a8c14'
+down_revision = 'a7c2e5d8f031'
+branch_labels = None
+depends_on = None
+
+INDEX = ('ix_Movie_release_year_id', ['release_year', 'id'])
+
+
+def release_year(dialect):
+    # the year of date, as models.Movie.release_year compiles it
+    if dialect == 'postgresql':
+        expression = 'CAST(EXTRACT(year FROM date) AS INTEGER)'
+    else:
+        expression = "CAST(strftime('%Y', date) AS INTEGER)"
+    return sa.Column('release_year', sa.Integer(),
+                     sa.Computed(expression, persisted=True),
+                     nullable=False)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    name, columns = INDEX
+    if dialect != 'postgresql':
+        # SQLite cannot add a stored generated column: batch mode copies
+        # the table, computing the years of the existing rows
+        with op.batch_alter_table('Movie', recreate='always') as batch_op:
+            batch_op.add_column(release_year(dialect))
+        op.create_index(name, 'Movie', columns)
+        return
+
+    # adding a stored generated column rewrites Movie (under an exclusive
+    # lock), which fills in the years of the existing rows
+    op.add_column('Movie', release_year(dialect))
+    # the index is built without locking Movie against writes, see
+    # e41c7a0b9f52
+    with op.get_context().autocommit_block():
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+        op.create_index(name, 'Movie', columns,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    name, _ = INDEX
+    op.drop_index(name, table_name='Movie')
+    if op.get_bind().dialect.name != 'postgresql':
+        with op.batch_alter_table('Movie', recreate='always') as batch_op:
+            batch_op.drop_column('release_year')
+        return
+    op.drop_column('Movie', 'release_year')
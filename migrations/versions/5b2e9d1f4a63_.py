@@ -0,0 +1,54 @@
+"""add indexes backing keyset pagination
+
+Revision ID: 5b2e9d1f4a63
+Revises: c8f47bca3cf9
+Create Date: 2026-10-18 10:12:41.508233
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2e9d1f4a63'
+down_revision = 'c8f47bca3cf9'
+branch_labels = None
+depends_on = None
+
+
+# every sort key is indexed together with the id tie-breaker, so a page
+# of GET /actors?sort=name&after=... is a single index range scan
+# (name, table, columns)
+INDEXES = [
+    ('ix_Actor_name_id', 'Actor', ['name', 'id']),
+    ('ix_Actor_age_id', 'Actor', ['age', 'id']),
+    ('ix_Movie_title_id', 'Movie', ['title', 'id']),
+    ('ix_Movie_date_id', 'Movie', ['date', 'id']),
+    ('ix_Role_role_name_id', 'Role', ['role_name', 'id']),
+]
+
+
+def upgrade():
+    # on Postgres, build the indexes without locking the tables against
+    # writes. CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                # a failed concurrent build leaves an INVALID index behind,
+                # drop it so the migration can simply be run again
+                op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+                op.create_index(name, table, columns,
+                                postgresql_concurrently=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, _ in reversed(INDEXES):
+                op.drop_index(name, table_name=table,
+                              postgresql_concurrently=True)
+    else:
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table)
@@ -0,0 +1,49 @@
+"""index the actor list filters
+
+Revision ID: 6c1f8e4b2d97
+Revises: 3f9b6d2a8c14
+Create Date: 2026-10-18 23:12:05.641380
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '6c1f8e4b2d97'
+down_revision = '3f9b6d2a8c14'
+branch_labels = None
+depends_on = None
+
+# ?age_min/?age_max use ix_Actor_age_id and the Role filters the foreign key
+# indexes of e41c7a0b9f52; ?gender and ?name_prefix need these two
+# (name, columns, postgresql_ops)
+INDEXES = [
+    ('ix_Actor_gender_age_id', ['gender', 'age', 'id'], {}),
+    ('ix_Actor_name_pattern', ['name'], {'name': 'text_pattern_ops'}),
+]
+
+
+def upgrade():
+    # on Postgres, build the indexes without locking Actor against writes,
+    # see e41c7a0b9f52
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, columns, ops in INDEXES:
+                op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+                op.create_index(name, 'Actor', columns,
+                                postgresql_concurrently=True,
+                                postgresql_ops=ops)
+    else:
+        for name, columns, _ in INDEXES:
+            op.create_index(name, 'Actor', columns)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, _, _ in reversed(INDEXES):
+                op.drop_index(name, table_name='Actor',
+                              postgresql_concurrently=True)
+    else:
+        for name, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name='Actor')
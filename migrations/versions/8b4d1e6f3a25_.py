@@ -0,0 +1,72 @@
+"""full-text index the actor names, movie titles and role names
+
+Revision ID: 8b4d1e6f3a25
+Revises: 6c1f8e4b2d97
+Create Date: 2026-10-18 23:48:27.093512
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8b4d1e6f3a25'
+down_revision = '6c1f8e4b2d97'
+branch_labels = None
+depends_on = None
+
+# table -> searched column, as models.SEARCH_COLUMNS
+SEARCH_COLUMNS = {'Actor': 'name', 'Movie': 'title', 'Role': 'role_name'}
+
+
+def sqlite_upgrade(table, column):
+    # an FTS5 table over the column, filled from the existing rows and kept
+    # up to date by triggers, as models.search_index_ddl creates it
+    search = f'"{table}_search"'
+    insert = (f'INSERT INTO {search}(rowid, {column}) '
+              f'VALUES (new.id, new.{column});')
+    delete = (f'INSERT INTO {search}({search}, rowid, {column}) '
+              f"VALUES ('delete', old.id, old.{column});")
+    op.execute(f'CREATE VIRTUAL TABLE {search} USING fts5({column}, '
+               f"content='{table}', content_rowid='id')")
+    op.execute(f"INSERT INTO {search}({search}) VALUES ('rebuild')")
+    op.execute(f'CREATE TRIGGER "{table}_search_insert" AFTER INSERT ON '
+               f'"{table}" BEGIN {insert} END')
+    op.execute(f'CREATE TRIGGER "{table}_search_delete" AFTER DELETE ON '
+               f'"{table}" BEGIN {delete} END')
+    op.execute(f'CREATE TRIGGER "{table}_search_update" AFTER UPDATE OF '
+               f'{column} ON "{table}" BEGIN {delete} {insert} END')
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        for table, column in SEARCH_COLUMNS.items():
+            sqlite_upgrade(table, column)
+        return
+
+    # adding a stored generated column rewrites the table (under an
+    # exclusive lock), which computes the vectors of the existing rows
+    for table, column in SEARCH_COLUMNS.items():
+        op.execute(f'ALTER TABLE "{table}" ADD COLUMN search_vector tsvector '
+                   f"GENERATED ALWAYS AS (to_tsvector('simple', {column})) "
+                   f'STORED')
+    # the GIN indexes are built without locking the tables against writes,
+    # see e41c7a0b9f52
+    with op.get_context().autocommit_block():
+        for table in SEARCH_COLUMNS:
+            name = f'ix_{table}_search_vector'
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+            op.execute(f'CREATE INDEX CONCURRENTLY "{name}" ON "{table}" '
+                       f'USING gin (search_vector)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        for table in reversed(list(SEARCH_COLUMNS)):
+            for trigger in ('update', 'delete', 'insert'):
+                op.execute(f'DROP TRIGGER "{table}_search_{trigger}"')
+            op.execute(f'DROP TABLE "{table}_search"')
+        return
+
+    # dropping the column drops its index
+    for table in reversed(list(SEARCH_COLUMNS)):
+        op.drop_column(table, 'search_vector')
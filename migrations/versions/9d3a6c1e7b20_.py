@@ -0,0 +1,57 @@
+"""make the sort columns NOT NULL
+
+Revision ID: 9d3a6c1e7b20
+Revises: 5b2e9d1f4a63
+Create Date: 2026-10-18 14:02:17.830114
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3a6c1e7b20'
+down_revision = '5b2e9d1f4a63'
+branch_labels = None
+depends_on = None
+
+# keyset pagination seeks with WHERE (name, id) > (:name, :id), which a
+# NULL name never satisfies, so every sortable column must hold a value.
+COLUMNS = [
+    ('Actor', 'name', sa.String()),
+    ('Actor', 'age', sa.Integer()),
+    ('Movie', 'title', sa.String()),
+    ('Role', 'role_name', sa.String()),
+]
+
+
+def upgrade():
+    # rows written before the API validated these fields may hold NULLs.
+    # There is no value to make up for them (an age of 0 would be wrong
+    # for the age filters, and a downgrade could not bring the NULL back):
+    # stop, and leave fixing or deleting those rows to whoever runs this
+    bind = op.get_bind()
+    nulls = []
+    for table, column, _ in COLUMNS:
+        count = bind.execute(sa.text(
+            f'SELECT count(*) FROM "{table}" WHERE {column} IS NULL'
+        )).scalar()
+        if count:
+            nulls.append(f'{count} rows of {table} without {column}')
+    if nulls:
+        message = ('cannot make the sort columns NOT NULL: ' +
+                   ', '.join(nulls) +
+                   '. Set or delete these rows, then run the migration again')
+        # manage.py exits on the error without printing it
+        logging.getLogger('alembic.env').error(message)
+        raise RuntimeError(message)
+
+    for table, column, type_ in COLUMNS:
+        op.alter_column(table, column, existing_type=type_, nullable=False)
+
+
+def downgrade():
+    for table, column, type_ in reversed(COLUMNS):
+        op.alter_column(table, column, existing_type=type_, nullable=True)
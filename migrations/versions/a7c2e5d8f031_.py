@@ -0,0 +1,57 @@
+"""delete the roles of a deleted actor or movie
+
+Revision ID: a7c2e5d8f031
+Revises: e41c7a0b9f52
+Create Date: 2026-10-18 19:02:13.518244
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c2e5d8f031'
+down_revision = 'e41c7a0b9f52'
+branch_labels = None
+depends_on = None
+
+# Role foreign keys: (constraint, column, referred table), named as
+# Postgres named them in c8f47bca3cf9
+FOREIGN_KEYS = [
+    ('Role_actor_id_fkey', 'actor_id', 'Actor'),
+    ('Role_movie_id_fkey', 'movie_id', 'Movie'),
+]
+
+# SQLite foreign keys have no name, batch mode reflects them with this one
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def replace_foreign_keys(ondelete):
+    if op.get_bind().dialect.name != 'postgresql':
+        # SQLite cannot alter a constraint: batch mode copies the table
+        with op.batch_alter_table(
+                'Role', naming_convention=NAMING_CONVENTION) as batch_op:
+            for name, column, table in FOREIGN_KEYS:
+                batch_op.drop_constraint(name, type_='foreignkey')
+                batch_op.create_foreign_key(name, table, [column], ['id'],
+                                            ondelete=ondelete)
+        return
+
+    # on Postgres, swap the constraint NOT VALID (no scan of Role under an
+    # exclusive lock) and commit, then validate it: VALIDATE CONSTRAINT
+    # scans Role with a lock that lets writes through
+    action = f' ON DELETE {ondelete}' if ondelete else ''
+    with op.get_context().autocommit_block():
+        for name, column, table in FOREIGN_KEYS:
+            op.execute(
+                f'ALTER TABLE "Role" DROP CONSTRAINT "{name}", '
+                f'ADD CONSTRAINT "{name}" FOREIGN KEY ({column}) '
+                f'REFERENCES "{table}" (id){action} NOT VALID')
+            op.execute(f'ALTER TABLE "Role" VALIDATE CONSTRAINT "{name}"')
+
+
+def upgrade():
+    replace_foreign_keys('CASCADE')
+
+
+def downgrade():
+    replace_foreign_keys(None)
@@ -0,0 +1,51 @@
+"""index the Role foreign keys
+
+Revision ID: e41c7a0b9f52
+Revises: 9d3a6c1e7b20
+Create Date: 2026-10-18 15:20:44.172906
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41c7a0b9f52'
+down_revision = '9d3a6c1e7b20'
+branch_labels = None
+depends_on = None
+
+# Role.movie_id lookups use the leading column of the composite index, and
+# Actor.name, Movie.title and Movie.date are already the leading columns of
+# the keyset pagination indexes (5b2e9d1f4a63), so these two are all that
+# is missing.
+INDEXES = [
+    ('ix_Role_actor_id', ['actor_id']),
+    ('ix_Role_movie_id_actor_id', ['movie_id', 'actor_id']),
+]
+
+
+def upgrade():
+    # on Postgres, build the indexes without locking Role against writes.
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, columns in INDEXES:
+                # a failed concurrent build leaves an INVALID index behind,
+                # drop it so the migration can simply be run again
+                op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+                op.create_index(name, 'Role', columns,
+                                postgresql_concurrently=True)
+    else:
+        for name, columns in INDEXES:
+            op.create_index(name, 'Role', columns)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, _ in reversed(INDEXES):
+                op.drop_index(name, table_name='Role',
+                              postgresql_concurrently=True)
+    else:
+        for name, _ in reversed(INDEXES):
+            op.drop_index(name, table_name='Role')
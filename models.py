@@ -1,31 +1,175 @@
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import (DDL, Column, Computed, String, Integer, and_, any_,
+                        bindparam, cast, event, extract, inspect, literal,
+                        select)
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.postgresql import ARRAY
 from flask_sqlalchemy import SQLAlchemy
+from collections import namedtuple
+from contextlib import contextmanager
 import json
+import sqlite3
 
 db = SQLAlchemy()
 
 
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    '''
+    SQLite only enforces foreign keys, and ON DELETE CASCADE, when asked
+    to, on each connection
+    '''
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def any_of(column, values):
+    '''
+    any_of(column, values)
+    column IN values, sent as a single array parameter on Postgres
+    (column = ANY(:values)), which compiles and plans the same way for
+    ten values or ten thousand
+    '''
+    values = list(values)
+    if db.engine.name == 'postgresql':
+        return column == any_(bindparam(None, values,
+                                        type_=ARRAY(column.type)))
+    return column.in_(values)
+
+
+# Unit of work
+#
+# insert(), update() and delete() commit by default, one transaction per
+# call. Inside a transaction() block they only flush (the rows get their
+# ids) and the block commits everything once at its end, or rolls it all
+# back when it raises. Blocks nest: an inner block joins the outer one.
+# commit=False defers the commit without a block, for a caller that
+# commits itself.
+#
+# Every helper takes the session to work on, db.session by default (the
+# scoped session the app and the tests share).
+#
+# EXAMPLE
+#   with transaction():
+#       actor.insert()
+#       movie.insert()
+#       Role(role_name='Hero', actor_id=actor.id, movie_id=movie.id).insert()
+
+# key of session.info holding the depth of the open transaction() blocks
+TRANSACTION_DEPTH = 'transaction_depth'
+
+
+def in_transaction(session=None):
+    session = session or db.session
+    return session.info.get(TRANSACTION_DEPTH, 0) > 0
+
+
+@contextmanager
+def transaction(session=None):
+    '''
+    transaction(session=db.session)
+    commit the work of the block once at its end, roll it back if the block
+    or the commit raises; yield the session
+    '''
+    session = session or db.session
+    depth = session.info.get(TRANSACTION_DEPTH, 0)
+    session.info[TRANSACTION_DEPTH] = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+    except BaseException:
+        if depth == 0:
+            session.rollback()
+        raise
+    finally:
+        session.info[TRANSACTION_DEPTH] = depth
+
+
+def end_change(commit, session):
+    '''
+    commit a change, or only flush it inside a transaction() or when
+    commit is False
+    '''
+    if commit and not in_transaction(session):
+        session.commit()
+    else:
+        session.flush()
+
+
+# Name changes
+#
+# autocomplete.py indexes the actor names and movie titles (the column
+# named by the autocompleted attribute of the model) in memory. The names
+# a transaction inserts, changes or deletes are noted in session.info: by
+# the flush for the ORM (inheritedClassName.insert, update and delete), by
+# name_changed for the Core statements of the record helpers and batches.
+# autocomplete.py applies them once the transaction commits; they are
+# dropped when it ends otherwise.
+
+# key of session.info holding the (table, id, name, None once deleted)
+# changes of the open transaction
+NAME_CHANGES = 'name_changes'
+
+
+def name_changed(model, row, deleted=False, session=None):
+    '''
+    name_changed(model, row, deleted=False, session=db.session)
+    note the autocompleted name of a row (a record, or any row with the id
+    and the column) written by a Core statement, nothing for a model
+    without an autocompleted column
+    '''
+    column = getattr(model, 'autocompleted', None)
+    if column is None:
+        return
+    session = session or db.session
+    session.info.setdefault(NAME_CHANGES, []).append(
+        (model.__tablename__, row.id,
+         None if deleted else getattr(row, column)))
+
+
+@event.listens_for(db.session, 'after_flush')
+def note_flushed_names(session, flush_context):
+    # new, dirty and deleted still hold the flushed instances, with their ids
+    for instance in session.new:
+        name_changed(type(instance), instance, session=session)
+    for instance in session.dirty:
+        column = getattr(instance, 'autocompleted', None)
+        if column and inspect(instance).attrs[column].history.has_changes():
+            name_changed(type(instance), instance, session=session)
+    for instance in session.deleted:
+        name_changed(type(instance), instance, deleted=True, session=session)
+
+
+@event.listens_for(db.session, 'after_transaction_end')
+def drop_name_changes(session, session_transaction):
+    if session_transaction.parent is None:
+        session.info.pop(NAME_CHANGES, None)
+
+
 class inheritedClassName(db.Model):
     '''
     Extend the base Model class to add common methods
     '''
     __abstract__ = True
 
-    def insert(self):
+    def insert(self, commit=True, session=None):
         '''
-        insert()
+        insert(commit=True, session=db.session)
         inserts a new model into a database
         the model must have a unique id or null id
         EXAMPLE
             actor = Actor(name=req_name, age=req_age, gender=req_gender)
             actor.insert()
         '''
-        db.session.add(self)
-        db.session.commit()
+        session = session or db.session
+        session.add(self)
+        end_change(commit, session)
 
-    def update(self):
+    def update(self, commit=True, session=None):
         '''
-        update()
+        update(commit=True, session=db.session)
         updates a model in a database
         the model must exist in the database
         EXAMPLE
@@ -33,19 +177,20 @@ class inheritedClassName(db.Model):
             actor.age = 36
             actor.update()
         '''
-        db.session.commit()
+        end_change(commit, session or db.session)
 
-    def delete(self):
+    def delete(self, commit=True, session=None):
         '''
-        delete()
+        delete(commit=True, session=db.session)
         delets a model from a database
         the model must exist in the database
         EXAMPLE
             actor = Actor.query.filter(Actor.id == id).one_or_none()
             actor.delete()
         '''
-        db.session.delete(self)
-        db.session.commit()
+        session = session or db.session
+        session.delete(self)
+        end_change(commit, session)
 
 
 class Actor(inheritedClassName):
@@ -54,12 +199,31 @@ class Actor(inheritedClassName):
     Have name, age and gender.
     '''
     __tablename__ = 'Actor'
+    __table_args__ = (
+        db.Index('ix_Actor_name_id', 'name', 'id'),
+        db.Index('ix_Actor_age_id', 'age', 'id'),
+        # ?gender= (with ?age_min/?age_max) and ?name_prefix= filters;
+        # text_pattern_ops lets LIKE 'prefix%' use the index whatever the
+        # collation of the database
+        db.Index('ix_Actor_gender_age_id', 'gender', 'age', 'id'),
+        db.Index('ix_Actor_name_pattern', 'name',
+                 postgresql_ops={'name': 'text_pattern_ops'}),
+    )
+
+    # columns the list endpoint can be sorted by, each backed by an index
+    # and NOT NULL so keyset pagination can seek with a row comparison
+    sortable = ('id', 'name', 'age')
+    # column of the autocomplete index, see autocomplete.py
+    autocompleted = 'name'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
-    age = Column(Integer)
+    name = Column(String, nullable=False)
+    age = Column(Integer, nullable=False)
     gender = Column(String)
-    roles = db.relationship('Role', backref='actor', lazy=True)
+    # the database deletes the roles (ON DELETE CASCADE), the ORM does
+    # not load them to do it
+    roles = db.relationship('Role', backref='actor', lazy=True,
+                            passive_deletes=True)
 
     def __init__(self, name, age, gender=""):
         self.name = name
@@ -88,11 +252,31 @@ class Movie(inheritedClassName):
     Have title and release date
     '''
     __tablename__ = 'Movie'
+    __table_args__ = (
+        db.Index('ix_Movie_title_id', 'title', 'id'),
+        db.Index('ix_Movie_date_id', 'date', 'id'),
+        # ?year_from=&year_to= range scans, and sort=release_year
+        db.Index('ix_Movie_release_year_id', 'release_year', 'id'),
+    )
+    # read the generated release_year back with RETURNING on insert
+    __mapper_args__ = {'eager_defaults': True}
+
+    # columns the list endpoint can be sorted by, each backed by an index
+    # and NOT NULL so keyset pagination can seek with a row comparison
+    sortable = ('id', 'title', 'date', 'release_year')
+    # column of the autocomplete index, see autocomplete.py
+    autocompleted = 'title'
 
     id = Column(Integer, primary_key=True)
-    title = Column(String)
+    title = Column(String, nullable=False)
     date = Column(db.DateTime, nullable=False)
-    roles = db.relationship('Role', backref='movie', lazy=True)
+    # the year of date, generated by the database on every write (whatever
+    # the path: ORM, Core statements or COPY) so it never disagrees with it
+    release_year = Column(Integer, Computed(
+        cast(extract('year', date), Integer), persisted=True),
+        nullable=False)
+    roles = db.relationship('Role', backref='movie', lazy=True,
+                            passive_deletes=True)
 
     def __init__(self, title, date):
         self.title = title
@@ -102,7 +286,7 @@ class Movie(inheritedClassName):
         return {
             'id': self.id,
             'title': self.title,
-            'release_year': self.date.strftime("%Y"),
+            'release_year': str(self.release_year),
         }
 
     def __repr__(self):
@@ -115,11 +299,23 @@ class Role(inheritedClassName):
     Have role name, actor name and related movie
     '''
     __tablename__ = 'Role'
+    __table_args__ = (
+        db.Index('ix_Role_role_name_id', 'role_name', 'id'),
+        # the roles of an actor, and of a movie (leading column)
+        db.Index('ix_Role_actor_id', 'actor_id'),
+        db.Index('ix_Role_movie_id_actor_id', 'movie_id', 'actor_id'),
+    )
+
+    # columns the list endpoint can be sorted by, each backed by an index
+    # and NOT NULL so keyset pagination can seek with a row comparison
+    sortable = ('id', 'role_name')
 
     id = Column(Integer, primary_key=True)
-    role_name = Column(String)
-    actor_id = Column(Integer, db.ForeignKey('Actor.id'))
-    movie_id = Column(Integer, db.ForeignKey('Movie.id'))
+    role_name = Column(String, nullable=False)
+    actor_id = Column(Integer, db.ForeignKey('Actor.id',
+                                             ondelete='CASCADE'))
+    movie_id = Column(Integer, db.ForeignKey('Movie.id',
+                                             ondelete='CASCADE'))
 
     def __init__(self, role_name, actor_id, movie_id):
         self.role_name = role_name
@@ -138,3 +334,233 @@ class Role(inheritedClassName):
 
     def __repr__(self):
         return json.dumps(self.format())
+
+
+# Full-text search
+#
+# The searched columns get a full-text index each, outside the mapped
+# columns (search.py queries them with SQL of its own):
+# - on Postgres a tsvector column generated from the column ('simple'
+#   configuration: lowercased words, no stemming, names are not English),
+#   with a GIN index
+# - on SQLite an FTS5 table over the column, kept up to date by triggers
+# They are created along with the tables here (db.create_all), and by the
+# migration 8b4d1e6f3a25 on an existing database.
+
+# table -> searched column
+SEARCH_COLUMNS = {'Actor': 'name', 'Movie': 'title', 'Role': 'role_name'}
+
+
+def search_index_ddl(table, column, dialect):
+    '''
+    search_index_ddl(table, column, dialect)
+    the statements creating the full-text index of table.column
+    '''
+    if dialect == 'postgresql':
+        return [
+            f'ALTER TABLE "{table}" ADD COLUMN search_vector tsvector '
+            f"GENERATED ALWAYS AS (to_tsvector('simple', {column})) STORED",
+            f'CREATE INDEX "ix_{table}_search_vector" ON "{table}" '
+            f'USING gin (search_vector)',
+        ]
+    search = f'"{table}_search"'
+    insert = (f'INSERT INTO {search}(rowid, {column}) '
+              f'VALUES (new.id, new.{column});')
+    delete = (f'INSERT INTO {search}({search}, rowid, {column}) '
+              f"VALUES ('delete', old.id, old.{column});")
+    return [
+        f'CREATE VIRTUAL TABLE {search} USING fts5({column}, '
+        f"content='{table}', content_rowid='id')",
+        f'CREATE TRIGGER "{table}_search_insert" AFTER INSERT ON "{table}" '
+        f'BEGIN {insert} END',
+        f'CREATE TRIGGER "{table}_search_delete" AFTER DELETE ON "{table}" '
+        f'BEGIN {delete} END',
+        f'CREATE TRIGGER "{table}_search_update" AFTER UPDATE OF {column} '
+        f'ON "{table}" BEGIN {delete} {insert} END',
+    ]
+
+
+for model in (Actor, Movie, Role):
+    table, column = model.__tablename__, SEARCH_COLUMNS[model.__tablename__]
+    for dialect in ('postgresql', 'sqlite'):
+        for statement in search_index_ddl(table, column, dialect):
+            event.listen(model.__table__, 'after_create',
+                         DDL(statement).execute_if(dialect=dialect))
+    # the FTS5 table outlives its content table, drop it first (the
+    # triggers go with the table)
+    event.listen(model.__table__, 'before_drop',
+                 DDL(f'DROP TABLE IF EXISTS "{table}_search"')
+                 .execute_if(dialect='sqlite'))
+
+
+# Read-only records
+#
+# The list endpoints only read rows and turn them into JSON. Selecting the
+# columns (instead of the mapped class) skips building ORM instances,
+# their attribute state and the session identity map; each row becomes a
+# namedtuple with the same format() as the model.
+
+
+class ActorRecord(namedtuple('ActorRecord', ['id', 'name', 'age',
+                                             'gender'])):
+    __slots__ = ()
+
+    format = Actor.format
+
+    @staticmethod
+    def query():
+        return db.session.query(Actor.id, Actor.name, Actor.age,
+                                Actor.gender)
+
+
+class MovieRecord(namedtuple('MovieRecord', ['id', 'title', 'date',
+                                             'release_year'])):
+    __slots__ = ()
+
+    format = Movie.format
+
+    @staticmethod
+    def query():
+        return db.session.query(Movie.id, Movie.title, Movie.date,
+                                Movie.release_year)
+
+
+def update_record(record, model, id, values):
+    '''
+    update_record(record, model, id, values)
+    set the columns in values on the row of model with that id and return
+    the row as a record, or None when there is no such row; the caller
+    commits
+    one UPDATE ... RETURNING on Postgres, nothing is read beforehand
+    EXAMPLE
+        actor = update_record(ActorRecord, Actor, 3, {'name': 'Link',
+                                                      'age': 117})
+    '''
+    table = model.__table__
+    statement = table.update().where(table.c.id == id).values(**values)
+    if db.engine.name == 'postgresql':
+        row = db.session.execute(statement.returning(
+            *[table.c[field] for field in record._fields])).first()
+    elif db.session.execute(statement).rowcount:
+        row = record.query().filter(model.id == id).one()
+    else:
+        row = None
+    if row is None:
+        return None
+    if getattr(model, 'autocompleted', None) in values:
+        name_changed(model, row)
+    return record._make(row)
+
+
+def delete_record(record, model, id):
+    '''
+    delete_record(record, model, id)
+    delete the row of model with that id and return it as a record, or
+    None when there is no such row; the caller commits, see transaction()
+    one DELETE ... RETURNING on Postgres, the roles of the row go with it
+    (ON DELETE CASCADE) without being loaded
+    '''
+    table = model.__table__
+    statement = table.delete().where(table.c.id == id)
+    if db.engine.name == 'postgresql':
+        row = db.session.execute(statement.returning(
+            *[table.c[field] for field in record._fields])).first()
+    else:
+        row = record.query().filter(model.id == id).one_or_none()
+        if row is not None:
+            db.session.execute(statement)
+    if row is None:
+        return None
+    name_changed(model, row, deleted=True)
+    return record._make(row)
+
+
+def delete_records(record, model, ids):
+    '''
+    delete_records(record, model, ids)
+    delete the rows of model with these ids and return them as records;
+    the caller commits, see transaction()
+    one DELETE ... WHERE id = ANY(:ids) RETURNING on Postgres, roles are
+    read back with their actor and movie names in the same statement
+    '''
+    table = model.__table__
+    statement = table.delete().where(any_of(table.c.id, ids))
+    if db.engine.name != 'postgresql':
+        rows = record.query().filter(any_of(model.id, ids)).all()
+        db.session.execute(statement)
+    elif record is not RoleRecord:
+        rows = db.session.execute(statement.returning(
+            *[table.c[field] for field in record._fields])).fetchall()
+    else:
+        # the actors and movies are not deleted: join them to the RETURNING
+        deleted = statement.returning(*table.c).cte('deleted')
+        actor, movie = Actor.__table__, Movie.__table__
+        rows = db.session.execute(
+            select([deleted.c.id, deleted.c.role_name, deleted.c.actor_id,
+                    actor.c.name, deleted.c.movie_id, movie.c.title])
+            .select_from(deleted
+                         .outerjoin(actor, actor.c.id == deleted.c.actor_id)
+                         .outerjoin(movie,
+                                    movie.c.id == deleted.c.movie_id))
+        ).fetchall()
+    for row in rows:
+        name_changed(model, row, deleted=True)
+    return [record._make(row) for row in rows]
+
+
+class RoleRecord(namedtuple('RoleRecord', ['id', 'role_name', 'actor_id',
+                                           'actor_name', 'movie_id',
+                                           'movie_name'])):
+    __slots__ = ()
+
+    def format(self):
+        return self._asdict()
+
+    @staticmethod
+    def create(role_name, actor_id, movie_id):
+        '''
+        create(role_name, actor_id, movie_id)
+        insert a role and return its record, or None when the actor or the
+        movie does not exist; the caller commits, see transaction()
+        on Postgres this is one statement: the role is inserted from the
+        join of its actor and movie (no row when either is missing) and
+        read back with their names
+            WITH inserted AS (INSERT INTO "Role" ... SELECT ... RETURNING ...)
+            SELECT ... FROM inserted JOIN "Actor" ... JOIN "Movie" ...
+        '''
+        actor, movie, role = Actor.__table__, Movie.__table__, Role.__table__
+        insert = role.insert().from_select(
+            ['role_name', 'actor_id', 'movie_id'],
+            select([literal(role_name, String), actor.c.id, movie.c.id])
+            .where(and_(actor.c.id == actor_id, movie.c.id == movie_id)))
+
+        if db.engine.name != 'postgresql':
+            result = db.session.execute(insert)
+            if not result.rowcount:
+                return None
+            return RoleRecord._make(RoleRecord.query()
+                                    .filter(Role.id == result.lastrowid)
+                                    .one())
+
+        inserted = insert.returning(role.c.id, role.c.role_name,
+                                    role.c.actor_id, role.c.movie_id) \
+            .cte('inserted')
+        row = db.session.execute(
+            select([inserted.c.id, inserted.c.role_name, inserted.c.actor_id,
+                    actor.c.name, inserted.c.movie_id, movie.c.title])
+            .select_from(inserted
+                         .join(actor, actor.c.id == inserted.c.actor_id)
+                         .join(movie, movie.c.id == inserted.c.movie_id))
+        ).first()
+        return RoleRecord._make(row) if row else None
+
+    @staticmethod
+    def query():
+        '''
+        the role columns joined to the actor name and the movie title
+        '''
+        return db.session.query(
+            Role.id, Role.role_name, Role.actor_id, Actor.name,
+            Role.movie_id, Movie.title) \
+            .join(Actor, Role.actor_id == Actor.id) \
+            .join(Movie, Role.movie_id == Movie.id)
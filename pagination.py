@@ -0,0 +1,208 @@
+import os
+import json
+import base64
+from datetime import datetime
+
+from itertools import groupby
+
+from sqlalchemy import and_, or_, tuple_
+
+# Keyset (cursor) pagination
+#
+# A page is the first `limit` rows ordered by the requested sort keys (plus
+# the primary key as a tie-breaker) that come strictly after the last row
+# of the previous page. The client gets that last row's sort values back as
+# an opaque cursor (?after=<cursor>), so every page is a range scan on an
+# index over the sort keys no matter how deep the client pages, unlike
+# OFFSET which reads and throws away every row before the page.
+#
+# The seek is a row comparison, WHERE (name, id) > (:name, :id), which
+# Postgres and SQLite turn into the start of an index range scan on
+# (name, id). The id tie-breaker sorts in the direction of the last key so
+# that (name DESC, id DESC) is the same index read backwards. Sortable
+# columns are NOT NULL: a NULL would compare as unknown and drop out of
+# the row comparison.
+#
+# EXAMPLE
+#   GET /actors?limit=2&sort=name,-age
+#   {..., "actors": [...], "next_cursor": "eyJzIjoibmFtZS..."}
+#   GET /actors?limit=2&sort=name,-age&after=eyJzIjoibmFtZS...
+
+DEFAULT_PAGE_LIMIT = int(os.environ.get('DEFAULT_PAGE_LIMIT', 100))
+MAX_PAGE_LIMIT = int(os.environ.get('MAX_PAGE_LIMIT', 1000))
+
+
+class PaginationError(ValueError):
+    '''
+    Raised for a malformed limit, sort or cursor query parameter
+    '''
+
+
+def parse_limit(limit, maximum=MAX_PAGE_LIMIT):
+    '''
+    Return the limit query parameter as an int, between 1 and maximum
+    (no upper bound when maximum is None)
+    '''
+    if limit is None:
+        return DEFAULT_PAGE_LIMIT
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise PaginationError('limit must be an integer')
+    if limit < 1 or maximum is not None and limit > maximum:
+        raise PaginationError(
+            f'limit must be between 1 and {maximum}')
+    return limit
+
+
+def parse_sort(sort, model):
+    '''
+    Turn 'name,-age' into [('name', False), ('age', True), ('id', False)]
+    (name, descending) pairs, restricted to model.sortable, always ending
+    with the primary key so the order is total
+    '''
+    keys = []
+    for field in (sort or '').split(','):
+        field = field.strip()
+        if not field:
+            continue
+        descending = field.startswith('-')
+        name = field.lstrip('-')
+        if name not in model.sortable:
+            raise PaginationError(f'cannot sort by {name!r}')
+        if name in (key for key, _ in keys):
+            raise PaginationError(f'{name!r} is sorted twice')
+        keys.append((name, descending))
+        if name == 'id':
+            break
+    if not keys:
+        keys.append(('id', False))
+    elif keys[-1][0] != 'id':
+        keys.append(('id', keys[-1][1]))
+    return keys
+
+
+def sort_spec(keys):
+    return ','.join(('-' if descending else '') + name
+                    for name, descending in keys)
+
+
+def encode_cursor(keys, row):
+    values = []
+    for name, _ in keys:
+        value = getattr(row, name)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        values.append(value)
+    cursor = json.dumps({'s': sort_spec(keys), 'v': values},
+                        separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, keys, model):
+    '''
+    Return the sort values stored in a cursor
+    the cursor must have been issued for the same sort keys
+    '''
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        spec, values = data['s'], data['v']
+    except (ValueError, TypeError, KeyError, UnicodeEncodeError):
+        raise PaginationError('malformed cursor')
+    if not isinstance(values, list):
+        raise PaginationError('malformed cursor')
+    if spec != sort_spec(keys) or len(values) != len(keys):
+        raise PaginationError('cursor does not match the sort order')
+
+    for i, (name, _) in enumerate(keys):
+        python_type = getattr(model, name).type.python_type
+        if python_type is datetime:
+            try:
+                values[i] = datetime.fromisoformat(values[i])
+            except (ValueError, TypeError):
+                raise PaginationError('malformed cursor')
+        elif (not isinstance(values[i], python_type) or
+              isinstance(values[i], bool)):
+            raise PaginationError('malformed cursor')
+    return values
+
+
+def ordering(model, keys):
+    return [getattr(model, name).desc() if descending
+            else getattr(model, name).asc()
+            for name, descending in keys]
+
+
+def after(model, keys, values):
+    '''
+    Build the WHERE clause selecting the rows that come after values in
+    the order of keys
+    keys sorted in one direction are a single row comparison:
+        (k1, k2, id) > (v1, v2, x)
+    a change of direction splits the keys into runs compared in turn:
+        k1 >= v1 AND (k1 > v1 OR (k2, id) < (v2, x))
+    where the leading bound on k1 keeps the index range scan
+    '''
+    runs = []
+    pairs = zip(keys, values)
+    for descending, run in groupby(pairs, key=lambda pair: pair[0][1]):
+        run = list(run)
+        runs.append(([getattr(model, name) for (name, _), _ in run],
+                     [value for _, value in run], descending))
+
+    def beyond(columns, run_values, descending):
+        if len(columns) == 1:
+            left, right = columns[0], run_values[0]
+        else:
+            left, right = tuple_(*columns), tuple_(*run_values)
+        return left < right if descending else left > right
+
+    if len(runs) == 1:
+        return beyond(*runs[0])
+
+    alternatives = []
+    for i, run in enumerate(runs):
+        prefix = [column == value
+                  for columns, run_values, _ in runs[:i]
+                  for column, value in zip(columns, run_values)]
+        alternatives.append(and_(*prefix, beyond(*run)))
+
+    columns, run_values, descending = runs[0]
+    lead = (columns[0] <= run_values[0] if descending
+            else columns[0] >= run_values[0])
+    return and_(lead, or_(*alternatives))
+
+
+def seek(query, model, keys, values, limit):
+    '''
+    Return query narrowed to the limit rows after values (None for the
+    first page) in the order of keys
+    '''
+    if values is not None:
+        query = query.filter(after(model, keys, values))
+    return query.order_by(*ordering(model, keys)).limit(limit)
+
+
+def paginate(query, model, args):
+    '''
+    Return (rows, next_cursor) for the page of query described by the
+    request args limit, sort and after
+    next_cursor is None on the last page
+    rows may be model instances or projected rows, as long as they expose
+    the sort keys as attributes
+    raise a PaginationError on malformed args
+    '''
+    limit = parse_limit(args.get('limit'))
+    keys = parse_sort(args.get('sort'), model)
+
+    cursor = args.get('after')
+    values = decode_cursor(cursor, keys, model) if cursor else None
+
+    # one row more than the page tells whether there is a next page
+    rows = seek(query, model, keys, values, limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(keys, rows[-1])
+    return rows, next_cursor
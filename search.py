@@ -0,0 +1,150 @@
+import re
+import json
+import base64
+
+from sqlalchemy import text
+
+from models import db, SEARCH_COLUMNS
+from pagination import PaginationError, parse_limit
+
+# Full-text search
+#
+# GET /search?q= looks the words of q up in the full-text indexes of the
+# actor names, movie titles and role names (see models.py): the rows
+# having every word, in any order and case, are matched through the GIN
+# indexes on Postgres and the FTS5 tables on SQLite, without reading the
+# tables. The matches of the three tables are ranked together, best first
+# (ts_rank, normalized by the length of the text, on Postgres; bm25 on
+# SQLite), and paginated with a cursor like the lists: the rank, type and
+# id of the last result of the page.
+#
+# EXAMPLE
+#   GET /search?q=zelda&limit=2
+#   {"results": [{"id": 1, "rank": 0.0607927, "title": "The Legend of
+#    Zelda", "type": "movie"}, ...], "next_cursor": "eyJxIjoiemVsZGEi..."}
+
+# result type -> searched table
+SEARCH_TYPES = {'actor': 'Actor', 'movie': 'Movie', 'role': 'Role'}
+
+
+class SearchError(ValueError):
+    '''
+    A missing or empty q, reported as 400
+    '''
+
+
+def search_words(q):
+    '''
+    the words of a search, as the full-text indexes split the text
+    '''
+    if not q or not q.strip():
+        raise SearchError('q is required')
+    # letters and digits: both split on punctuation, underscores included
+    return re.findall(r'[^\W_]+', q.lower())
+
+
+def matches(search_type, dialect):
+    '''
+    the SELECT of the (type, id, text, rank) of the rows of a type matching
+    the search, ranked from 0 (worst)
+    '''
+    table = SEARCH_TYPES[search_type]
+    column = SEARCH_COLUMNS[table]
+    if dialect == 'postgresql':
+        # float8: the rank is compared with the one of the cursor exactly
+        return (f"SELECT '{search_type}' AS type, id, {column} AS text, "
+                f'ts_rank(search_vector, query, 1)::float8 AS rank '
+                f'FROM "{table}", '
+                f"to_tsquery('simple', :match) AS query "
+                f'WHERE search_vector @@ query')
+    # bm25 is lower for better matches
+    return (f"SELECT '{search_type}' AS type, rowid AS id, {column} AS text, "
+            f'-bm25("{table}_search") AS rank FROM "{table}_search" '
+            f'WHERE "{table}_search" MATCH :match')
+
+
+def encode_search_cursor(q, row):
+    cursor = json.dumps({'q': q, 'v': [row.rank, row.type, row.id]},
+                        separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
+
+def decode_search_cursor(cursor, q):
+    '''
+    Return the rank, type and id stored in a cursor
+    the cursor must have been issued for the same search
+    '''
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        cursor_q, values = data['q'], data['v']
+        rank, search_type, id = values
+    except (ValueError, TypeError, KeyError, UnicodeEncodeError):
+        raise PaginationError('malformed cursor')
+    if cursor_q != q:
+        raise PaginationError('cursor does not match the search')
+    if (not isinstance(rank, (int, float)) or isinstance(rank, bool) or
+            search_type not in SEARCH_TYPES or
+            not isinstance(id, int) or isinstance(id, bool)):
+        raise PaginationError('malformed cursor')
+    return float(rank), search_type, id
+
+
+def search_statement(words, values, limit):
+    '''
+    search_statement(words, values, limit)
+    the SQL and parameters of the limit best results having every word,
+    after the rank, type and id in values (None for the first page)
+    '''
+    dialect = db.engine.name
+    if dialect == 'postgresql':
+        # every word, as a lexeme of its own (quoted, so no operator)
+        match = ' & '.join(f"'{word}'" for word in words)
+    else:
+        match = ' '.join(f'"{word}"' for word in words)
+    parameters = {'match': match, 'limit': limit}
+
+    statement = ('SELECT type, id, text, rank FROM (' +
+                 ' UNION ALL '.join(matches(search_type, dialect)
+                                    for search_type in SEARCH_TYPES) +
+                 ') AS results ')
+    if values is not None:
+        statement += ('WHERE rank < :rank OR rank = :rank AND '
+                      '(type > :type OR type = :type AND id > :id) ')
+        parameters.update(zip(('rank', 'type', 'id'), values))
+    statement += 'ORDER BY rank DESC, type, id LIMIT :limit'
+    return text(statement), parameters
+
+
+def search(args):
+    '''
+    search(args)
+    Return (rows, next_cursor) for the page of results of the request args
+    q, limit and after; rows have type, id, text and rank
+    raise a SearchError on a missing q, a PaginationError on malformed
+    limit or after
+    '''
+    q = args.get('q')
+    words = search_words(q)
+    limit = parse_limit(args.get('limit'))
+    cursor = args.get('after')
+    values = decode_search_cursor(cursor, q) if cursor else None
+    if not words:
+        return [], None
+
+    # one row more than the page tells whether there is a next page
+    rows = db.session.execute(
+        *search_statement(words, values, limit + 1)).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_search_cursor(q, rows[-1])
+    return rows, next_cursor
+
+
+def format_result(row):
+    return {
+        'type': row.type,
+        'id': row.id,
+        SEARCH_COLUMNS[SEARCH_TYPES[row.type]]: row.text,
+        'rank': row.rank,
+    }
@@ -20,6 +20,12 @@ export AUTH0_DOMAIN="acasting.us.auth0.com"
 export ALGORITHMS=['RS256']
 export API_AUDIENCE="casting"
 
+# Offline mode: verify tokens against a local key pair instead of Auth0.
+# Generate the keys once with `python manage.py generate_keys`, then mint
+# tokens with `python manage.py mint_token --role producer`.
+# test_app.py mints its own tokens in this mode.
+# export AUTH_MODE=local
+
 # jwt token for testing
 export ASSISTANT_TOKEN=$assistant_token
 export DIRECTOR_TOKEN=$director_token
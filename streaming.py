@@ -0,0 +1,87 @@
+import os
+from itertools import islice
+
+from flask import Response, current_app, stream_with_context
+
+from pagination import (decode_cursor, encode_cursor, parse_limit,
+                        parse_sort, seek)
+
+# Streamed list responses
+#
+# GET /actors?stream=1 (and /movies, /castings) sends every row after the
+# cursor instead of one page. The rows are read from a server-side cursor
+# (yield_per: psycopg2 fetches STREAM_CHUNK_SIZE rows at a time) and
+# written out as they arrive, inside the same envelope jsonify would build,
+# so a full dump keeps the worker's memory flat and the client gets the
+# first rows before the query has finished. The keys are not sorted as
+# jsonify sorts them: next_cursor is only known once the rows are sent, so
+# it always comes after them ("roles" sorts after it).
+#
+# The status code is sent with the first chunk: a database error halfway
+# through cuts the body short, which the client sees as invalid JSON.
+#
+# EXAMPLE
+#   GET /castings?stream=1&sort=role_name
+#   {"action":"get all roles","roles":[{...},{...},...],
+#    "next_cursor":null,"success":true}
+
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 500))
+
+
+def wants_stream(args):
+    return args.get('stream', '').lower() in ('1', 'true')
+
+
+def stream_list(query, model, record, args, action, key):
+    '''
+    Return a streamed JSON response with the rows of query, formatted by
+    record, under key
+    sort and after work as for a page; without a limit every remaining
+    row is sent and next_cursor is null, with one the stream stops there
+    raise a PaginationError on malformed args, before anything is sent
+    '''
+    keys = parse_sort(args.get('sort'), model)
+    cursor = args.get('after')
+    values = decode_cursor(cursor, keys, model) if cursor else None
+    # a stream is not a page: the limit is not capped at MAX_PAGE_LIMIT
+    limit = (parse_limit(args['limit'], maximum=None) if 'limit' in args
+             else None)
+
+    query = seek(query, model, keys, values,
+                 None if limit is None else limit + 1)
+    rows = iter(query.yield_per(STREAM_CHUNK_SIZE))
+
+    # one encoder for the whole stream, configured as jsonify's
+    encode = current_app.json_encoder(
+        sort_keys=current_app.config['JSON_SORT_KEYS'],
+        ensure_ascii=current_app.config['JSON_AS_ASCII'],
+        separators=(',', ':')).encode
+
+    def generate():
+        yield '{"action":%s,%s:[' % (encode(action), encode(key))
+
+        sent = 0
+        last = None
+        more = False
+        separator = ''
+        while True:
+            size = STREAM_CHUNK_SIZE
+            if limit is not None:
+                size = min(size, limit - sent)
+            chunk = list(islice(rows, size))
+            if not chunk:
+                break
+            sent += len(chunk)
+            last = chunk[-1]
+            yield separator + ','.join(
+                encode(record._make(row).format()) for row in chunk)
+            separator = ','
+            if limit is not None and sent == limit:
+                more = next(rows, None) is not None
+                break
+
+        next_cursor = encode_cursor(keys, last) if more else None
+        yield '],"next_cursor":%s,"success":true}' % encode(next_cursor)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
@@ -1,18 +1,43 @@
 import os
+import base64
+import tempfile
 import unittest
+from unittest import mock
 import json
+from datetime import datetime
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
-from models import db, Actor, Movie, Role
+from models import (db, Actor, Movie, Role, ActorRecord, MovieRecord,
+                    RoleRecord, transaction)
+from dates import parse_date
+from filters import (ACTOR_FILTERS, MOVIE_FILTERS, ROLE_FILTERS,
+                     apply_filters)
+from importer import Importer, read_records
+from instrumentation import QueryCounter
+from pagination import parse_sort, seek
+from autocomplete import PrefixIndex, build_index, building
+from search import search_statement
 from app import app
 
 # Set up database path and JWT token
+#
+# With AUTH_MODE=local the tokens are minted with the local key pair
+# (generated on first run) instead of being read from the environment
 
 database_path = os.environ['DATABASE_URL']
-assistant_token = os.environ['ASSISTANT_TOKEN']
-director_token = os.environ['DIRECTOR_TOKEN']
-producer_token = os.environ['PRODUCER_TOKEN']
+if os.environ.get('AUTH_MODE') == 'local':
+    import local_auth
+    if not os.path.exists(local_auth.LOCAL_PRIVATE_KEY_PATH):
+        local_auth.generate_keys()
+    local_tokens = local_auth.mint_role_tokens()
+    assistant_token = local_tokens['assistant']
+    director_token = local_tokens['director']
+    producer_token = local_tokens['producer']
+else:
+    assistant_token = os.environ['ASSISTANT_TOKEN']
+    director_token = os.environ['DIRECTOR_TOKEN']
+    producer_token = os.environ['PRODUCER_TOKEN']
 
 
 class ACastingTestCase(unittest.TestCase):
@@ -24,6 +49,9 @@ class ACastingTestCase(unittest.TestCase):
         '''
         # launch and initialize app
         cls.app = app
+        # no background build of the autocomplete index querying the
+        # database behind the tests (and their QueryCounter)
+        cls.app.config['AUTOCOMPLETE_REBUILD'] = False
         cls.client = cls.app.test_client
         db.app = cls.app
         db.init_app(cls.app)
@@ -90,6 +118,8 @@ class ACastingTestCase(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         '''Excutes once at the end of all test case'''
+        # end the transaction of the last test, drop_all waits for its locks
+        db.session.remove()
         db.drop_all()
         db.session.commit()
 
@@ -134,6 +164,30 @@ class ACastingTestCase(unittest.TestCase):
         delete_actor = self.client().delete('/actors/' + actor_id,
                                             headers=self.producer_header)
 
+    def test_add_actors_batch(self):
+        actors = [{'name': f'Batch Actor {i}', 'age': 20 + i}
+                  for i in range(50)]
+        with QueryCounter() as counter:
+            res = self.client().post('/actors',
+                                     headers=self.producer_header,
+                                     json=actors)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         [actor['name'] for actor in actors])
+        self.assertEqual(data['actors'][49]['age'], 69)
+        if db.engine.name == 'postgresql':
+            # one multi-row INSERT ... RETURNING
+            self.assertEqual(counter.count, 1)
+
+        ids = [actor['id'] for actor in data['actors']]
+        self.assertEqual(Actor.query.filter(Actor.id.in_(ids)).count(), 50)
+        Actor.query.filter(Actor.id.in_(ids)).delete(
+            synchronize_session=False)
+        db.session.commit()
+
     def test_get_actor_detail(self):
         res = self.client().get('/actors/1', headers=self.producer_header)
         data = json.loads(res.data)
@@ -154,6 +208,29 @@ class ACastingTestCase(unittest.TestCase):
         self.assertTrue(len(data['actors']))
         self.assertEqual(data['actors'][0]['age'], 16)
 
+    def test_edit_actor_detail_fields_together(self):
+        actor = Actor(name='Patched Actor', age=30, gender='Female')
+        actor.insert()
+        actor_id = actor.id
+
+        with QueryCounter() as counter:
+            res = self.client().patch(f'/actors/{actor_id}',
+                                      headers=self.producer_header,
+                                      json={'name': 'Renamed Actor',
+                                            'age': 31, 'gender': 'Male'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors'], [{'id': actor_id,
+                                           'name': 'Renamed Actor',
+                                           'age': 31, 'gender': 'Male'}])
+        if db.engine.name == 'postgresql':
+            # one UPDATE ... RETURNING, no SELECT before it
+            self.assertEqual(counter.count, 1)
+
+        Actor.query.filter(Actor.id == actor_id).delete()
+        db.session.commit()
+
     def test_delete_an_actor(self):
         # add data beforehead to test delete request
         add_actor = self.client().post('/actors',
@@ -171,6 +248,139 @@ class ACastingTestCase(unittest.TestCase):
         self.assertTrue(len(data['deleted_actors']))
         self.assertEqual(data['deleted_actors'][0]['id'], int(actor_id))
 
+    def test_delete_an_actor_with_roles(self):
+        actor = Actor(name='Busy Actor', age=40)
+        movie = Movie(title='Busy Movie', date='2010-10-10')
+        db.session.add_all([actor, movie])
+        db.session.commit()
+        actor_id, movie_id = actor.id, movie.id
+        db.session.add_all([Role(role_name=f'Busy Role {i}',
+                                 actor_id=actor_id, movie_id=movie_id)
+                            for i in range(20)])
+        db.session.commit()
+
+        with QueryCounter() as counter:
+            res = self.client().delete(f'/actors/{actor_id}',
+                                       headers=self.producer_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted_actors'][0]['name'], 'Busy Actor')
+        if db.engine.name == 'postgresql':
+            # one DELETE ... RETURNING, the roles are not loaded
+            self.assertEqual(counter.count, 1)
+        # ON DELETE CASCADE
+        self.assertEqual(
+            Role.query.filter(Role.movie_id == movie_id).count(), 0)
+
+        Movie.query.filter(Movie.id == movie_id).delete()
+        db.session.commit()
+
+    def test_delete_actors_by_ids(self):
+        actors = [Actor(name=f'Purged Actor {i}', age=50) for i in range(3)]
+        db.session.add_all(actors)
+        db.session.commit()
+        ids = [actor.id for actor in actors]
+
+        with QueryCounter() as counter:
+            res = self.client().delete('/actors',
+                                       headers=self.producer_header,
+                                       json={'ids': ids + [100000]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(actor['id'] for actor in
+                                data['deleted_actors']), ids)
+        self.assertEqual(data['missing_ids'], [100000])
+        if db.engine.name == 'postgresql':
+            # one DELETE ... WHERE id = ANY(...) RETURNING
+            self.assertEqual(counter.count, 1)
+        self.assertEqual(Actor.query.filter(Actor.id.in_(ids)).count(), 0)
+
+    def test_400_delete_actors_with_bad_ids(self):
+        res = self.client().delete('/actors',
+                                   headers=self.producer_header,
+                                   json={'ids': [1, 'two']})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['errors'], [
+            {'index': 1, 'message': 'an id must be an integer'}])
+        # nothing is deleted
+        self.assertIsNotNone(Actor.query.get(1))
+
+    def test_get_actor_list_pages(self):
+        actors = [Actor(name=name, age=age, gender='Female')
+                  for name, age in [('Pager B', 30), ('Pager A', 20),
+                                    ('Pager B', 40), ('Pager A', 20)]]
+        db.session.add_all(actors)
+        db.session.commit()
+        added_ids = [actor.id for actor in actors]
+
+        expected = sorted(
+            Actor.query.all(),
+            key=lambda actor: (actor.name, -actor.age, -actor.id))
+        seen = []
+        cursor = None
+        while True:
+            url = '/actors?limit=2&sort=name,-age'
+            if cursor:
+                url += '&after=' + cursor
+            res = self.client().get(url, headers=self.producer_header)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertLessEqual(len(data['actors']), 2)
+            seen += [actor['id'] for actor in data['actors']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, [actor.id for actor in expected])
+
+        # a single descending key: the id tie-breaker follows it
+        res = self.client().get('/actors?limit=3&sort=-name',
+                                headers=self.producer_header)
+        data = json.loads(res.data)
+        expected = sorted(Actor.query.all(),
+                          key=lambda actor: (actor.name, actor.id),
+                          reverse=True)
+        self.assertEqual([actor['id'] for actor in data['actors']],
+                         [actor.id for actor in expected[:3]])
+
+        Actor.query.filter(Actor.id.in_(added_ids)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+    def explain(self, query):
+        '''
+        the plan of a query, with sequential scans discouraged on
+        Postgres: the test tables are small enough for a scan to win
+        '''
+        statement = str(query.statement.compile(
+            db.engine, compile_kwargs={'literal_binds': True}))
+        if db.engine.name != 'postgresql':
+            return '\n'.join(row[-1] for row in db.session.execute(
+                'EXPLAIN QUERY PLAN ' + statement))
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        plan = '\n'.join(row[0] for row in db.session.execute(
+            'EXPLAIN ' + statement))
+        db.session.rollback()
+        return plan
+
+    def test_actor_page_is_an_index_range_scan(self):
+        keys = parse_sort('-name', Actor)
+        plan = self.explain(seek(Actor.query, Actor, keys, ['Pager', 1000],
+                                 10))
+
+        if db.engine.name == 'postgresql':
+            self.assertIn('Index Scan Backward using "ix_Actor_name_id"',
+                          plan)
+            self.assertIn('Index Cond: (ROW(', plan)
+        else:
+            self.assertIn('USING INDEX ix_Actor_name_id', plan)
+        self.assertNotIn('Sort', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
     # ----------------------------------------
     # Test error behavior for /actors
     # ----------------------------------------
@@ -200,6 +410,16 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'bad request')
 
+    def test_400_add_an_actor_without_name(self):
+        res = self.client().post('/actors',
+                                 headers=self.producer_header,
+                                 json={'age': 12, 'gender': 'Female'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     def test_400_add_an_actor_with_age_non_integer(self):
         res = self.client().post('/actors',
                                  headers=self.producer_header,
@@ -213,6 +433,44 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'bad request')
 
+    def test_400_add_actors_batch_with_invalid_items(self):
+        actors_before = Actor.query.count()
+        res = self.client().post('/actors',
+                                 headers=self.producer_header,
+                                 json=[{'name': 'Valid Actor', 'age': 30},
+                                       {'name': 'Ageless Actor'},
+                                       'not an actor'])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual([error['index'] for error in data['errors']],
+                         [1, 2])
+        # nothing of a rejected batch is inserted
+        self.assertEqual(Actor.query.count(), actors_before)
+
+    def test_400_add_an_empty_actors_batch(self):
+        res = self.client().post('/actors',
+                                 headers=self.producer_header,
+                                 json=[])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_actor_list_with_bad_page_params(self):
+        not_a_list = base64.urlsafe_b64encode(
+            b'{"s":"id","v":7}').decode('ascii')
+        for query in ['limit=0', 'limit=ten', 'sort=height',
+                      'after=not-a-cursor', 'after=' + not_a_list]:
+            res = self.client().get('/actors?' + query,
+                                    headers=self.producer_header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'bad request')
+
     def test_404_get_non_existing_actor_detail(self):
         res = self.client().get('/actors/1000', headers=self.producer_header)
         data = json.loads(res.data)
@@ -394,6 +652,53 @@ class ACastingTestCase(unittest.TestCase):
         delete_movie = self.client().delete('/movies/' + movie_id,
                                             headers=self.producer_header)
 
+    def test_add_movies_batch(self):
+        res = self.client().post('/movies',
+                                 headers=self.producer_header,
+                                 json=[{'title': 'Batch Movie',
+                                        'date': '2015-06-01'},
+                                       {'title': 'Batch Sequel',
+                                        'date': 'Mar 2019'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['release_year'] for movie in data['movies']],
+                         ['2015', '2019'])
+
+        ids = [movie['id'] for movie in data['movies']]
+        Movie.query.filter(Movie.id.in_(ids)).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+    def test_add_a_movie_with_two_digit_year(self):
+        # %m-%d-%y, misspelled %m-%d-$y in the old format list
+        res = self.client().post('/movies',
+                                 headers=self.producer_header,
+                                 json={'title': 'Y2K Movie',
+                                       'date': '12-31-99'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'][0]['release_year'], '1999')
+
+        Movie.query.filter(Movie.id == data['movies'][0]['id']).delete()
+        db.session.commit()
+
+    def test_parse_date(self):
+        self.assertEqual(parse_date('2017'), datetime(2017, 1, 1))
+        self.assertEqual(parse_date('Mar 3, 2011'), datetime(2011, 3, 3))
+        self.assertEqual(parse_date('March  3, 2011'), datetime(2011, 3, 3))
+        self.assertEqual(parse_date('September 3 2011'),
+                         datetime(2011, 9, 3))
+        self.assertEqual(parse_date('3/4/2011'), datetime(2011, 3, 4))
+        self.assertEqual(parse_date('March2011'), datetime(2011, 3, 1))
+        # %y-%m-%d comes before %m-%d-%y
+        self.assertEqual(parse_date('03-03-11'), datetime(2003, 3, 11))
+        self.assertEqual(parse_date('12-31-99'), datetime(1999, 12, 31))
+        for value in ('Merry christmas', '2017 ', '13/40/2011', '', 2017):
+            with self.assertRaises(ValueError):
+                parse_date(value)
+
     def test_get_movie_detail(self):
         res = self.client().get('/movies/1', headers=self.producer_header)
         data = json.loads(res.data)
@@ -419,6 +724,25 @@ class ACastingTestCase(unittest.TestCase):
                                           headers=self.producer_header,
                                           json={'title': 'First Movie'})
 
+    def test_edit_movie_detail_fields_together(self):
+        movie = Movie(title='Patched Movie', date='2001-01-01')
+        movie.insert()
+        movie_id = movie.id
+
+        res = self.client().patch(f'/movies/{movie_id}',
+                                  headers=self.producer_header,
+                                  json={'title': 'Renamed Movie',
+                                        'date': 'March 3, 2011'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'], [{'id': movie_id,
+                                           'title': 'Renamed Movie',
+                                           'release_year': '2011'}])
+
+        Movie.query.filter(Movie.id == movie_id).delete()
+        db.session.commit()
+
     def test_delete_an_movie(self):
         # add data beforehead to test delete request
         add_movie = self.client().post('/movies',
@@ -439,6 +763,248 @@ class ACastingTestCase(unittest.TestCase):
     # ----------------------------------------
     # Test error behavior for /movies
     # ----------------------------------------
+    def test_delete_a_movie_with_roles(self):
+        movie = Movie(title='Cast Movie', date='2012-12-12')
+        movie.insert()
+        movie_id = movie.id
+        db.session.add_all([Role(role_name=f'Cast Role {i}', actor_id=1,
+                                 movie_id=movie_id) for i in range(3)])
+        db.session.commit()
+
+        res = self.client().delete(f'/movies/{movie_id}',
+                                   headers=self.producer_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted_movies'][0]['id'], movie_id)
+        self.assertEqual(
+            Role.query.filter(Role.movie_id == movie_id).count(), 0)
+
+    def test_replace_movie_cast(self):
+        movie = Movie(title='Recast Movie', date='2014-04-04')
+        actors = [Actor(name=f'Recast Actor {i}', age=30 + i)
+                  for i in range(4)]
+        db.session.add_all([movie] + actors)
+        db.session.commit()
+        movie_id = movie.id
+        a0, a1, a2, a3 = [actor.id for actor in actors]
+        roles = [Role(role_name='Lead', actor_id=a0, movie_id=movie_id),
+                 Role(role_name='Villain', actor_id=a1, movie_id=movie_id),
+                 Role(role_name='Extra', actor_id=a2, movie_id=movie_id)]
+        db.session.add_all(roles)
+        db.session.commit()
+        lead_id, villain_id = roles[0].id, roles[1].id
+
+        with QueryCounter() as counter:
+            res = self.client().put(
+                f'/movies/{movie_id}/castings',
+                headers=self.producer_header,
+                json=[{'actor_id': a0, 'role_name': 'Lead'},
+                      {'actor_id': a1, 'role_name': 'Antihero'},
+                      {'actor_id': a3, 'role_name': 'Sidekick'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data['inserted'], data['updated'], data['deleted']),
+                         (1, 1, 1))
+        self.assertEqual(
+            [(role['id'] if role['id'] in (lead_id, villain_id) else None,
+              role['actor_id'], role['role_name']) for role in data['roles']],
+            [(lead_id, a0, 'Lead'), (villain_id, a1, 'Antihero'),
+             (None, a3, 'Sidekick')])
+        if db.engine.name == 'postgresql':
+            # lock, actors, roles, then one DELETE, UPDATE and INSERT
+            self.assertEqual(counter.count, 6)
+
+        db.session.remove()
+        self.assertEqual(
+            sorted(role.role_name for role in
+                   Role.query.filter(Role.movie_id == movie_id)),
+            ['Antihero', 'Lead', 'Sidekick'])
+
+        Movie.query.filter(Movie.id == movie_id).delete()
+        Actor.query.filter(Actor.id.in_([a0, a1, a2, a3])).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+    def test_400_replace_movie_cast_with_non_existing_actor(self):
+        res = self.client().put('/movies/1/castings',
+                                headers=self.producer_header,
+                                json=[{'actor_id': 100000,
+                                       'role_name': 'Ghost'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['errors'], [
+            {'index': 0, 'message': 'actor 100000 does not exist'}])
+        self.assertTrue(Role.query.filter(Role.movie_id == 1).count())
+
+    def test_404_replace_non_existing_movie_cast(self):
+        res = self.client().put('/movies/100000/castings',
+                                headers=self.producer_header,
+                                json=[])
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_movie_list_by_release_years(self):
+        movies = [Movie(title=f'Year Movie {year}', date=f'{year}-06-01')
+                  for year in (1931, 1932, 1933, 1934)]
+        db.session.add_all(movies)
+        db.session.commit()
+        ids = [movie.id for movie in movies]
+        self.assertEqual([movie.release_year for movie in movies],
+                         [1931, 1932, 1933, 1934])
+
+        res = self.client().get('/movies?year_from=1932&year_to=1933'
+                                '&sort=-release_year',
+                                headers=self.producer_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ['Year Movie 1933', 'Year Movie 1932'])
+
+        # the year follows the date
+        res = self.client().patch(f'/movies/{ids[0]}',
+                                  headers=self.producer_header,
+                                  json={'date': '1935-01-01'})
+        self.assertEqual(json.loads(res.data)['movies'][0]['release_year'],
+                         '1935')
+
+        Movie.query.filter(Movie.id.in_(ids)).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+    def test_movie_year_filter_is_an_index_range_scan(self):
+        query = apply_filters(MovieRecord.query(), MOVIE_FILTERS,
+                              {'year_from': '2015', 'year_to': '2020'})
+        plan = self.explain(seek(query, Movie,
+                                 parse_sort('release_year', Movie), None,
+                                 100))
+
+        if db.engine.name == 'postgresql':
+            self.assertIn('using "ix_Movie_release_year_id"', plan)
+            self.assertIn('Index Cond: ((release_year >= 2015) AND '
+                          '(release_year <= 2020))', plan)
+        else:
+            self.assertIn('USING INDEX ix_Movie_release_year_id', plan)
+        self.assertNotIn('Sort', plan)
+
+    def test_list_filters_are_index_scans(self):
+        # (filters, record, model, args, sort, index the filter must use)
+        # every filter has a row: a new one without an index fails here
+        cases = [
+            (ACTOR_FILTERS, ActorRecord, Actor, {'age_min': '20'}, 'age',
+             'ix_Actor_age_id'),
+            (ACTOR_FILTERS, ActorRecord, Actor, {'age_max': '30'}, 'age',
+             'ix_Actor_age_id'),
+            (ACTOR_FILTERS, ActorRecord, Actor, {'gender': 'Female'}, None,
+             'ix_Actor_gender_age_id'),
+            # ix_Actor_name_pattern, or ix_Actor_name_id when the database
+            # collation is C and it can serve LIKE as well
+            (ACTOR_FILTERS, ActorRecord, Actor, {'name_prefix': 'Am'}, None,
+             'ix_Actor_name_'),
+            (ROLE_FILTERS, RoleRecord, Role, {'actor_id': '1'}, None,
+             'ix_Role_actor_id'),
+            (ROLE_FILTERS, RoleRecord, Role, {'movie_id': '1'}, None,
+             'ix_Role_movie_id_actor_id'),
+            (MOVIE_FILTERS, MovieRecord, Movie, {'year_from': '2015'},
+             'release_year', 'ix_Movie_release_year_id'),
+            (MOVIE_FILTERS, MovieRecord, Movie, {'year_to': '2020'},
+             'release_year', 'ix_Movie_release_year_id'),
+        ]
+        self.assertEqual(
+            sorted(name for _, _, _, args, _, _ in cases for name in args),
+            sorted([*ACTOR_FILTERS, *ROLE_FILTERS, *MOVIE_FILTERS]))
+
+        for filters, record, model, args, sort, index in cases:
+            with self.subTest(**args):
+                query = apply_filters(record.query(), filters, args)
+                plan = self.explain(seek(query, model,
+                                         parse_sort(sort, model), None, 100))
+                self.assertIn(index, plan)
+                self.assertNotIn('Seq Scan', plan)
+                self.assertNotIn(f'SCAN {model.__tablename__}', plan)
+
+    def test_get_actor_list_by_filters(self):
+        actors = [Actor(name=name, age=age, gender=gender)
+                  for name, age, gender in [('Filtered Ann', 30, 'Female'),
+                                            ('Filtered Bob', 40, 'Male'),
+                                            ('Filtered Cid', 50, 'Female'),
+                                            ('Filter_ Dee', 40, 'Female')]]
+        db.session.add_all(actors)
+        db.session.commit()
+        ids = [actor.id for actor in actors]
+
+        res = self.client().get('/actors', headers=self.producer_header,
+                                query_string={'name_prefix': 'Filtered',
+                                              'gender': 'Female',
+                                              'age_min': 35})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ['Filtered Cid'])
+
+        # the prefix is matched literally, not as a LIKE pattern
+        res = self.client().get('/actors', headers=self.producer_header,
+                                query_string={'name_prefix': 'Filter_',
+                                              'age_max': 45, 'sort': 'name'})
+        self.assertEqual([actor['name']
+                          for actor in json.loads(res.data)['actors']],
+                         ['Filter_ Dee'])
+
+        Actor.query.filter(Actor.id.in_(ids)).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+    def test_get_castings_list_by_actor_and_movie(self):
+        actor = Actor(name='Filtered Role Actor', age=33, gender='Male')
+        movie = Movie(title='Filtered Role Movie', date='2001-01-01')
+        db.session.add_all([actor, movie])
+        db.session.commit()
+        actor_id, movie_id = actor.id, movie.id
+        roles = [Role(role_name='Filtered One', actor_id=actor_id,
+                      movie_id=movie_id),
+                 Role(role_name='Filtered Two', actor_id=actor_id,
+                      movie_id=1)]
+        db.session.add_all(roles)
+        db.session.commit()
+
+        res = self.client().get('/castings', headers=self.producer_header,
+                                query_string={'actor_id': actor_id})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([role['role_name'] for role in data['roles']],
+                         ['Filtered One', 'Filtered Two'])
+
+        res = self.client().get('/castings', headers=self.producer_header,
+                                query_string={'actor_id': actor_id,
+                                              'movie_id': movie_id})
+        self.assertEqual([role['role_name']
+                          for role in json.loads(res.data)['roles']],
+                         ['Filtered One'])
+
+        # deleting the actor and the movie cascades to the roles
+        Actor.query.filter(Actor.id == actor_id).delete()
+        Movie.query.filter(Movie.id == movie_id).delete()
+        db.session.commit()
+
+    def test_400_get_lists_with_bad_filters(self):
+        for url in ('/actors?age_min=old', '/actors?gender=',
+                    '/actors?name_prefix=', '/castings?movie_id=first'):
+            with self.subTest(url=url):
+                res = self.client().get(url, headers=self.producer_header)
+
+                self.assertEqual(res.status_code, 400)
+
+    def test_400_get_movie_list_with_bad_year(self):
+        res = self.client().get('/movies?year_from=recent',
+                                headers=self.producer_header)
+
+        self.assertEqual(res.status_code, 400)
+
     def test_405_get_movies_with_bad_methods(self):
         res = self.client().patch('/movies', headers=self.producer_header)
         data = json.loads(res.data)
@@ -555,6 +1121,14 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(data['code'], 'unauthorized')
         self.assertEqual(data['description'], 'Permission not found.')
 
+    def test_assistant_delete_movies(self):
+        res = self.client().delete('/movies', headers=self.assistant_header,
+                                   json={'ids': [1]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['code'], 'unauthorized')
+
     def test_assistant_delete_a_movie(self):
         res = self.client().delete('/movies/1', headers=self.assistant_header)
         data = json.loads(res.data)
@@ -642,6 +1216,42 @@ class ACastingTestCase(unittest.TestCase):
         delete_role = self.client().delete('/castings/' + role_id,
                                            headers=self.producer_header)
 
+    def test_add_a_role_is_one_statement(self):
+        with QueryCounter() as counter:
+            res = self.client().post('/castings',
+                                     headers=self.producer_header,
+                                     json=self.new_role)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['roles'][0]['movie_name'],
+                         Movie.query.get(1).title)
+        if db.engine.name == 'postgresql':
+            # checked, inserted and read back with the names at once
+            self.assertEqual(counter.count, 1)
+
+        Role.query.filter(Role.id == data['roles'][0]['id']).delete()
+        db.session.commit()
+
+    def test_add_roles_batch(self):
+        roles = [dict(self.new_role, role_name=f'Batch Role {i}')
+                 for i in range(3)]
+        res = self.client().post('/castings',
+                                 headers=self.producer_header,
+                                 json=roles)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([role['role_name'] for role in data['roles']],
+                         ['Batch Role 0', 'Batch Role 1', 'Batch Role 2'])
+        self.assertEqual(data['roles'][0]['actor_name'],
+                         Actor.query.get(1).name)
+
+        ids = [role['id'] for role in data['roles']]
+        Role.query.filter(Role.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
     def test_delete_a_role(self):
         # add data beforehead to test delete request
         add_role = self.client().post('/castings',
@@ -660,6 +1270,144 @@ class ACastingTestCase(unittest.TestCase):
         self.assertTrue(len(data['deleted_roles']))
         self.assertEqual(data['deleted_roles'][0]['id'], int(role_id))
 
+    def test_delete_roles_by_ids(self):
+        roles = [Role(role_name=f'Purged Role {i}', actor_id=1, movie_id=1)
+                 for i in range(3)]
+        db.session.add_all(roles)
+        db.session.commit()
+        ids = [role.id for role in roles]
+
+        res = self.client().delete('/castings',
+                                   headers=self.producer_header,
+                                   json={'ids': ids})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(role['id'] for role in data['deleted_roles']),
+                         ids)
+        self.assertEqual(data['deleted_roles'][0]['movie_name'],
+                         Movie.query.get(1).title)
+        self.assertEqual(data['missing_ids'], [])
+
+    def test_get_castings_list_query_count(self):
+        def castings_queries():
+            with QueryCounter() as counter:
+                res = self.client().get('/castings',
+                                        headers=self.producer_header)
+            self.assertEqual(res.status_code, 200)
+            return counter.count, len(json.loads(res.data)['roles'])
+
+        queries_before, roles_before = castings_queries()
+
+        actors = [Actor(name='Counted Actor', age=30) for _ in range(5)]
+        movies = [Movie(title='Counted Movie', date='2020-01-01')
+                  for _ in range(5)]
+        db.session.add_all(actors + movies)
+        db.session.commit()
+        roles = [Role(role_name='Counted Role', actor_id=actor.id,
+                      movie_id=movie.id)
+                 for actor, movie in zip(actors, movies)]
+        db.session.add_all(roles)
+        db.session.commit()
+
+        queries_after, roles_after = castings_queries()
+
+        self.assertEqual(roles_after, roles_before + 5)
+        self.assertEqual(queries_after, queries_before)
+        self.assertEqual(queries_after, 1)
+
+        for entity in roles + actors + movies:
+            db.session.delete(entity)
+            db.session.commit()
+
+    def test_get_castings_list_stream(self):
+        res = self.client().get('/castings?limit=1000&sort=-role_name',
+                                headers=self.producer_header)
+        page = json.loads(res.data)
+
+        res = self.client().get('/castings?stream=1&sort=-role_name',
+                                headers=self.producer_header)
+        self.assertTrue(res.is_streamed)
+        self.assertNotIn('Content-Length', res.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data, page)
+        self.assertIsNone(data['next_cursor'])
+
+        # with a limit the stream stops there and returns a cursor
+        res = self.client().get('/castings?stream=1&limit=1',
+                                headers=self.producer_header)
+        data = json.loads(res.data)
+        if len(page['roles']) > 1:
+            self.assertEqual(len(data['roles']), 1)
+            res = self.client().get(
+                '/castings?stream=1&after=' + data['next_cursor'],
+                headers=self.producer_header)
+            rest = json.loads(res.data)
+            self.assertEqual(len(rest['roles']), len(page['roles']) - 1)
+
+        res = self.client().get('/castings?stream=1&sort=height',
+                                headers=self.producer_header)
+        self.assertEqual(res.status_code, 400)
+
+    def test_records_format_like_models(self):
+        for model, record in [(Actor, ActorRecord), (Movie, MovieRecord),
+                              (Role, RoleRecord)]:
+            instances = model.query.order_by(model.id).all()
+            records = [record._make(row)
+                       for row in record.query().order_by(model.id)]
+
+            self.assertTrue(records)
+            self.assertEqual([r.format() for r in records],
+                             [instance.format() for instance in instances])
+            db.session.remove()
+
+    def test_get_detail_query_count(self):
+        actor = Actor(name='Busy Actor', age=40)
+        movie = Movie(title='Busy Movie', date='2020-01-01')
+        movies = [Movie(title='Credited Movie', date='2020-01-01')
+                  for _ in range(5)]
+        db.session.add_all([actor, movie] + movies)
+        db.session.commit()
+        actor_id, movie_id = actor.id, movie.id
+        movie_ids = [credited.id for credited in movies]
+
+        def detail_queries(url):
+            with QueryCounter() as counter:
+                res = self.client().get(url, headers=self.producer_header)
+            self.assertEqual(res.status_code, 200)
+            return counter.count
+
+        roles = []
+        for credited_id in movie_ids:
+            roles += [Role(role_name='Credit', actor_id=actor_id,
+                           movie_id=credited_id),
+                      Role(role_name='Cast', actor_id=actor_id,
+                           movie_id=movie_id)]
+            db.session.add_all(roles[-2:])
+            db.session.commit()
+
+            # one query whatever the number of roles
+            self.assertEqual(detail_queries(f'/actors/{actor_id}'), 1)
+            self.assertEqual(detail_queries(f'/movies/{movie_id}'), 1)
+
+        res = self.client().get(f'/actors/{actor_id}',
+                                headers=self.producer_header)
+        data = json.loads(res.data)
+        self.assertEqual(len(data['actors'][0]['roles']), 10)
+        self.assertEqual(
+            sorted(role['movie_title'] for role in data['actors'][0]['roles']),
+            ['Busy Movie'] * 5 + ['Credited Movie'] * 5)
+
+        Role.query.filter(Role.actor_id == actor_id) \
+            .delete(synchronize_session=False)
+        Movie.query.filter(Movie.id.in_(movie_ids + [movie_id])) \
+            .delete(synchronize_session=False)
+        Actor.query.filter(Actor.id == actor_id) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
     # ----------------------------------------
     # Test error behavior for /casting
     # ----------------------------------------
@@ -725,6 +1473,19 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'bad request')
 
+    def test_400_add_roles_batch_with_non_existing_movie(self):
+        roles_before = Role.query.count()
+        res = self.client().post('/castings',
+                                 headers=self.producer_header,
+                                 json=[self.new_role,
+                                       dict(self.new_role, movie_id=10000)])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['errors'], [
+            {'index': 1, 'message': 'movie 10000 does not exist'}])
+        self.assertEqual(Role.query.count(), roles_before)
+
     def test_404_delete_non_existing_role(self):
         res = self.client().delete('/castings/1000',
                                    headers=self.producer_header)
@@ -801,6 +1562,344 @@ class ACastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['roles']))
 
+    # ----------------------------------------
+    # Export
+    # ----------------------------------------
+    def test_export_ndjson(self):
+        counts = {'actor': Actor.query.count(), 'movie': Movie.query.count(),
+                  'role': Role.query.count()}
+        actor = Actor.query.order_by(Actor.id).first().format()
+        db.session.remove()
+
+        res = self.client().get('/export', headers=self.assistant_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.is_streamed)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+
+        lines = [json.loads(line) for line in res.data.splitlines()]
+        self.assertEqual({type_: sum(line['type'] == type_ for line in lines)
+                          for type_ in counts}, counts)
+        first_actor = next(line for line in lines if line['type'] == 'actor')
+        self.assertEqual(first_actor, dict(actor, type='actor'))
+
+    def test_export_csv(self):
+        count = Movie.query.count()
+        db.session.remove()
+
+        res = self.client().get('/export?format=csv&entity=movies',
+                                headers=self.producer_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+
+        lines = res.data.decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 'id,title,date')
+        self.assertEqual(len(lines), count + 1)
+
+    def test_400_export_with_bad_params(self):
+        for query in ['format=xml', 'format=csv', 'entity=directors',
+                      'format=csv&entity=actors,movies']:
+            res = self.client().get('/export?' + query,
+                                    headers=self.producer_header)
+            self.assertEqual(res.status_code, 400)
+
+    def test_401_export_without_token(self):
+        res = self.client().get('/export')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['code'], 'authorization_header_missing')
+
+    # ----------------------------------------
+    # Search
+    # ----------------------------------------
+    def test_search_ranks_actors_movies_and_roles(self):
+        actor = Actor(name='Zorro Searched', age=40, gender='Male')
+        movie = Movie(title='zorro', date='1998-07-17')
+        db.session.add_all([actor, movie])
+        db.session.commit()
+        ids = {'actor': actor.id, 'movie': movie.id}
+        role = Role(role_name='The Mask of Zorro, searched at night',
+                    actor_id=ids['actor'], movie_id=ids['movie'])
+        db.session.add(role)
+        db.session.commit()
+        ids['role'] = role.id
+
+        res = self.client().get('/search?q=ZORRO',
+                                headers=self.producer_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['next_cursor'], None)
+        # the shorter the text, the better the match
+        self.assertEqual([(result['type'], result['id'])
+                          for result in data['results']],
+                         [('movie', ids['movie']), ('actor', ids['actor']),
+                          ('role', ids['role'])])
+        self.assertEqual(data['results'][0]['title'], 'zorro')
+        self.assertEqual(data['results'][1]['name'], 'Zorro Searched')
+        ranks = [result['rank'] for result in data['results']]
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+        # every word, in any order
+        res = self.client().get('/search?q=searched+zorro',
+                                headers=self.producer_header)
+        self.assertEqual([result['type']
+                          for result in json.loads(res.data)['results']],
+                         ['actor', 'role'])
+
+        # page by page, each result once
+        results = []
+        url = '/search?q=zorro&limit=1'
+        while url:
+            data = json.loads(self.client().get(
+                url, headers=self.producer_header).data)
+            results += [(result['type'], result['id'])
+                        for result in data['results']]
+            url = data['next_cursor'] and \
+                f'/search?q=zorro&limit=1&after={data["next_cursor"]}'
+        self.assertEqual(results, [('movie', ids['movie']),
+                                   ('actor', ids['actor']),
+                                   ('role', ids['role'])])
+
+        # the indexes follow the writes, cascading deletes included
+        self.client().patch(f'/movies/{ids["movie"]}',
+                            headers=self.producer_header,
+                            json={'title': 'Untitled'})
+        Actor.query.filter(Actor.id == ids['actor']).delete()
+        db.session.commit()
+        res = self.client().get('/search?q=zorro',
+                                headers=self.producer_header)
+        self.assertEqual(json.loads(res.data)['results'], [])
+
+        Movie.query.filter(Movie.id == ids['movie']).delete()
+        db.session.commit()
+
+    def test_search_uses_the_full_text_indexes(self):
+        statement, parameters = search_statement(['first', 'role'],
+                                                 None, 100)
+        if db.engine.name == 'postgresql':
+            db.session.execute('SET LOCAL enable_seqscan = off')
+            plan = '\n'.join(row[0] for row in db.session.execute(
+                'EXPLAIN ' + str(statement), parameters))
+            db.session.rollback()
+            for table in ('Actor', 'Movie', 'Role'):
+                self.assertIn(f'Bitmap Index Scan on "ix_{table}_search_'
+                              f'vector"', plan)
+            self.assertNotIn('Seq Scan', plan)
+        else:
+            plan = '\n'.join(row[-1] for row in db.session.execute(
+                'EXPLAIN QUERY PLAN ' + str(statement), parameters))
+            for table in ('Actor', 'Movie', 'Role'):
+                self.assertIn(f'SCAN {table}_search VIRTUAL TABLE INDEX',
+                              plan)
+
+    def test_search_without_words_is_empty(self):
+        res = self.client().get('/search?q=%21%3F',
+                                headers=self.producer_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'], [])
+
+    def test_400_search_with_bad_params(self):
+        res = self.client().get('/search?q=first&limit=1',
+                                headers=self.producer_header)
+        cursor = json.loads(res.data)['next_cursor']
+        self.assertTrue(cursor)
+
+        for query in ['', 'q=', 'q=first&limit=0', 'q=first&after=nope',
+                      f'q=role&after={cursor}']:
+            with self.subTest(query=query):
+                res = self.client().get('/search?' + query,
+                                        headers=self.producer_header)
+                self.assertEqual(res.status_code, 400)
+
+    def test_401_search_without_token(self):
+        res = self.client().get('/search?q=first')
+
+        self.assertEqual(res.status_code, 401)
+
+    # ----------------------------------------
+    # Autocomplete
+    # ----------------------------------------
+    def test_prefix_index(self):
+        index = PrefixIndex(max_entries=4)
+        index.build([('actor', 1, 'Link'), ('movie', 1, 'The Legend'),
+                     ('actor', 2, 'lisa'), ('movie', 2, 'Lion King'),
+                     ('actor', 3, 'Left out')])
+
+        def names(prefix, limit=10):
+            return [name for _, _, _, name in index.lookup(prefix, limit)]
+
+        # bounded: the fifth name is not indexed
+        self.assertEqual(names(''), ['Link', 'Lion King', 'lisa',
+                                     'The Legend'])
+        self.assertEqual(names('LI'), ['Link', 'Lion King', 'lisa'])
+        self.assertEqual(names('li', 2), ['Link', 'Lion King'])
+        self.assertEqual(names('lio'), ['Lion King'])
+        self.assertEqual(names('x'), [])
+
+        index.apply([('actor', 1, 'Zelda'), ('movie', 2, None),
+                     ('actor', 4, 'Liam')])
+        self.assertEqual(names(''), ['Liam', 'lisa', 'The Legend', 'Zelda'])
+
+        # a change committed while a rebuild reads the database is kept
+        def rows():
+            index.apply([('actor', 5, 'Lima')])
+            yield 'actor', 2, 'lisa'
+        index.max_entries = 10
+        index.build(rows())
+        self.assertEqual(names(''), ['Lima', 'lisa'])
+
+    def test_autocomplete_follows_the_writes(self):
+        with self.app.app_context(), building:
+            build_index()
+
+        def completions(q):
+            res = self.client().get('/autocomplete', query_string={'q': q},
+                                    headers=self.producer_header)
+            self.assertEqual(res.status_code, 200)
+            return [(result['type'], result.get('name') or result['title'])
+                    for result in json.loads(res.data)['results']]
+
+        self.assertEqual(completions('qwerty'), [])
+        res = self.client().post('/actors', headers=self.producer_header,
+                                 json={'name': 'Qwerty Actor', 'age': 30})
+        actor_id = json.loads(res.data)['actors'][0]['id']
+        self.client().post('/movies', headers=self.producer_header,
+                           json=[{'title': 'qwerty movie',
+                                  'date': '2001-01-01'}])
+        self.assertEqual(completions('QWERTY'),
+                         [('actor', 'Qwerty Actor'),
+                          ('movie', 'qwerty movie')])
+
+        self.client().patch(f'/actors/{actor_id}',
+                            headers=self.producer_header,
+                            json={'name': 'Qwertz Actor'})
+        self.assertEqual(completions('qwert'),
+                         [('movie', 'qwerty movie'),
+                          ('actor', 'Qwertz Actor')])
+
+        # a rolled back insert is not completed
+        with self.assertRaises(RuntimeError):
+            with transaction():
+                Actor(name='Qwerty Rolled Back', age=1,
+                      gender=None).insert()
+                raise RuntimeError
+        self.assertEqual(completions('qwerty r'), [])
+
+        self.client().delete(f'/actors/{actor_id}',
+                             headers=self.producer_header)
+        Movie.query.filter(Movie.title == 'qwerty movie').one().delete()
+        self.assertEqual(completions('qwert'), [])
+
+    def test_400_autocomplete_with_bad_params(self):
+        for query in ['', 'q=', 'q=a&limit=0', 'q=a&limit=101']:
+            with self.subTest(query=query):
+                res = self.client().get('/autocomplete?' + query,
+                                        headers=self.producer_header)
+                self.assertEqual(res.status_code, 400)
+
+    def test_401_autocomplete_without_token(self):
+        res = self.client().get('/autocomplete?q=a')
+
+        self.assertEqual(res.status_code, 401)
+
+    def test_503_autocomplete_before_the_index_is_built(self):
+        # the request does not build the index itself
+        with mock.patch('autocomplete.index', PrefixIndex()) as index:
+            res = self.client().get('/autocomplete?q=a',
+                                    headers=self.producer_header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(data['success'], False)
+            self.assertIsNone(index.entries)
+
+    # ----------------------------------------
+    # Unit of work
+    # ----------------------------------------
+    def test_transaction_commits_once(self):
+        with QueryCounter() as counter:
+            with transaction():
+                actor = Actor(name='Unit Actor', age=41)
+                movie = Movie(title='Unit Movie', date='2003-03-03')
+                actor.insert()
+                movie.insert()
+                # flushed: the ids are known inside the block
+                role = Role(role_name='Unit Role', actor_id=actor.id,
+                            movie_id=movie.id)
+                with transaction():
+                    role.insert()
+                self.assertFalse(any(statement.startswith('COMMIT')
+                                     for statement in counter.statements))
+        db.session.remove()
+
+        role = Role.query.filter(Role.role_name == 'Unit Role').one()
+        self.assertEqual(role.actor.name, 'Unit Actor')
+        movie_id = role.movie_id
+        Actor.query.filter(Actor.id == role.actor_id).delete()
+        Movie.query.filter(Movie.id == movie_id).delete()
+        db.session.commit()
+
+    def test_transaction_rolls_back_on_error(self):
+        actors_before = Actor.query.count()
+        with self.assertRaises(ValueError):
+            with transaction():
+                Actor(name='Rolled Back Actor', age=42).insert()
+                Actor(name='Rolled Back Actor', age=43).insert(commit=False)
+                raise ValueError('changed my mind')
+        db.session.remove()
+
+        self.assertEqual(Actor.query.count(), actors_before)
+
+    # ----------------------------------------
+    # Import
+    # ----------------------------------------
+    def test_import_ndjson(self):
+        lines = [
+            {'type': 'actor', 'id': 100001, 'name': 'Imported Actor',
+             'age': 33, 'gender': 'Female'},
+            {'type': 'movie', 'title': 'Imported Movie',
+             'date': '2001-02-03T00:00:00'},
+            {'type': 'role', 'role_name': 'Imported Role',
+             'actor_id': 100001, 'movie_title': 'Imported Movie'},
+            {'type': 'role', 'role_name': 'Orphan Role',
+             'actor_id': 100001, 'movie_title': 'Missing Movie'},
+            {'type': 'actor', 'name': 'Ageless Actor', 'age': 'old'},
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'casting.ndjson')
+            with open(path, 'w') as f:
+                f.writelines(json.dumps(line) + '\n' for line in lines)
+                f.write('not json\n')
+
+            importer = Importer(batch_size=2)
+            with transaction():
+                importer.load(read_records(path), source=path)
+                importer.finish()
+
+        self.assertEqual(importer.rows,
+                         {'actors': 1, 'movies': 1, 'roles': 1})
+        self.assertEqual(sorted(number for _, number, _ in importer.errors),
+                         [4, 5, 6])
+
+        role = Role.query.filter(Role.role_name == 'Imported Role').one()
+        self.assertEqual(role.actor.id, 100001)
+        self.assertEqual(role.movie.title, 'Imported Movie')
+
+        # the id sequence was moved past the imported id
+        actor = Actor(name='After Import', age=1)
+        actor.insert()
+        self.assertGreater(actor.id, 100001)
+
+        movie_id = role.movie_id
+        Role.query.filter(Role.id == role.id).delete()
+        Movie.query.filter(Movie.id == movie_id).delete()
+        Actor.query.filter(Actor.id.in_([100001, actor.id])).delete(
+            synchronize_session=False)
+        db.session.commit()
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
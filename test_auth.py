@@ -0,0 +1,368 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from flask import Flask
+from jose import jwt
+
+import local_auth
+from auth import (API_AUDIENCE, AUTH_ISSUER,
+                  AuthError, CircuitBreaker, JWKSCache, TokenCache,
+                  ROUTE_PERMISSIONS, allowed_routes, check_permissions,
+                  register_route_permissions, requires_auth)
+
+# A JWKS document with a single (fake) key, served by the stub below
+
+jwks_document = {
+    'keys': [{
+        'kty': 'RSA',
+        'kid': 'first-key',
+        'use': 'sig',
+        'n': 'abc',
+        'e': 'AQAB',
+    }]
+}
+
+
+class StubJWKSCache(JWKSCache):
+    ''' JWKSCache that serves jwks_document instead of calling Auth0 '''
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('background_refresh', False)
+        super().__init__('https://example.invalid/jwks.json',
+                         *args, **kwargs)
+        self.document = jwks_document
+        self.fetches = 0
+
+    def fetch(self):
+        self.fetches += 1
+        return self.document
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    ''' This class represents the JWKS key store test case'''
+
+    def test_steady_state_does_not_fetch(self):
+        cache = StubJWKSCache()
+
+        for _ in range(100):
+            key = cache.get_key('first-key')
+
+        self.assertEqual(key['kid'], 'first-key')
+        self.assertEqual(cache.fetches, 1)
+        self.assertEqual(cache.stats()['hits'], 100)
+        self.assertEqual(cache.stats()['refreshes'], 1)
+
+    def test_expired_keys_are_fetched_again(self):
+        cache = StubJWKSCache(ttl=0)
+
+        cache.get_key('first-key')
+        cache.get_key('first-key')
+
+        self.assertEqual(cache.fetches, 2)
+
+    def test_unknown_kid_forces_one_rate_limited_refresh(self):
+        cache = StubJWKSCache(min_refresh_interval=0)
+        cache.get_key('first-key')
+
+        self.assertIsNone(cache.get_key('rotated-key'))
+        self.assertEqual(cache.fetches, 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        # within the refresh interval unknown kids are not fetched again
+        cache.min_refresh_interval = 60
+        for _ in range(10):
+            self.assertIsNone(cache.get_key('forged-key'))
+        self.assertEqual(cache.fetches, 2)
+
+    def test_unknown_kid_picks_up_rotated_key(self):
+        cache = StubJWKSCache(min_refresh_interval=0)
+        cache.get_key('first-key')
+
+        rotated = dict(jwks_document['keys'][0], kid='rotated-key')
+        cache.document = {'keys': [rotated]}
+
+        self.assertEqual(cache.get_key('rotated-key')['kid'], 'rotated-key')
+
+
+class JWKSHandler(BaseHTTPRequestHandler):
+    ''' Local stand-in for Auth0 /.well-known/jwks.json '''
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        if self.server.down:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        body = json.dumps(self.server.document).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class JWKSRefreshTestCase(unittest.TestCase):
+    '''
+    This class represents the JWKS snapshot, background refresh and
+    circuit breaker test case, against a local HTTP server
+    '''
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), JWKSHandler)
+        self.server.requests = 0
+        self.server.down = False
+        self.server.delay = 0
+        self.server.document = jwks_document
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/.well-known/jwks.json' % (
+            self.server.server_address[1])
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.snapshot_path = os.path.join(self.tmpdir.name, 'jwks.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def test_snapshot_is_loaded_without_fetching(self):
+        cache = JWKSCache(self.url, snapshot_path=self.snapshot_path,
+                          background_refresh=False)
+        cache.get_key('first-key')
+        self.assertEqual(self.server.requests, 1)
+
+        # a new worker boots while Auth0 is down
+        self.server.down = True
+        booted = JWKSCache(self.url, snapshot_path=self.snapshot_path,
+                           background_refresh=False)
+
+        self.assertEqual(booted.get_key('first-key')['kid'], 'first-key')
+        self.assertEqual(self.server.requests, 1)
+
+    def test_snapshot_of_another_url_is_ignored(self):
+        cache = JWKSCache(self.url, snapshot_path=self.snapshot_path,
+                          background_refresh=False)
+        cache.get_key('first-key')
+
+        other = JWKSCache('http://127.0.0.1:1/jwks.json',
+                          snapshot_path=self.snapshot_path,
+                          background_refresh=False)
+        self.assertEqual(other.keys, {})
+
+    def test_circuit_breaker_fails_fast(self):
+        self.server.down = True
+        cache = JWKSCache(self.url, background_refresh=False,
+                          breaker=CircuitBreaker(failure_threshold=2,
+                                                 reset_timeout=60))
+
+        for _ in range(2):
+            with self.assertRaises(AuthError) as context:
+                cache.get_key('first-key')
+            self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(cache.stats()['circuit'], 'open')
+
+        # the breaker is open: no more requests reach the server
+        with self.assertRaises(AuthError):
+            cache.get_key('first-key')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_half_open_breaker_closes_after_success(self):
+        self.server.down = True
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        cache = JWKSCache(self.url, background_refresh=False,
+                          breaker=breaker)
+        with self.assertRaises(AuthError):
+            cache.get_key('first-key')
+
+        self.server.down = False
+        self.assertEqual(cache.get_key('first-key')['kid'], 'first-key')
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_stale_keys_are_served_while_revalidating(self):
+        cache = JWKSCache(self.url, ttl=60)
+        cache.get_key('first-key')
+
+        # keys past their TTL and a slow Auth0: requests are still served
+        cache.fetched_at -= 60
+        self.assertEqual(cache.get_key('first-key')['kid'], 'first-key')
+        self.assertEqual(cache.stats()['stale_hits'], 1)
+
+        deadline = time.monotonic() + 5
+        while cache.refreshes < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.refreshes, 2)
+        self.assertFalse(cache.is_expired())
+
+    def test_stale_keys_are_served_during_a_slow_fetch(self):
+        cache = JWKSCache(self.url, ttl=60)
+        cache.get_key('first-key')
+
+        self.server.delay = 1
+        cache.fetched_at -= 60
+        cache.get_key('first-key')
+        deadline = time.monotonic() + 5
+        while self.server.requests < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.requests, 2)
+
+        # the refresher is now blocked on the network
+        started = time.monotonic()
+        self.assertEqual(cache.get_key('first-key')['kid'], 'first-key')
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(cache.refreshes, 1)
+
+        deadline = time.monotonic() + 5
+        while cache.refreshes < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.refreshes, 2)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    ''' This class represents the verified token cache test case'''
+
+    def test_cached_payload_is_returned(self):
+        cache = TokenCache()
+        payload = {'sub': 'someone', 'exp': time.time() + 60}
+        cache.put('token', payload)
+
+        self.assertIs(cache.get('token')[0], payload)
+        self.assertIsNone(cache.get('other token'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['hit_rate'], 0.5)
+
+    def test_entry_never_outlives_exp(self):
+        cache = TokenCache()
+        cache.put('token', {'sub': 'someone', 'exp': time.time() - 1})
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_token_without_exp_is_not_cached(self):
+        cache = TokenCache()
+        cache.put('token', {'sub': 'someone'})
+
+        self.assertIsNone(cache.get('token'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = TokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.put('first', {'exp': exp})
+        cache.put('second', {'exp': exp})
+        cache.get('first')
+        cache.put('third', {'exp': exp})
+
+        self.assertIsNotNone(cache.get('first'))
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['size'], 2)
+
+
+class PermissionTestCase(unittest.TestCase):
+    ''' This class represents the permission check and registry test case'''
+
+    def test_check_permissions_with_precompiled_set(self):
+        payload = {'permissions': ['get:actors', 'get:movies']}
+        permissions = frozenset(payload['permissions'])
+
+        self.assertTrue(check_permissions('get:actors', payload, permissions))
+        with self.assertRaises(AuthError) as context:
+            check_permissions('post:actors', payload, permissions)
+        self.assertEqual(context.exception.status_code, 401)
+
+    def test_check_permissions_without_permissions_claim(self):
+        with self.assertRaises(AuthError) as context:
+            check_permissions('get:actors', {'sub': 'someone'})
+        self.assertEqual(context.exception.status_code, 400)
+
+    def test_route_permission_registry(self):
+        # keep the registry of the real app intact for other tests
+        saved = dict(ROUTE_PERMISSIONS)
+        self.addCleanup(ROUTE_PERMISSIONS.update, saved)
+        self.addCleanup(ROUTE_PERMISSIONS.clear)
+        self.addCleanup(allowed_routes.cache_clear)
+
+        app = Flask(__name__)
+
+        @app.route('/')
+        def welcome():
+            return ''
+
+        @app.route('/actors', methods=['GET'])
+        @requires_auth('get:actors')
+        def get_actors(payload):
+            return ''
+
+        @app.route('/actors', methods=['POST'])
+        @requires_auth(('post:actors', 'get:actors'))
+        def add_actor(payload):
+            return ''
+
+        registry = register_route_permissions(app)
+
+        self.assertEqual(registry, {
+            ('GET', '/actors'): frozenset(['get:actors']),
+            ('POST', '/actors'): frozenset(['post:actors', 'get:actors']),
+        })
+        self.assertEqual(allowed_routes(frozenset(['get:actors'])),
+                         (('GET', '/actors'),))
+        self.assertEqual(
+            allowed_routes(frozenset(['get:actors', 'post:actors'])),
+            (('GET', '/actors'), ('POST', '/actors')))
+
+
+class LocalKeysTestCase(unittest.TestCase):
+    ''' This class represents the offline signing mode test case'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.private_key_path = os.path.join(cls.tmpdir.name, 'private.pem')
+        cls.jwks_path = os.path.join(cls.tmpdir.name, 'jwks.json')
+        cls.private_key_pem = local_auth.generate_keys(
+            cls.private_key_path, cls.jwks_path, bits=1024)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_minted_token_verifies_against_local_jwks(self):
+        token = local_auth.mint_token('director', self.private_key_pem)
+        cache = JWKSCache('file://' + self.jwks_path,
+                          background_refresh=False)
+        rsa_key = cache.get_key(jwt.get_unverified_header(token)['kid'])
+
+        payload = jwt.decode(token, rsa_key, algorithms=['RS256'],
+                             audience=API_AUDIENCE, issuer=AUTH_ISSUER)
+        self.assertEqual(payload['permissions'],
+                         local_auth.ROLE_PERMISSIONS['director'])
+
+    def test_expired_token_is_rejected(self):
+        token = local_auth.mint_token('producer', self.private_key_pem,
+                                      expires_in=-60)
+        rsa_key = local_auth.public_jwks(self.private_key_pem)['keys'][0]
+
+        with self.assertRaises(jwt.ExpiredSignatureError):
+            jwt.decode(token, rsa_key, algorithms=['RS256'],
+                       audience=API_AUDIENCE, issuer=AUTH_ISSUER)
+
+    def test_unknown_role(self):
+        with self.assertRaises(ValueError):
+            local_auth.mint_token('intern', self.private_key_pem)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()